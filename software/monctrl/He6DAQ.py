@@ -1,138 +1,54 @@
 #!/usr/bin/env python
 
 import adc5g
+from adccal import CoreSolver, fit_core_phases
+from codec import BasePacket, PacketCodec
 from copy import deepcopy
 from corr.katcp_wrapper import FpgaClient
+from daq_capture import DataCapture
 from datetime import datetime
 import netifaces as ni
 from numpy import (
 	abs,
+	arange,
 	array,
+	bincount,
 	ceil,
 	complex64,
-	concatenate,
+	empty,
 	float32,
+	float64,
 	floor,
+	frombuffer,
 	int8,
 	pi,
+	sqrt,
+	uint16,
 	uint32,
 	uint64,
 	uint8,
 	zeros,
 	)
 from scipy.signal import firwin2
-from socket import socket, AF_INET, SOCK_DGRAM
-from struct import unpack
+from stats import PipelineStats
 from time import sleep, time
 
-class Packet():
+class Packet(BasePacket):
 	"""
-	Encapsulate an He6CRES packet. Header length and structure are retained from R2DAQ (aka ArtooDaq)
+	Encapsulate an He6CRES packet with 8-bit samples. Header length and structure are retained from R2DAQ (aka ArtooDaq)
 	"""
 
-	BYTES_IN_PAYLOAD = 8192
-	BYTES_IN_HEADER = 32
-	BYTES_IN_PACKET = BYTES_IN_PAYLOAD + BYTES_IN_HEADER
+	CODEC = PacketCodec('int8')
+	PAYLOAD_DTYPE = CODEC.wire_dtype
+	SAMPLES_PER_WORD = CODEC.samples_per_word
 
-	@property
-	def unix_time(self):
-		return self._unix_time
-
-	@property
-	def pkt_in_batch(self):
-		return self._pkt_in_batch
-
-	@property
-	def digital_id(self):
-		return self._digital_id
-
-	@property
-	def if_id(self):
-		return self._if_id
-
-	@property
-	def user_data_1(self):
-		return self._user_data_1
-
-	@property
-	def user_data_0(self):
-		return self._user_data_0
-
-	@property
-	def reserved_0(self):
-		return self._reserved_0
-
-	@property
-	def reserverd_1(self):
-		return self._reserved_1
-
-	@property
-	def freq_not_time(self):
-		return self._freq_not_time
-
-	@property
-	def data(self):
-		return self._data
-
-	def __init__(self,ut=0,pktnum=0,did=0,ifid=0,ud0=0,ud1=0,res0=0,res1=0,fnt=False,data=None):
-		"""
-		Initialize Packet with the given attributes
-		"""
-		# assign attributes
-		self._unix_time = ut
-		self._pkt_in_batch = pktnum
-		self._digital_id = did
-		self._if_id = ifid
-		self._user_data_0 = ud0
-		self._user_data_1 = ud1
-		self._reserved_0 = res0
-		self._reserved_1 = res1
-		self._freq_not_time = fnt
-		self._data = data
-
-	def interpret_data(self):
-		"""
-		Returns
-		-------
-		x : ndarray
-		    real-valued array represented by the data.
-		"""
-		x = array(self.data, dtype = uint16)
-		return x
-
-	@classmethod
-	def FromByteString(cls,bytestr):
-		"""
-		Parse packet header and data from the given byte string, return an object of type Packet
-		"""
-		# check correct size packet
-		len_bytes = len(bytestr)
-		if not len_bytes == cls.BYTES_IN_PACKET:
-			raise ValueError("Packet should comprise {0} bytes, but has {1} bytes".format(len_bytes,cls.BYTES_IN_PACKET))
-		# unpack header
-		hdr = unpack(">{0}Q".format(cls.BYTES_IN_HEADER/8),bytestr[:cls.BYTES_IN_HEADER])
-		ut = uint32(hdr[0] & 0xFFFFFFFF)
-		pktnum = uint32((hdr[0]>>uint32(32)) & 0xFFFFF)
-		did = uint8(hdr[0]>>uint32(52) & 0x3F)
-		ifid = uint8(hdr[0]>>uint32(58) & 0x3F)
-		ud1 = uint32(hdr[1] & 0xFFFFFFFF)
-		ud0 = uint32((hdr[1]>>uint32(32)) & 0xFFFFFFFF)
-		res0 = uint64(hdr[2])
-		res1 = uint64(hdr[3]&0x7FFFFFFFFFFFFFFF)
-		fnt = not (hdr[3]&0x8000000000000000 == 0)
-		# unpack data in 64bit mode to correct for byte-order
-		data_64bit = array(unpack(">{0}Q".format(cls.BYTES_IN_PAYLOAD/8),bytestr[cls.BYTES_IN_HEADER:]),dtype=uint64)
-		data = zeros(cls.BYTES_IN_PAYLOAD,dtype=int8)
-		for ii in xrange(len(data_64bit)):
-			for jj in xrange(8):
-				data[ii*8+jj] = int8((data_64bit[ii]>>uint64(8*jj))&uint64(0xFF))
-		return Packet(ut,pktnum,did,ifid,ud0,ud1,res0,res1,fnt,data)
-
-class He6CRES_DAQ(object):
+class He6CRES_DAQ(DataCapture):
 	"""
 	Encapsulate a DAQ object. Based on the R2DAQ (aka ArtooDaq) class from Andre Young.
 	"""
 
+	_PACKET = Packet
+
 	_TIMEOUT = 5
 	_FPGA_CLOCK = 200e6
 	_DEMUX = 16
@@ -169,6 +85,10 @@ class He6CRES_DAQ(object):
 			registers[k] = self.roach2.read_int(k)
 		return registers
 
+	@property
+	def implemented_digital_channels(self):
+		return self._implemented_digital_channels
+
 	@property
 	def roach2(self):
 		return self._roach2
@@ -265,6 +185,7 @@ class He6CRES_DAQ(object):
 		    filename 'latest-build' uses the current build of the bit-code.
 		    Default is None.
 		"""
+		self._stats = PipelineStats()
 		# connect to roach and store local copy of FpgaClient
 		r2 = FpgaClient(hostname)
 		if not r2.wait_connected(self._TIMEOUT):
@@ -277,58 +198,6 @@ class He6CRES_DAQ(object):
 		if not dsoc_desc is None:
 			self.open_dsoc(dsoc_desc)
 
-	def grab_packets(self,n=1,dsoc_desc=None,close_soc=False):
-		"""
-		Grab packets using open data socket.
-
-		Calls to this method should only be made while a data socket is
-		open, unless a socket descriptor is provided. See open_dsoc() for
-		details.
-
-		Parameters
-		----------
-		n : int
-		    Number of packets to grab, default is 1.
-		dsoc_desc : tuple
-		    Socket descriptor tuple as for open_dsoc() method. If None,
-		    a data socket should already be open. Default is None.
-		close_soc : boolean
-		    Close socket after grabbing the given number of packets.
-		"""
-		if not dsoc_desc is None:
-			self.open_dsoc(dsoc_desc)
-		try:
-			dsoc = self._data_socket
-		except AttributeError:
-			raise RuntimeError("No open data socket. Call open_dsoc() first.")
-		pkts = []
-		for ii in xrange(n):
-			data = dsoc.recv(Packet.BYTES_IN_PACKET)
-			pkts.append(Packet.FromByteString(data))
-		if close_soc:
-			self.close_dsoc()
-		return pkts
-
-	def open_dsoc(self,dsoc_desc):
-		"""
-		Open socket for data reception and bind.
-
-		Parameters
-		----------
-		dsoc_desc: tuple
-		    Tuple of IP address / hostname and port as passed to socket.bind().
-		"""
-		self._data_socket = socket(AF_INET,SOCK_DGRAM)
-		self._data_socket.bind(dsoc_desc)
-		return self._data_socket
-
-	def close_dsoc(self):
-		"""
-		Close socket used for data reception.
-		"""
-		self._data_socket.close()
-
-
 	def set_fft_shift(self,shift_vec='1010101010101',tag='ab'):
 		"""
 		Set shift vector for FFT engine.
@@ -382,9 +251,13 @@ class He6CRES_DAQ(object):
 			from core1, then the gain-tuning is considered sufficient (default
 			value is 0.005).
 		piter : int
-			Phase calibration not yet implemented.
+			Maximum number of iterations to fine-tune phase parameter, 0
+			to leave the phases as they are. Phase calibration needs a
+			tone injected into the ADC (default is 0).
 		ptol : float
-			Phase calibration not yet implemented.
+			If the timing skew of one core relative to core1 is below this
+			value in ps then the phase-tuning is considered sufficient
+			(default is 1.0).
 		verbose : int
 			The higher the more verbose, control the amount of output to
 			the screen. Default is 10 (probably the highest).
@@ -393,20 +266,36 @@ class He6CRES_DAQ(object):
 		-------
 		ogp : dict
 		    The returned parameter is a dictionary that contains the optimal
-		    settings for offset, gain and phase as solved during calibration.
+		    settings for offset, gain and phase as solved during calibration,
+		    and under 'snapshots' the number of snapshots taken to solve for
+		    the offsets, gains and, if tuned, phases.
 		"""
 		if verbose > 3:
 			print "Attempting OGP-calibration for ZDOK{0}".format(zdok)
-		co = self.calibrate_adc_offset(zdok=zdok,oiter=oiter,otol=otol,verbose=verbose)
-		cg = self.calibrate_adc_gain(zdok=zdok,giter=giter,gtol=gtol,verbose=verbose)
-		cp = self.calibrate_adc_phase(zdok=zdok,piter=piter,ptol=ptol,verbose=verbose)
-		return {'offset': co, 'gain': cg, 'phase': cp}
+		snapshots = dict()
+		co = self.calibrate_adc_offset(zdok=zdok,oiter=oiter,otol=otol,verbose=verbose,report=snapshots)
+		cg = self.calibrate_adc_gain(zdok=zdok,giter=giter,gtol=gtol,verbose=verbose,report=snapshots)
+		cp = self.calibrate_adc_phase(zdok=zdok,piter=piter,ptol=ptol,verbose=verbose,report=snapshots)
+		if verbose > 3:
+			print "OGP-calibration for ZDOK{0} took {1} snapshots".format(zdok,", ".join(["{0} {1}".format(v,k) for k,v in sorted(snapshots.items())]))
+		return {'offset': co, 'gain': cg, 'phase': cp, 'snapshots': snapshots}
 
-	def calibrate_adc_offset(self,zdok,oiter=10,otol=0.005,verbose=10):
+	def calibrate_adc_offset(self,zdok,oiter=10,otol=0.005,verbose=10,report=None):
 		"""
 		Attempt to match the core offsets within the ADC.
 
+		The means of the cores, normalized to their standard deviations,
+		are measured with zero offsets and with a test offset, then the
+		offsets are solved for by fitting the response of every core to
+		all snapshots taken so far, see CoreSolver.
+
 		See ArtooDaq.calibrate_adc_ogp for more details.
+
+		Parameters
+		----------
+		report : dict
+			If not None, the number of snapshots taken is stored under
+			'offset'. Default is None.
 		"""
 		# offset controlled by float varying over [-50,50] mV with 0.4 mV resolution
 		res_offset = 0.4
@@ -415,73 +304,53 @@ class He6CRES_DAQ(object):
 		test_step = 10*res_offset
 		if verbose > 3:
 			print "  Offset calibration ZDOK{0}:".format(zdok)
-		for ic in xrange(1,5):
-			adc5g.set_spi_offset(self.roach2,zdok,ic,0)
-		x1 = self._snap_per_core(zdok=zdok,groups=groups)
-		sx1 = x1.std(axis=0)
-		mx1 = x1.mean(axis=0)/sx1
-		if verbose > 5:
-			print "    ...offset: with zero-offsets, means are [{0}]".format(
-				", ".join(["{0:+7.4f}".format(imx) for imx in mx1])
-			)
-		for ic in xrange(1,5):
-			adc5g.set_spi_offset(self.roach2,zdok,ic,test_step)
-		x2 = self._snap_per_core(zdok=zdok,groups=groups)
-		sx2 = x2.std(axis=0)
-		mx2 = x2.mean(axis=0)/sx2
-		if verbose > 5:
-			print "    ...offset: with {0:+4.1f} mV offset, means are [{1}]".format(
-				test_step,
-				", ".join(["{0:+7.4f}".format(imx) for imx in mx2])
-			)
-		d_mx = (mx2 - mx1)/test_step
-		core_offsets = -mx1/d_mx
-		for ic in xrange(1,5):
-			adc5g.set_spi_offset(self.roach2,zdok,ic,core_offsets[ic-1])
-			core_offsets[ic-1] = adc5g.get_spi_offset(self.roach2,zdok,ic)
-		x = self._snap_per_core(zdok=zdok,groups=groups)
-		sx = x.std(axis=0)
-		mx = x.mean(axis=0)/sx
-		if verbose > 5:
-			print "    ...offset: solution offsets are [{0}] mV, means are [{1}]".format(
-				", ".join(["{0:+6.2f}".format(ico) for ico in core_offsets]),
-				", ".join(["{0:+7.4f}".format(imx) for imx in mx])
-			)
-		if any(abs(mx) >= otol):
-			if verbose > 5:
-				print "    ...offset: solution not good enough, iterating (tol={0:4.4f},iter={1:d})".format(otol,oiter)
-			for ii in xrange(0,oiter):
-				for ic in xrange(1,5):
-					if mx[ic-1] > otol:
-						adc5g.set_spi_offset(self.roach2,zdok,ic,core_offsets[ic-1]-res_offset)
-					elif mx[ic-1] < -otol:
-						adc5g.set_spi_offset(self.roach2,zdok,ic,core_offsets[ic-1]+res_offset)
-					core_offsets[ic-1] = adc5g.get_spi_offset(self.roach2,zdok,ic)
-				x = self._snap_per_core(zdok=zdok,groups=groups)
-				sx = x.std(axis=0)
-				mx = x.mean(axis=0)/sx
-				if verbose > 7:
-					print "    ...offset: solution offsets are [{0}] mV, means are [{1}]".format(
-						", ".join(["{0:+6.2f}".format(ico) for ico in core_offsets]),
-        		        ", ".join(["{0:+7.4f}".format(imx) for imx in mx])
-					)
-				if all(abs(mx) < otol):
-					if verbose > 5:
-						print "    ...offset: solution good enough"
-					break
-				if ii==oiter-1:
-					if verbose > 5:
-						print "    ...offset: maximum number of iterations reached, aborting"
-		else:
+		current = [None]
+		def apply(offsets):
+			for ic in xrange(1,5):
+				adc5g.set_spi_offset(self.roach2,zdok,ic,offsets[ic-1])
+			current[0] = array([adc5g.get_spi_offset(self.roach2,zdok,ic) for ic in xrange(1,5)])
+			return current[0]
+		def measure():
+			mx,sx = self._core_stats(self._snap_per_core(zdok=zdok,groups=groups))
+			mx = mx/sx
 			if verbose > 5:
-				print "    ...offset: solution good enough"
+				print "    ZDOK{0} ...offset: offsets are [{1}] mV, means are [{2}]".format(
+					zdok,
+					", ".join(["{0:+6.2f}".format(ico) for ico in current[0]]),
+					", ".join(["{0:+7.4f}".format(imx) for imx in mx])
+				)
+			return mx
+		# register steps are 1/255 of the range
+		solver = CoreSolver(0.0,otol,(lim_offset[1]-lim_offset[0])/255.0,lim_offset)
+		core_offsets = solver.run(apply,measure,zeros(4),test_step,oiter+1)
+		if verbose > 5:
+			if solver.done():
+				print "    ZDOK{0} ...offset: solution good enough after {1} snapshots".format(zdok,solver.snapshots)
+			elif solver.settled:
+				print "    ZDOK{0} ...offset: solution within one register step after {1} snapshots".format(zdok,solver.snapshots)
+			else:
+				print "    ZDOK{0} ...offset: maximum number of iterations reached after {1} snapshots, aborting".format(zdok,solver.snapshots)
+		if not report is None:
+			report['offset'] = solver.snapshots
 		return core_offsets
 
-	def calibrate_adc_gain(self,zdok,giter=10,gtol=0.005,verbose=10):
+	def calibrate_adc_gain(self,zdok,giter=10,gtol=0.005,verbose=10,report=None):
 		"""
 		Attempt to match the core gains within the ADC.
 
+		The standard deviations of the cores relative to core1 are
+		measured with zero gains and with a test gain, then the gains of
+		the last three cores are solved for by fitting the response of
+		every core to all snapshots taken so far, see CoreSolver. Core1
+		is the reference and keeps zero gain.
+
 		See ArtooDaq.calibrate_adc_ogp for more details.
+
+		Parameters
+		----------
+		report : dict
+			If not None, the number of snapshots taken is stored under
+			'gain'. Default is None.
 		"""
 		# gain controlled by float varying over [-18%,18%] with 0.14% resolution
 		res_gain = 0.14
@@ -490,98 +359,119 @@ class He6CRES_DAQ(object):
 		test_step = 10*res_gain
 		if verbose > 3:
 			print "  Gain calibration ZDOK{0}:".format(zdok)
-		for ic in xrange(1,5):
-			adc5g.set_spi_gain(self.roach2,zdok,ic,0)
-		x1 = self._snap_per_core(zdok=zdok,groups=groups)
-		sx1 = x1.std(axis=0)
-		s0 = sx1[0]
-		sx1 = sx1/s0
-		if verbose > 5:
-			print "    ...gain: with zero-offsets, stds are                                    [{0}]".format(
-				", ".join(["{0:+7.4f}".format(isx) for isx in sx1])
-			)
+		current = [None]
+		def apply(gains):
+			for ic in xrange(1,5):
+				adc5g.set_spi_gain(self.roach2,zdok,ic,gains[ic-1])
+			current[0] = array([adc5g.get_spi_gain(self.roach2,zdok,ic) for ic in xrange(1,5)])
+			return current[0]
+		def measure():
+			sx = self._core_stats(self._snap_per_core(zdok=zdok,groups=groups))[1]
+			sx = sx/sx[0]
+			if verbose > 5:
+				print "    ZDOK{0} ...gain: gains are [{1}]%, stds are [{2}]".format(
+					zdok,
+					", ".join(["{0:+6.2f}".format(icg) for icg in current[0]]),
+					", ".join(["{0:+7.4f}".format(isx) for isx in sx])
+				)
+			return sx
 		# only adjust gains for last three cores, core1 is the reference
-		for ic in xrange(2,5):
-			adc5g.set_spi_gain(self.roach2,zdok,ic,test_step)
-		x2 = self._snap_per_core(zdok=zdok,groups=groups)
-		sx2 = x2.std(axis=0)
-		s0 = sx2[0]
-		sx2 = sx2/s0
-		if verbose > 5:
-			print "    ...gain: with {0:+6.2f}% gain, stds are                                    [{1}]".format(
-				test_step,
-				", ".join(["{0:+7.4f}".format(isx) for isx in sx2])
-			)
-		d_sx = 100*(sx2 - sx1)/test_step
-		# give differential for core1 a non-zero value, it won't be used anyway
-		d_sx[0] = 1.0
-		# gains are in units percentage
-		core_gains = 100*(1.0-sx1)/d_sx
-		# set core1 gain to zero
-		core_gains[0] = 0
-		for ic in xrange(2,5):
-			adc5g.set_spi_gain(self.roach2,zdok,ic,core_gains[ic-1])
-			core_gains[ic-1] = adc5g.get_spi_gain(self.roach2,zdok,ic)
-		x = self._snap_per_core(zdok=zdok,groups=groups)
-		sx = x.std(axis=0)
-		s0 = sx[0]
-		sx = sx/s0
+		solver = CoreSolver(1.0,gtol,(lim_gain[1]-lim_gain[0])/255.0,lim_gain,fixed=(0,))
+		core_gains = solver.run(apply,measure,zeros(4),test_step,giter+1)
 		if verbose > 5:
-			print "    ...gain: solution gains are [{0}]%, stds are [{1}]".format(
-				", ".join(["{0:+6.2f}".format(ico) for ico in core_gains]),
-				", ".join(["{0:+7.4f}".format(isx) for isx in sx])
-			)
-		if any(abs(1.0-sx) >= gtol):
-			if verbose > 5:
-				print "    ...gain: solution not good enough, iterating (tol={0:4.4f},iter={1:d})".format(gtol,giter)
-			for ii in xrange(0,giter):
-				for ic in xrange(2,5):
-					if (1.0-sx[ic-1]) > gtol:
-						adc5g.set_spi_gain(self.roach2,zdok,ic,core_gains[ic-1]+res_gain)
-					elif (1.0-sx[ic-1]) < -gtol:
-						adc5g.set_spi_gain(self.roach2,zdok,ic,core_gains[ic-1]-res_gain)
-					core_gains[ic-1] = adc5g.get_spi_gain(self.roach2,zdok,ic)
-				x = self._snap_per_core(zdok=zdok,groups=groups)
-				sx = x.std(axis=0)
-				s0 = sx[0]
-				sx = sx/s0
-				if verbose > 7:
-					print "    ...gain: solution gains are [{0}]%, stds are [{1}]".format(
-							", ".join(["{0:+6.2f}".format(ico) for ico in core_gains]),
-        	                ", ".join(["{0:+7.4f}".format(isx) for isx in sx])
-					)
-				if all(abs(1.0-sx) < gtol):
-					if verbose > 5:
-						print "    ...gain: solution good enough"
-					break
-				if ii==giter-1:
-					if verbose > 5:
-						print "    ...gain: maximum number of iterations reached, aborting"
-		else:
-			if verbose > 5:
-				print "    ...gain: solution good enough"
+			if solver.done():
+				print "    ZDOK{0} ...gain: solution good enough after {1} snapshots".format(zdok,solver.snapshots)
+			elif solver.settled:
+				print "    ZDOK{0} ...gain: solution within one register step after {1} snapshots".format(zdok,solver.snapshots)
+			else:
+				print "    ZDOK{0} ...gain: maximum number of iterations reached after {1} snapshots, aborting".format(zdok,solver.snapshots)
+		if not report is None:
+			report['gain'] = solver.snapshots
 		return core_gains
 
-	def calibrate_adc_phase(self,zdok,piter=0,ptol=1.0,verbose=10):
+	def calibrate_adc_phase(self,zdok,piter=0,ptol=1.0,freq=None,verbose=10,report=None):
 		"""
 		Attempt to match the core phases within the ADC.
 
+		Requires a tone injected into the ADC input. The timing skew of
+		every core relative to core1 is measured by fitting a sine to the
+		samples of every core at their place in the interleaved sequence,
+		see fit_core_phases(), with zero phases and with a test phase, then
+		the phases of the last three cores are solved for by fitting the
+		response of every core to all snapshots taken so far, see
+		CoreSolver. Core1 is the reference and keeps zero phase.
+
+		Skews are converted from phase to time with the tone frequency as
+		sampled, which is the true frequency only if the tone lies in the
+		first Nyquist zone. The solver fits the response rather than
+		relying on that scale, so this only affects ptol.
+
 		See ArtooDaq.calibrate_adc_ogp for more details.
+
+		Parameters
+		----------
+		freq : float
+			Frequency of the injected tone in Hz as sampled by the ADC. If
+			None it is estimated from the first snapshot. Default is None.
+		report : dict
+			If not None and the phases are tuned, the number of snapshots
+			taken is stored under 'phase'. Default is None.
 		"""
 		# phase controlled by float varying over [-14,14] ps with 0.11 ps resolution
 		res_phase = 0.11
 		lim_phase = [-14.0,14.0]
+		groups = 8
+		test_step = 10*res_phase
 		if verbose > 3:
 			print "  Phase calibration ZDOK{0}:".format(zdok)
-		core_phases = zeros(4)
-		for ic in xrange(1,5):
-			core_phases[ic-1] = adc5g.get_spi_phase(self.roach2,zdok,ic)
+		if piter < 1:
+			core_phases = zeros(4)
+			for ic in xrange(1,5):
+				core_phases[ic-1] = adc5g.get_spi_phase(self.roach2,zdok,ic)
+			if verbose > 5:
+				print "    ZDOK{0} ...phase: tuning not requested, phase parameters are [{1}]".format(
+					zdok,
+					", ".join(["{0:+06.2f}".format(icp) for icp in core_phases])
+				)
+			return core_phases
+		fs = self._ADC_SAMPLE_RATE
+		tone = [None if freq is None else 2*pi*freq/fs]
+		current = [None]
+		def apply(phases):
+			for ic in xrange(1,5):
+				adc5g.set_spi_phase(self.roach2,zdok,ic,phases[ic-1])
+			current[0] = array([adc5g.get_spi_phase(self.roach2,zdok,ic) for ic in xrange(1,5)])
+			return current[0]
+		def measure():
+			x = self._snap_per_core(zdok=zdok,groups=groups)
+			dphi,amp,omega = fit_core_phases(x,self._SNAP_CORE_ORDER,groups=groups,omega=tone[0])
+			# the tone found in the first snapshot is used for all others
+			tone[0] = omega
+			skew = 1e12*dphi/(omega*fs)
+			if verbose > 5:
+				print "    ZDOK{0} ...phase: phases are [{1}] ps, skews are [{2}] ps at {3:.2f} MHz".format(
+					zdok,
+					", ".join(["{0:+6.2f}".format(icp) for icp in current[0]]),
+					", ".join(["{0:+7.3f}".format(isk) for isk in skew]),
+					1e-6*omega*fs/(2*pi)
+				)
+			return skew
+		solver = CoreSolver(0.0,ptol,(lim_phase[1]-lim_phase[0])/255.0,lim_phase,fixed=(0,))
+		core_phases = solver.run(apply,measure,zeros(4),test_step,piter)
 		if verbose > 5:
-			print "    ...phase: tuning not implemented yet, phase parameters are [{0}]".format(
-				", ".join(["{0:+06.2f}".format(icp) for icp in core_phases])
-			)
+			if solver.done():
+				print "    ZDOK{0} ...phase: solution good enough after {1} snapshots".format(zdok,solver.snapshots)
+			elif solver.settled:
+				print "    ZDOK{0} ...phase: solution within one register step after {1} snapshots".format(zdok,solver.snapshots)
+			else:
+				print "    ZDOK{0} ...phase: maximum number of iterations reached after {1} snapshots, aborting".format(zdok,solver.snapshots)
+		if not report is None:
+			report['phase'] = solver.snapshots
 		return core_phases
 
+	# column order that matches the core indexing of the spi-family of functions
+	_SNAP_CORE_ORDER = (0,2,1,3)
+
 	def _snap_per_core(self,zdok,groups=1):
 		"""
 		Get a snapshot of 8-bit data per core from the ADC.
@@ -597,19 +487,51 @@ class He6CRES_DAQ(object):
 		Returns
 		-------
 		x : ndarray
-			A (groups*(2**16), 4)-shaped array in which data along the
-			first dimension contains consecutive samples taken form the
-			same core. The data is ordered such that the index along
+			A (groups*(2**16), 4)-shaped int8 array in which data along
+			the first dimension contains consecutive samples taken form
+			the same core. The data is ordered such that the index along
 			the second dimension matches core-indexing in the spi-
 			family of functions used to tune the core parameters.
 		"""
-		x = zeros((0,4))
+		x = empty((0,4),dtype=int8)
 		for ig in xrange(groups):
 			grab = self.roach2.snapshot_get('snap_{0}_snapshot'.format(zdok))
-        	        x_ = array(unpack('%ib' %grab['length'], grab['data']))
-                	x_ = x_.reshape((x_.size/4,4))
-			x = concatenate((x,x_))
-		return x[:,[0,2,1,3]]
+			n = grab['length']/4
+			if ig == 0:
+				x = empty((groups*n,4),dtype=int8)
+			elif not n*groups == x.shape[0]:
+				raise RuntimeError("Snapshot length changed from {0} to {1} samples".format(x.shape[0]/groups*4,grab['length']))
+			# interleaved samples of the four cores, reordered column by column without temporaries
+			g = frombuffer(grab['data'],dtype=int8,count=4*n).reshape((n,4))
+			for ic,src in enumerate(self._SNAP_CORE_ORDER):
+				x[ig*n:(ig+1)*n,ic] = g[:,src]
+		return x
+
+	@staticmethod
+	def _core_stats(x):
+		"""
+		Compute the mean and standard deviation per core of a snapshot.
+
+		Parameters
+		----------
+		x : ndarray
+			Snapshot as returned by _snap_per_core().
+
+		Returns
+		-------
+		mean, std : ndarray
+			Per-core mean and standard deviation, each of shape (4,),
+			computed exactly from one histogram pass over the samples.
+		"""
+		# one 256-bin histogram per core, offset so that all cores go in one bincount
+		idx = x.view(uint8) + arange(0,1024,256,dtype=uint16)
+		h = bincount(idx.ravel(),minlength=1024).reshape((4,256)).astype(float64)
+		v = arange(256,dtype=float64)
+		v[128:] -= 256
+		n = h.sum(axis=1)
+		mean = h.dot(v)/n
+		var = h.dot(v*v)/n - mean*mean
+		return mean,sqrt(var)
 
 	def _make_assignment(self,assign_dict):
 		"""
@@ -1,160 +1,62 @@
 #!/usr/bin/env python
 
 import adc5g
+from adccal import CoreSolver, fit_core_phases
+from calcache import CalibrationCache
+from codec import BasePacket, PacketCodec
 from copy import deepcopy
 from corr.katcp_wrapper import FpgaClient
+from daq_capture import DataCapture
 from datetime import datetime
 import netifaces as ni
 from numpy import (
 	abs,
+	arange,
 	array,
+	bincount,
 	ceil,
 	complex64,
-	concatenate,
+	empty,
 	float32,
+	float64,
 	floor,
+	frombuffer,
 	int8,
 	pi,
-	uint64,
-	uint32,
+	sqrt,
 	uint16,
+	uint32,
+	uint64,
 	uint8,
 	zeros,
 	)
 from scipy.signal import firwin2
-from socket import socket, AF_INET, SOCK_DGRAM
-from struct import unpack
+from stats import PipelineStats
 from time import sleep, time
+from waterfall import Waterfall
+import sys
+import threading
 import matplotlib
 #matplotlib.use('Agg')
 import matplotlib.pyplot as mplpp
 from matplotlib.pyplot import figure
 
-class Packet():
+class Packet(BasePacket):
 	"""
-	Encapsulate an He6CRES packet. Header length and structure are retained from R2DAQ (aka ArtooDaq)
+	Encapsulate an He6CRES packet with 16-bit samples. Header length and structure are retained from R2DAQ (aka ArtooDaq)
 	"""
 
-	BYTES_IN_PAYLOAD = 8192
-	BYTES_IN_HEADER = 32
-	BYTES_IN_PACKET = BYTES_IN_PAYLOAD + BYTES_IN_HEADER
-
-	@property
-	def unix_time(self):
-		return self._unix_time
-
-	@property
-	def pkt_in_batch(self):
-		return self._pkt_in_batch
-
-	@property
-	def digital_id(self):
-		return self._digital_id
-
-	@property
-	def if_id(self):
-		return self._if_id
-
-	@property
-	def user_data_1(self):
-		return self._user_data_1
-
-	@property
-	def user_data_0(self):
-		return self._user_data_0
-
-	@property
-	def reserved_0(self):
-		return self._reserved_0
-
-	@property
-	def reserverd_1(self):
-		return self._reserved_1
-
-	@property
-	def freq_not_time(self):
-		return self._freq_not_time
-
-	@property
-	def data(self):
-		return self._data
-
-	def __init__(self,ut=0,pktnum=0,did=0,ifid=0,ud0=0,ud1=0,res0=0,res1=0,fnt=False,data=None):
-		"""
-		Initialize Packet with the given attributes
-		"""
-		# assign attributes
-		self._unix_time = ut
-		self._pkt_in_batch = pktnum
-		self._digital_id = did
-		self._if_id = ifid
-		self._user_data_0 = ud0
-		self._user_data_1 = ud1
-		self._reserved_0 = res0
-		self._reserved_1 = res1
-		self._freq_not_time = fnt
-		self._data = data
-
-	def interpret_data(self):
-		"""
-		Returns
-		-------
-		x : ndarray
-		    real-valued array represented by the data.
-		"""
-		x = array(self.data, dtype = uint16)
-		return x
+	CODEC = PacketCodec('uint16')
+	PAYLOAD_DTYPE = CODEC.wire_dtype
+	SAMPLES_PER_WORD = CODEC.samples_per_word
 
-	@classmethod
-	def FromByteString(cls,bytestr):
-		"""
-		Parse packet header and data from the given byte string, return an object of type Packet
-		"""
-		# check correct size packet
-		len_bytes = len(bytestr)
-		#print "Packet length = {0} bytes".format(len_bytes)
-		#if not len_bytes == cls.BYTES_IN_PACKET:
-		#	raise ValueError("Packet length is {0} bytes, should have {1} bytes".format(len_bytes,cls.BYTES_IN_PACKET))
-		# unpack header
-		hdr = unpack(">{0}Q".format(cls.BYTES_IN_HEADER/8),bytestr[:cls.BYTES_IN_HEADER])
-		ut = uint32(hdr[0] & 0xFFFFFFFF)
-		#print"Packet time = {0}".format(ut)
-		pktnum = uint32((hdr[0]>>uint32(32)) & 0xFFFFF)
-		#print "Packet number = {0}".format(pktnum)
-		did = uint8(hdr[0]>>uint32(52) & 0x3F)
-		ifid = uint8(hdr[0]>>uint32(58) & 0x3F)
-		ud1 = uint32(hdr[1] & 0xFFFFFFFF)
-		ud0 = uint32((hdr[1]>>uint32(32)) & 0xFFFFFFFF)
-		res0 = uint64(hdr[2])
-		res1 = uint64(hdr[3]&0x7FFFFFFFFFFFFFFF)
-		fnt = not (hdr[3]&0x8000000000000000 == 0)
-		#print"Frequency bit = {0}".format(fnt)
-
-		# pre-allocate data array long enough to hold 8192-byte payload as 16-bit integer numbers
-                data = zeros(cls.BYTES_IN_PAYLOAD/2,dtype=uint16)
-
-                # use a holder array of 64-bit data because struct.unpack requires the payload to be unpacked in 64-bit words
-                data_64bit = array(unpack(">{0}Q".format(cls.BYTES_IN_PAYLOAD/8),bytestr[cls.BYTES_IN_HEADER:]),dtype=uint64)
-
-		#fill data array word by word from data_64bit
-                for ii in xrange(len(data_64bit)):
-                       for jj in xrange(4):
-                               data[ii*4+jj] = uint16((data_64bit[ii]>>uint64(16*jj))&uint64(0xFFFF))
-
-		# unpack data in 64bit mode to correct for byte-order
-		#data = zeros(cls.BYTES_IN_PAYLOAD,dtype=int8)
-		#data_64bit = array(unpack(">{0}Q".format(cls.BYTES_IN_PAYLOAD/8),bytestr[cls.BYTES_IN_HEADER:]),dtype=uint64)
-		#for ii in xrange(len(data_64bit)):
-		#	for jj in xrange(8):
-		#		data[ii*8+jj] = int8((data_64bit[ii]>>uint64(8*jj))&uint64(0xFF))
-
-		return Packet(ut,pktnum,did,ifid,ud0,ud1,res0,res1,fnt,data)
-
-class He6CRES_DAQ(object):
+class He6CRES_DAQ(DataCapture):
 	"""
 	Encapsulate a He6CRES_DAQ object. Based on the R2DAQ (aka ArtooDaq) class from Andre Young.
 	"""
 
+	_PACKET = Packet
+
 	_TIMEOUT = 5
 	_FPGA_CLOCK = 200e6
 	_DEMUX = 16
@@ -163,6 +65,8 @@ class He6CRES_DAQ(object):
 	_DIGITAL_CHANNELS = ['a','b','c','d','e','f']
 	_FFT_ENGINES = ['ab','cd','ef']
 	_PHASE_LOOKUP_DEPTH = 10
+	# snapshot of the test ramp per ZDOK for the ADC interface calibration
+	_MMCM_SNAPSHOTS = {0: 'snap_0_snapshot', 1: 'snap_1_snapshot'}
 
 	@property
 	def FPGA_CLOCK(self):
@@ -203,6 +107,14 @@ class He6CRES_DAQ(object):
 	def roach2(self):
 		return self._roach2
 
+	@property
+	def hostname(self):
+		return self._hostname
+
+	@property
+	def cal_cache(self):
+		return self._cal_cache
+
 	@property
 	def version(self):
 		reg = self.registers
@@ -275,7 +187,7 @@ class He6CRES_DAQ(object):
 		str_out = '\n'.join([str_out,'  Version: {0:10d}'.format(vu)])
 		print str_out
 
-	def __init__(self,hostname,dsoc_desc=None,boffile=None):
+	def __init__(self,hostname,dsoc_desc=None,boffile=None,cal_cache=CalibrationCache.DEFAULT_PATH):
 		"""
 		Initialize a He6CRES_DAQ object.
 
@@ -294,7 +206,18 @@ class He6CRES_DAQ(object):
 		    Program the device with this bitcode if not None. The special
 		    filename 'latest-build' uses the current build of the bit-code.
 		    Default is None.
+		cal_cache : string
+		    Path of the store of ADC core calibrations used by _start()
+		    to warm-start calibration, or a CalibrationCache. If None do
+		    not store calibrations. Default is
+		    CalibrationCache.DEFAULT_PATH.
 		"""
+		self._stats = PipelineStats()
+		self._hostname = hostname
+		if cal_cache is None or isinstance(cal_cache,CalibrationCache):
+			self._cal_cache = cal_cache
+		else:
+			self._cal_cache = CalibrationCache(cal_cache)
 		# connect to roach and store local copy of FpgaClient
 		r2 = FpgaClient(hostname)
 		if not r2.wait_connected(self._TIMEOUT):
@@ -307,61 +230,6 @@ class He6CRES_DAQ(object):
 		if not dsoc_desc is None:
 			self.open_dsoc(dsoc_desc)
 
-	def grab_packets(self,n=1,dsoc_desc=None,close_soc=False):
-		"""
-		Grab packets using open data socket.
-
-		Calls to this method should only be made while a data socket is
-		open, unless a socket descriptor is provided. See open_dsoc() for
-		details.
-
-		Parameters
-		----------
-		n : int
-		    Number of packets to grab, default is 1.
-		dsoc_desc : tuple
-		    Socket descriptor tuple as for open_dsoc() method. If None,
-		    a data socket should already be open. Default is None.
-		close_soc : boolean
-		    Close socket after grabbing the given number of packets.
-		"""
-		if not dsoc_desc is None:
-			self.open_dsoc(dsoc_desc)
-		try:
-			dsoc = self._data_socket
-		except AttributeError:
-			raise RuntimeError("No open data socket. Call open_dsoc() first.")
-		pkts = []
-		print "Obtaining {0} packets".format(n)
-                for jj in range(10):
-                        data = dsoc.recv(Packet.BYTES_IN_PACKET)
-		for ii in xrange(n):
-			data = dsoc.recv(Packet.BYTES_IN_PACKET)
-			pkts.append(Packet.FromByteString(data))
-		if close_soc:
-			self.close_dsoc()
-		return pkts
-
-	def open_dsoc(self,dsoc_desc):
-		"""
-		Open socket for data reception and bind.
-
-		Parameters
-		----------
-		dsoc_desc: tuple
-		    Tuple of IP address / hostname and port as passed to socket.bind().
-		"""
-		self._data_socket = socket(AF_INET,SOCK_DGRAM)
-		self._data_socket.bind(dsoc_desc)
-		return self._data_socket
-
-	def close_dsoc(self):
-		"""
-		Close socket used for data reception.
-		"""
-		self._data_socket.close()
-
-
 	def set_fft_shift(self,shift_vec='1111111111111',tag='ab'):
 		"""
 		Set shift vector for FFT engine.
@@ -415,9 +283,13 @@ class He6CRES_DAQ(object):
 			from core1, then the gain-tuning is considered sufficient (default
 			value is 0.005).
 		piter : int
-			Phase calibration not yet implemented.
+			Maximum number of iterations to fine-tune phase parameter, 0
+			to leave the phases as they are. Phase calibration needs a
+			tone injected into the ADC (default is 0).
 		ptol : float
-			Phase calibration not yet implemented.
+			If the timing skew of one core relative to core1 is below this
+			value in ps then the phase-tuning is considered sufficient
+			(default is 1.0).
 		verbose : int
 			The higher the more verbose, control the amount of output to
 			the screen. Default is 10 (probably the highest).
@@ -426,20 +298,282 @@ class He6CRES_DAQ(object):
 		-------
 		ogp : dict
 		    The returned parameter is a dictionary that contains the optimal
-		    settings for offset, gain and phase as solved during calibration.
+		    settings for offset, gain and phase as solved during calibration,
+		    and under 'snapshots' the number of snapshots taken to solve for
+		    the offsets, gains and, if tuned, phases.
 		"""
 		if verbose > 3:
 			print "Attempting OGP-calibration for ZDOK{0}".format(zdok)
-		co = self.calibrate_adc_offset(zdok=zdok,oiter=oiter,otol=otol,verbose=verbose)
-		cg = self.calibrate_adc_gain(zdok=zdok,giter=giter,gtol=gtol,verbose=verbose)
-		cp = self.calibrate_adc_phase(zdok=zdok,piter=piter,ptol=ptol,verbose=verbose)
-		return {'offset': co, 'gain': cg, 'phase': cp}
+		snapshots = dict()
+		co = self.calibrate_adc_offset(zdok=zdok,oiter=oiter,otol=otol,verbose=verbose,report=snapshots)
+		cg = self.calibrate_adc_gain(zdok=zdok,giter=giter,gtol=gtol,verbose=verbose,report=snapshots)
+		cp = self.calibrate_adc_phase(zdok=zdok,piter=piter,ptol=ptol,verbose=verbose,report=snapshots)
+		if verbose > 3:
+			print "OGP-calibration for ZDOK{0} took {1} snapshots".format(zdok,", ".join(["{0} {1}".format(v,k) for k,v in sorted(snapshots.items())]))
+		return {'offset': co, 'gain': cg, 'phase': cp, 'snapshots': snapshots}
+
+	def calibrate_adc_interface(self,zdoks=(0,1),concurrent=True,verbose=10):
+		"""
+		Calibrate the MMCM clock-to-data phase of the ADC interfaces.
 
-	def calibrate_adc_offset(self,zdok,oiter=10,otol=0.005,verbose=10):
+		All ADCs are put in test mode and synchronized together, then the
+		phase of every interface is stepped through its range looking for
+		glitches in the test ramp, see adc5g.calibrate_mmcm_phase().
+
+		Parameters
+		----------
+		zdoks : tuple
+			ZDOK slots to calibrate. Default is (0, 1).
+		concurrent : bool
+			If True calibrate all ZDOKs at the same time, see
+			_for_each_zdok(). Default is True.
+		verbose : int
+			The higher the more verbose, control the amount of output to
+			the screen. Default is 10 (probably the highest).
+
+		Returns
+		-------
+		result : dict
+		    Maps ZDOK to the tuple (optimal phase step, glitches per
+		    phase step).
+		"""
+		if verbose > 3:
+			print "Performing ADC interface calibration on ZDOK{0}".format(", ZDOK".join([str(z) for z in zdoks]))
+		for zdok in zdoks:
+			adc5g.set_test_mode(self.roach2,zdok)
+		adc5g.sync_adc(self.roach2)
+		try:
+			result = self._for_each_zdok(
+				lambda zdok: adc5g.calibrate_mmcm_phase(self.roach2,zdok,[self._MMCM_SNAPSHOTS[zdok],]),
+				zdoks,
+				concurrent=concurrent,
+				)
+		finally:
+			for zdok in zdoks:
+				adc5g.unset_test_mode(self.roach2,zdok)
+		if verbose > 3:
+			print "...ADC interface calibration done."
+		if verbose > 5:
+			for zdok in zdoks:
+				print "if{0}: opt{0} = ".format(zdok),result[zdok][0],", glitches{0} = \n".format(zdok),array(result[zdok][1])
+		return result
+
+	def calibrate_adcs_ogp(self,zdoks=(0,1),concurrent=True,verbose=10,**kwargs):
+		"""
+		Match the cores within several ADCs, see calibrate_adc_ogp().
+
+		Parameters
+		----------
+		zdoks : tuple
+			ZDOK slots to calibrate. Default is (0, 1).
+		concurrent : bool
+			If True calibrate all ZDOKs at the same time, see
+			_for_each_zdok(). Default is True.
+		verbose : int
+			See calibrate_adc_ogp().
+		kwargs : dict
+			Further arguments to calibrate_adc_ogp().
+
+		Returns
+		-------
+		ogp : dict
+		    Maps ZDOK to the result of calibrate_adc_ogp() for that slot.
+		"""
+		return self._for_each_zdok(
+			lambda zdok: self.calibrate_adc_ogp(zdok=zdok,verbose=verbose,**kwargs),
+			zdoks,
+			concurrent=concurrent,
+			)
+
+	def calibrate_adcs_cached(self,zdoks=(0,1),clock=None,otol=0.005,gtol=0.005,force=False,concurrent=True,verbose=10,**kwargs):
+		"""
+		Match the cores within several ADCs, starting from stored settings.
+
+		For every ZDOK the settings stored in cal_cache for this board,
+		bitcode and board clock are loaded into the ADC and checked with
+		a single snapshot against otol and gtol, see check_adc_ogp(). Only
+		ADCs without stored settings or that fail the check are
+		calibrated, see calibrate_adc_ogp(), and their new settings are
+		stored.
+
+		Parameters
+		----------
+		zdoks : tuple
+			ZDOK slots to calibrate. Default is (0, 1).
+		clock : float
+			Board clock in MHz. If None it is measured. Default is None.
+		otol : float
+			See calibrate_adc_ogp(). Default is 0.005.
+		gtol : float
+			See calibrate_adc_ogp(). Default is 0.005.
+		force : bool
+			If True ignore stored settings and calibrate, still storing
+			the results. Default is False.
+		concurrent : bool
+			If True calibrate all ZDOKs at the same time, see
+			_for_each_zdok(). Default is True.
+		verbose : int
+			See calibrate_adc_ogp().
+		kwargs : dict
+			Further arguments to calibrate_adc_ogp().
+
+		Returns
+		-------
+		ogp : dict
+		    Maps ZDOK to the settings in use, as returned by
+		    calibrate_adc_ogp(), with 'cached' True if the stored
+		    settings passed the check.
+		"""
+		cache = self._cal_cache
+		if cache is None:
+			return self.calibrate_adcs_ogp(zdoks=zdoks,concurrent=concurrent,verbose=verbose,otol=otol,gtol=gtol,**kwargs)
+		if clock is None:
+			clock = self.roach2.est_brd_clk()
+		version = self._rcs_version()
+		def calibrate(zdok):
+			ogp = None if force else cache.get(self._hostname,zdok,version,clock)
+			if not ogp is None:
+				if verbose > 3:
+					print "Loading stored calibration for ZDOK{0}, {1:.0f} s old".format(zdok,ogp['age'])
+				self.load_adc_ogp(zdok,ogp)
+				if self.check_adc_ogp(zdok,otol=otol,gtol=gtol,verbose=verbose):
+					ogp = dict((k,ogp[k]) for k in CalibrationCache.FIELDS)
+					ogp['cached'] = True
+					return ogp
+			ogp = self.calibrate_adc_ogp(zdok=zdok,otol=otol,gtol=gtol,verbose=verbose,**kwargs)
+			cache.put(self._hostname,zdok,version,clock,ogp)
+			ogp['cached'] = False
+			return ogp
+		result = self._for_each_zdok(calibrate,zdoks,concurrent=concurrent)
+		# written once all threads are done
+		if not all([ogp['cached'] for ogp in result.values()]):
+			cache.save()
+		return result
+
+	def load_adc_ogp(self,zdok,ogp):
+		"""
+		Apply offset, gain and phase settings to the cores of an ADC.
+
+		Parameters
+		----------
+		zdok : int
+			ZDOK slot that contains the ADC.
+		ogp : dict
+			'offset', 'gain' and 'phase' with one value per core, as
+			returned by calibrate_adc_ogp().
+		"""
+		for ic in xrange(1,5):
+			adc5g.set_spi_offset(self.roach2,zdok,ic,ogp['offset'][ic-1])
+			adc5g.set_spi_gain(self.roach2,zdok,ic,ogp['gain'][ic-1])
+			adc5g.set_spi_phase(self.roach2,zdok,ic,ogp['phase'][ic-1])
+
+	def check_adc_ogp(self,zdok,otol=0.005,gtol=0.005,groups=8,verbose=10):
+		"""
+		Check whether the cores of an ADC are matched, from one snapshot.
+
+		Parameters
+		----------
+		zdok : int
+			ZDOK slot that contains the ADC.
+		otol : float
+			Tolerance on the core means, see calibrate_adc_ogp(). Default
+			is 0.005.
+		gtol : float
+			Tolerance on the core standard deviations, see
+			calibrate_adc_ogp(). Default is 0.005.
+		groups : int
+			Snapshot size, see _snap_per_core(). Default is 8.
+		verbose : int
+			The higher the more verbose. Default is 10.
+
+		Returns
+		-------
+		ok : bool
+		    True if both offsets and gains are within tolerance.
+		"""
+		mx,sx = self._core_stats(self._snap_per_core(zdok=zdok,groups=groups))
+		mx = mx/sx
+		sx = sx/sx[0]
+		ok = all(abs(mx) < otol) and all(abs(1.0-sx) < gtol)
+		if verbose > 5:
+			print "    ZDOK{0} ...check: means are [{1}], stds are [{2}], {3}".format(
+				zdok,
+				", ".join(["{0:+7.4f}".format(imx) for imx in mx]),
+				", ".join(["{0:+7.4f}".format(isx) for isx in sx]),
+				"good enough" if ok else "recalibrating",
+			)
+		return ok
+
+	def _rcs_version(self):
+		# only the version registers, the version property reads every register
+		return tuple([self.roach2.read_int(k) for k in ('rcs_lib','rcs_app','rcs_user')])
+
+	def _for_each_zdok(self,func,zdoks,concurrent=True):
+		"""
+		Call func(zdok) for every ZDOK slot.
+
+		Calibration of one ADC is made up of katcp round trips and waits
+		for snapshots, so the ADCs are calibrated at the same time on one
+		thread per ZDOK, overlapping their requests on the shared katcp
+		connection. Each ADC has its own SPI port and MMCM, so every
+		thread only touches the registers of its own slot.
+
+		Parameters
+		----------
+		func : callable
+			Called with the ZDOK slot as its only argument.
+		zdoks : tuple
+			ZDOK slots.
+		concurrent : bool
+			If False call func for one ZDOK after the other. Default is
+			True.
+
+		Returns
+		-------
+		results : dict
+		    Maps ZDOK to the return value of func for that slot.
+		"""
+		results = dict()
+		if not concurrent or len(zdoks) < 2:
+			for zdok in zdoks:
+				results[zdok] = func(zdok)
+			return results
+		errors = dict()
+		def run(zdok):
+			try:
+				results[zdok] = func(zdok)
+			except Exception:
+				errors[zdok] = sys.exc_info()
+		threads = []
+		for zdok in zdoks:
+			t = threading.Thread(target=run,args=(zdok,),name="cal-zdok{0}".format(zdok))
+			t.daemon = True
+			threads.append(t)
+			t.start()
+		for t in threads:
+			t.join()
+		for zdok in zdoks:
+			if zdok in errors:
+				err = errors[zdok]
+				raise RuntimeError("Calibration of ZDOK{0} failed: {1}".format(zdok,err[1])), None, err[2]
+		return results
+
+	def calibrate_adc_offset(self,zdok,oiter=10,otol=0.005,verbose=10,report=None):
 		"""
 		Attempt to match the core offsets within the ADC.
 
+		The means of the cores, normalized to their standard deviations,
+		are measured with zero offsets and with a test offset, then the
+		offsets are solved for by fitting the response of every core to
+		all snapshots taken so far, see CoreSolver.
+
 		See ArtooDaq.calibrate_adc_ogp for more details.
+
+		Parameters
+		----------
+		report : dict
+			If not None, the number of snapshots taken is stored under
+			'offset'. Default is None.
 		"""
 		# offset controlled by float varying over [-50,50] mV with 0.4 mV resolution
 		res_offset = 0.4
@@ -448,73 +582,53 @@ class He6CRES_DAQ(object):
 		test_step = 10*res_offset
 		if verbose > 3:
 			print "  Offset calibration ZDOK{0}:".format(zdok)
-		for ic in xrange(1,5):
-			adc5g.set_spi_offset(self.roach2,zdok,ic,0)
-		x1 = self._snap_per_core(zdok,groups)
-		sx1 = x1.std(axis=0)
-		mx1 = x1.mean(axis=0)/sx1
-		if verbose > 5:
-			print "    ...offset: with zero-offsets, means are [{0}]".format(
-				", ".join(["{0:+7.4f}".format(imx) for imx in mx1])
-			)
-		for ic in xrange(1,5):
-			adc5g.set_spi_offset(self.roach2,zdok,ic,test_step)
-		x2 = self._snap_per_core(zdok,groups)
-		sx2 = x2.std(axis=0)
-		mx2 = x2.mean(axis=0)/sx2
-		if verbose > 5:
-			print "    ...offset: with {0:+4.1f} mV offset, means are [{1}]".format(
-				test_step,
-				", ".join(["{0:+7.4f}".format(imx) for imx in mx2])
-			)
-		d_mx = (mx2 - mx1)/test_step
-		core_offsets = -mx1/d_mx
-		for ic in xrange(1,5):
-			adc5g.set_spi_offset(self.roach2,zdok,ic,core_offsets[ic-1])
-			core_offsets[ic-1] = adc5g.get_spi_offset(self.roach2,zdok,ic)
-		x = self._snap_per_core(zdok,groups)
-		sx = x.std(axis=0)
-		mx = x.mean(axis=0)/sx
-		if verbose > 5:
-			print "    ...offset: solution offsets are [{0}] mV, means are [{1}]".format(
-				", ".join(["{0:+6.2f}".format(ico) for ico in core_offsets]),
-				", ".join(["{0:+7.4f}".format(imx) for imx in mx])
-			)
-		if any(abs(mx) >= otol):
-			if verbose > 5:
-				print "    ...offset: solution not good enough, iterating (tol={0:4.4f},iter={1:d})".format(otol,oiter)
-			for ii in xrange(0,oiter):
-				for ic in xrange(1,5):
-					if mx[ic-1] > otol:
-						adc5g.set_spi_offset(self.roach2,zdok,ic,core_offsets[ic-1]-res_offset)
-					elif mx[ic-1] < -otol:
-						adc5g.set_spi_offset(self.roach2,zdok,ic,core_offsets[ic-1]+res_offset)
-					core_offsets[ic-1] = adc5g.get_spi_offset(self.roach2,zdok,ic)
-				x = self._snap_per_core(zdok=zdok,groups=groups)
-				sx = x.std(axis=0)
-				mx = x.mean(axis=0)/sx
-				if verbose > 7:
-					print "    ...offset: solution offsets are [{0}] mV, means are [{1}]".format(
-						", ".join(["{0:+6.2f}".format(ico) for ico in core_offsets]),
-        		        ", ".join(["{0:+7.4f}".format(imx) for imx in mx])
-					)
-				if all(abs(mx) < otol):
-					if verbose > 5:
-						print "    ...offset: solution good enough"
-					break
-				if ii==oiter-1:
-					if verbose > 5:
-						print "    ...offset: maximum number of iterations reached, aborting"
-		else:
+		current = [None]
+		def apply(offsets):
+			for ic in xrange(1,5):
+				adc5g.set_spi_offset(self.roach2,zdok,ic,offsets[ic-1])
+			current[0] = array([adc5g.get_spi_offset(self.roach2,zdok,ic) for ic in xrange(1,5)])
+			return current[0]
+		def measure():
+			mx,sx = self._core_stats(self._snap_per_core(zdok=zdok,groups=groups))
+			mx = mx/sx
 			if verbose > 5:
-				print "    ...offset: solution good enough"
+				print "    ZDOK{0} ...offset: offsets are [{1}] mV, means are [{2}]".format(
+					zdok,
+					", ".join(["{0:+6.2f}".format(ico) for ico in current[0]]),
+					", ".join(["{0:+7.4f}".format(imx) for imx in mx])
+				)
+			return mx
+		# register steps are 1/255 of the range
+		solver = CoreSolver(0.0,otol,(lim_offset[1]-lim_offset[0])/255.0,lim_offset)
+		core_offsets = solver.run(apply,measure,zeros(4),test_step,oiter+1)
+		if verbose > 5:
+			if solver.done():
+				print "    ZDOK{0} ...offset: solution good enough after {1} snapshots".format(zdok,solver.snapshots)
+			elif solver.settled:
+				print "    ZDOK{0} ...offset: solution within one register step after {1} snapshots".format(zdok,solver.snapshots)
+			else:
+				print "    ZDOK{0} ...offset: maximum number of iterations reached after {1} snapshots, aborting".format(zdok,solver.snapshots)
+		if not report is None:
+			report['offset'] = solver.snapshots
 		return core_offsets
 
-	def calibrate_adc_gain(self,zdok,giter=10,gtol=0.005,verbose=10):
+	def calibrate_adc_gain(self,zdok,giter=10,gtol=0.005,verbose=10,report=None):
 		"""
 		Attempt to match the core gains within the ADC.
 
+		The standard deviations of the cores relative to core1 are
+		measured with zero gains and with a test gain, then the gains of
+		the last three cores are solved for by fitting the response of
+		every core to all snapshots taken so far, see CoreSolver. Core1
+		is the reference and keeps zero gain.
+
 		See ArtooDaq.calibrate_adc_ogp for more details.
+
+		Parameters
+		----------
+		report : dict
+			If not None, the number of snapshots taken is stored under
+			'gain'. Default is None.
 		"""
 		# gain controlled by float varying over [-18%,18%] with 0.14% resolution
 		res_gain = 0.14
@@ -523,98 +637,119 @@ class He6CRES_DAQ(object):
 		test_step = 10*res_gain
 		if verbose > 3:
 			print "  Gain calibration ZDOK{0}:".format(zdok)
-		for ic in xrange(1,5):
-			adc5g.set_spi_gain(self.roach2,zdok,ic,0)
-		x1 = self._snap_per_core(zdok=zdok,groups=groups)
-		sx1 = x1.std(axis=0)
-		s0 = sx1[0]
-		sx1 = sx1/s0
-		if verbose > 5:
-			print "    ...gain: with zero-offsets, stds are                                    [{0}]".format(
-				", ".join(["{0:+7.4f}".format(isx) for isx in sx1])
-			)
+		current = [None]
+		def apply(gains):
+			for ic in xrange(1,5):
+				adc5g.set_spi_gain(self.roach2,zdok,ic,gains[ic-1])
+			current[0] = array([adc5g.get_spi_gain(self.roach2,zdok,ic) for ic in xrange(1,5)])
+			return current[0]
+		def measure():
+			sx = self._core_stats(self._snap_per_core(zdok=zdok,groups=groups))[1]
+			sx = sx/sx[0]
+			if verbose > 5:
+				print "    ZDOK{0} ...gain: gains are [{1}]%, stds are [{2}]".format(
+					zdok,
+					", ".join(["{0:+6.2f}".format(icg) for icg in current[0]]),
+					", ".join(["{0:+7.4f}".format(isx) for isx in sx])
+				)
+			return sx
 		# only adjust gains for last three cores, core1 is the reference
-		for ic in xrange(2,5):
-			adc5g.set_spi_gain(self.roach2,zdok,ic,test_step)
-		x2 = self._snap_per_core(zdok=zdok,groups=groups)
-		sx2 = x2.std(axis=0)
-		s0 = sx2[0]
-		sx2 = sx2/s0
+		solver = CoreSolver(1.0,gtol,(lim_gain[1]-lim_gain[0])/255.0,lim_gain,fixed=(0,))
+		core_gains = solver.run(apply,measure,zeros(4),test_step,giter+1)
 		if verbose > 5:
-			print "    ...gain: with {0:+6.2f}% gain, stds are                                    [{1}]".format(
-				test_step,
-				", ".join(["{0:+7.4f}".format(isx) for isx in sx2])
-			)
-		d_sx = 100*(sx2 - sx1)/test_step
-		# give differential for core1 a non-zero value, it won't be used anyway
-		d_sx[0] = 1.0
-		# gains are in units percentage
-		core_gains = 100*(1.0-sx1)/d_sx
-		# set core1 gain to zero
-		core_gains[0] = 0
-		for ic in xrange(2,5):
-			adc5g.set_spi_gain(self.roach2,zdok,ic,core_gains[ic-1])
-			core_gains[ic-1] = adc5g.get_spi_gain(self.roach2,zdok,ic)
-		x = self._snap_per_core(zdok=zdok,groups=groups)
-		sx = x.std(axis=0)
-		s0 = sx[0]
-		sx = sx/s0
-		if verbose > 5:
-			print "    ...gain: solution gains are [{0}]%, stds are [{1}]".format(
-				", ".join(["{0:+6.2f}".format(ico) for ico in core_gains]),
-				", ".join(["{0:+7.4f}".format(isx) for isx in sx])
-			)
-		if any(abs(1.0-sx) >= gtol):
-			if verbose > 5:
-				print "    ...gain: solution not good enough, iterating (tol={0:4.4f},iter={1:d})".format(gtol,giter)
-			for ii in xrange(0,giter):
-				for ic in xrange(2,5):
-					if (1.0-sx[ic-1]) > gtol:
-						adc5g.set_spi_gain(self.roach2,zdok,ic,core_gains[ic-1]+res_gain)
-					elif (1.0-sx[ic-1]) < -gtol:
-						adc5g.set_spi_gain(self.roach2,zdok,ic,core_gains[ic-1]-res_gain)
-					core_gains[ic-1] = adc5g.get_spi_gain(self.roach2,zdok,ic)
-				x = self._snap_per_core(zdok=zdok,groups=groups)
-				sx = x.std(axis=0)
-				s0 = sx[0]
-				sx = sx/s0
-				if verbose > 7:
-					print "    ...gain: solution gains are [{0}]%, stds are [{1}]".format(
-							", ".join(["{0:+6.2f}".format(ico) for ico in core_gains]),
-        	                ", ".join(["{0:+7.4f}".format(isx) for isx in sx])
-					)
-				if all(abs(1.0-sx) < gtol):
-					if verbose > 5:
-						print "    ...gain: solution good enough"
-					break
-				if ii==giter-1:
-					if verbose > 5:
-						print "    ...gain: maximum number of iterations reached, aborting"
-		else:
-			if verbose > 5:
-				print "    ...gain: solution good enough"
+			if solver.done():
+				print "    ZDOK{0} ...gain: solution good enough after {1} snapshots".format(zdok,solver.snapshots)
+			elif solver.settled:
+				print "    ZDOK{0} ...gain: solution within one register step after {1} snapshots".format(zdok,solver.snapshots)
+			else:
+				print "    ZDOK{0} ...gain: maximum number of iterations reached after {1} snapshots, aborting".format(zdok,solver.snapshots)
+		if not report is None:
+			report['gain'] = solver.snapshots
 		return core_gains
 
-	def calibrate_adc_phase(self,zdok,piter=0,ptol=1.0,verbose=10):
+	def calibrate_adc_phase(self,zdok,piter=0,ptol=1.0,freq=None,verbose=10,report=None):
 		"""
 		Attempt to match the core phases within the ADC.
 
+		Requires a tone injected into the ADC input. The timing skew of
+		every core relative to core1 is measured by fitting a sine to the
+		samples of every core at their place in the interleaved sequence,
+		see fit_core_phases(), with zero phases and with a test phase, then
+		the phases of the last three cores are solved for by fitting the
+		response of every core to all snapshots taken so far, see
+		CoreSolver. Core1 is the reference and keeps zero phase.
+
+		Skews are converted from phase to time with the tone frequency as
+		sampled, which is the true frequency only if the tone lies in the
+		first Nyquist zone. The solver fits the response rather than
+		relying on that scale, so this only affects ptol.
+
 		See ArtooDaq.calibrate_adc_ogp for more details.
+
+		Parameters
+		----------
+		freq : float
+			Frequency of the injected tone in Hz as sampled by the ADC. If
+			None it is estimated from the first snapshot. Default is None.
+		report : dict
+			If not None and the phases are tuned, the number of snapshots
+			taken is stored under 'phase'. Default is None.
 		"""
 		# phase controlled by float varying over [-14,14] ps with 0.11 ps resolution
 		res_phase = 0.11
 		lim_phase = [-14.0,14.0]
+		groups = 8
+		test_step = 10*res_phase
 		if verbose > 3:
 			print "  Phase calibration ZDOK{0}:".format(zdok)
-		core_phases = zeros(4)
-		for ic in xrange(1,5):
-			core_phases[ic-1] = adc5g.get_spi_phase(self.roach2,zdok,ic)
+		if piter < 1:
+			core_phases = zeros(4)
+			for ic in xrange(1,5):
+				core_phases[ic-1] = adc5g.get_spi_phase(self.roach2,zdok,ic)
+			if verbose > 5:
+				print "    ZDOK{0} ...phase: tuning not requested, phase parameters are [{1}]".format(
+					zdok,
+					", ".join(["{0:+06.2f}".format(icp) for icp in core_phases])
+				)
+			return core_phases
+		fs = self._ADC_SAMPLE_RATE
+		tone = [None if freq is None else 2*pi*freq/fs]
+		current = [None]
+		def apply(phases):
+			for ic in xrange(1,5):
+				adc5g.set_spi_phase(self.roach2,zdok,ic,phases[ic-1])
+			current[0] = array([adc5g.get_spi_phase(self.roach2,zdok,ic) for ic in xrange(1,5)])
+			return current[0]
+		def measure():
+			x = self._snap_per_core(zdok=zdok,groups=groups)
+			dphi,amp,omega = fit_core_phases(x,self._SNAP_CORE_ORDER,groups=groups,omega=tone[0])
+			# the tone found in the first snapshot is used for all others
+			tone[0] = omega
+			skew = 1e12*dphi/(omega*fs)
+			if verbose > 5:
+				print "    ZDOK{0} ...phase: phases are [{1}] ps, skews are [{2}] ps at {3:.2f} MHz".format(
+					zdok,
+					", ".join(["{0:+6.2f}".format(icp) for icp in current[0]]),
+					", ".join(["{0:+7.3f}".format(isk) for isk in skew]),
+					1e-6*omega*fs/(2*pi)
+				)
+			return skew
+		solver = CoreSolver(0.0,ptol,(lim_phase[1]-lim_phase[0])/255.0,lim_phase,fixed=(0,))
+		core_phases = solver.run(apply,measure,zeros(4),test_step,piter)
 		if verbose > 5:
-			print "    ...phase: tuning not implemented yet, phase parameters are [{0}]".format(
-				", ".join(["{0:+06.2f}".format(icp) for icp in core_phases])
-			)
+			if solver.done():
+				print "    ZDOK{0} ...phase: solution good enough after {1} snapshots".format(zdok,solver.snapshots)
+			elif solver.settled:
+				print "    ZDOK{0} ...phase: solution within one register step after {1} snapshots".format(zdok,solver.snapshots)
+			else:
+				print "    ZDOK{0} ...phase: maximum number of iterations reached after {1} snapshots, aborting".format(zdok,solver.snapshots)
+		if not report is None:
+			report['phase'] = solver.snapshots
 		return core_phases
 
+	# column order that matches the core indexing of the spi-family of functions
+	_SNAP_CORE_ORDER = (0,2,1,3)
+
 	def _snap_per_core(self,zdok,groups=1):
 		"""
 		Get a snapshot of 8-bit data per core from the ADC.
@@ -630,19 +765,51 @@ class He6CRES_DAQ(object):
 		Returns
 		-------
 		x : ndarray
-			A (groups*(2**16), 4)-shaped array in which data along the
-			first dimension contains consecutive samples taken form the
-			same core. The data is ordered such that the index along
+			A (groups*(2**16), 4)-shaped int8 array in which data along
+			the first dimension contains consecutive samples taken form
+			the same core. The data is ordered such that the index along
 			the second dimension matches core-indexing in the spi-
 			family of functions used to tune the core parameters.
 		"""
-		x = zeros((0,4))
+		x = empty((0,4),dtype=int8)
 		for ig in xrange(groups):
 			grab = self.roach2.snapshot_get('snap_{0}_snapshot'.format(zdok))
-        	        x_ = array(unpack('%ib' %grab['length'], grab['data']))
-                	x_ = x_.reshape((x_.size/4,4))
-			x = concatenate((x,x_))
-		return x[:,[0,2,1,3]]
+			n = grab['length']/4
+			if ig == 0:
+				x = empty((groups*n,4),dtype=int8)
+			elif not n*groups == x.shape[0]:
+				raise RuntimeError("Snapshot length changed from {0} to {1} samples".format(x.shape[0]/groups*4,grab['length']))
+			# interleaved samples of the four cores, reordered column by column without temporaries
+			g = frombuffer(grab['data'],dtype=int8,count=4*n).reshape((n,4))
+			for ic,src in enumerate(self._SNAP_CORE_ORDER):
+				x[ig*n:(ig+1)*n,ic] = g[:,src]
+		return x
+
+	@staticmethod
+	def _core_stats(x):
+		"""
+		Compute the mean and standard deviation per core of a snapshot.
+
+		Parameters
+		----------
+		x : ndarray
+			Snapshot as returned by _snap_per_core().
+
+		Returns
+		-------
+		mean, std : ndarray
+			Per-core mean and standard deviation, each of shape (4,),
+			computed exactly from one histogram pass over the samples.
+		"""
+		# one 256-bin histogram per core, offset so that all cores go in one bincount
+		idx = x.view(uint8) + arange(0,1024,256,dtype=uint16)
+		h = bincount(idx.ravel(),minlength=1024).reshape((4,256)).astype(float64)
+		v = arange(256,dtype=float64)
+		v[128:] -= 256
+		n = h.sum(axis=1)
+		mean = h.dot(v)/n
+		var = h.dot(v*v)/n - mean*mean
+		return mean,sqrt(var)
 
 	def _make_assignment(self,assign_dict):
 		"""
@@ -715,6 +882,71 @@ class He6CRES_DAQ(object):
 
 		self.close_dsoc()
 
+	def plot_waterfall(self,n=None,nspec=16,mode='max',rows=256,width=1024,fps=10.0,digital_id=None,batch_size=1024,max_in_flight=4,dsoc_desc=None,close_soc=False,title=None,freq_range=None):
+		"""
+		Show a live waterfall of received spectra.
+
+		Unlike plot_packets() the display runs in its own process and is
+		handed spectra at its frame rate, see Waterfall, so that packets
+		are received at full rate while it is shown.
+
+		Calls to this method should only be made while a data socket is
+		open, unless a socket descriptor is provided. See open_dsoc() for
+		details.
+
+		Parameters
+		----------
+		n : int
+		    Stop after this many packets. If None then run until the
+		    window is closed. Default is None.
+		nspec : int
+		    Maximum number of spectra reduced into one row. Default is 16.
+		mode : string
+		    Reduction over spectra, 'max' for max-hold or 'mean'. Default
+		    is 'max'.
+		rows : int
+		    Number of rows in the image. Default is 256.
+		width : int
+		    Number of columns in the image. Default is 1024.
+		fps : float
+		    Frames drawn per second. Default is 10.0.
+		digital_id : int
+		    Only show spectra of this digital channel. If None show all.
+		    Default is None.
+		batch_size : int
+		    See iter_packets().
+		max_in_flight : int
+		    See iter_packets().
+		dsoc_desc : tuple
+		    Socket descriptor tuple as for open_dsoc() method. If None,
+		    a data socket should already be open. Default is None.
+		close_soc : boolean
+		    Close socket when done.
+		title : string
+		    Figure title. Default is None.
+		freq_range : tuple
+		    Frequencies in MHz of the first and past the last bin. If None
+		    the bins span the ADC band, 0 to ADC_SAMPLE_RATE/2. Default is
+		    None.
+
+		Returns
+		-------
+		loss : dict
+		    Summary of packet loss over the run, see packet_loss().
+		"""
+		if freq_range is None:
+			freq_range = (0,self.ADC_SAMPLE_RATE/2/1e6)
+		wf = Waterfall(Packet,nspec=nspec,mode=mode,rows=rows,width=width,fps=fps,digital_id=digital_id,freq_range=freq_range,title=title)
+		wf.start()
+		try:
+			for pkts in self.iter_packets(batch_size=batch_size,max_in_flight=max_in_flight,n=n,dsoc_desc=dsoc_desc,close_soc=close_soc,max_latency=1.0/fps):
+				wf.offer(pkts)
+				if not wf.is_alive():
+					break
+		finally:
+			wf.stop()
+		return self.packet_loss()
+
 
 	def _start(self,boffile='latest-build',do_cal=True,iface='enp11s0',verbose=10):
 		"""
@@ -745,36 +977,17 @@ class He6CRES_DAQ(object):
 		if verbose > 1:
 			print "Bitcode '", boffile, "' programmed successfully"
 
-		# display clock speed
+		# display clock speed, measured once since every estimate takes a while
+		clock = self.roach2.est_brd_clk()
 		if verbose > 3:
-			print "Board clock is ", self.roach2.est_brd_clk(), "MHz"
-	                if self.roach2.est_brd_clk() > 250.0 or self.roach2.est_brd_clk()<199.0:
+			print "Board clock is ", clock, "MHz"
+			if clock > 250.0 or clock < 199.0:
 				print "WrOnG INpuT cLoCK fREQuencY! trY AgAIN, FoOL!!!"
 
-		# ADC interface calibration
-		if verbose > 3:
-			print "Performing ADC interface calibration on ZDOK0"
-			adc5g.set_test_mode(self.roach2, 0)
-			adc5g.sync_adc(self.roach2)
-			opt0, glitches0 = adc5g.calibrate_mmcm_phase(self.roach2, 0, ['snap_0_snapshot',])
-			adc5g.unset_test_mode(self.roach2, 0)
-
-			print "Performing ADC interface calibration on ZDOK1"
-			adc5g.set_test_mode(self.roach2, 1)
-			adc5g.sync_adc(self.roach2)
-			opt1, glitches1 = adc5g.calibrate_mmcm_phase(self.roach2, 1, ['snap_1_snapshot',]) 
-			adc5g.unset_test_mode(self.roach2, 1)
-
-		if verbose > 3:
-			print "...ADC interface calibration done."
-		if verbose > 5:
-			print "if0: opt0 = ",opt0, ", glitches0 = \n", array(glitches0)
-			print "if1: opt1 = ",opt1, ", glitches0 = \n", array(glitches1)
-
-		# ADC core calibration
+		# ADC interface and core calibration, both ADC cards at the same time
+		self.calibrate_adc_interface(zdoks=(0,1),verbose=verbose)
 		if do_cal:
-			self.calibrate_adc_ogp(zdok=0,verbose=verbose)
-                        self.calibrate_adc_ogp(zdok=1,verbose=verbose)
+			self.calibrate_adcs_cached(zdoks=(0,1),clock=clock,verbose=verbose)
 
 		# build channel-list
 		ch_list = ['a','b','c','d','e','f','g','h']
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+from numpy import (
+	abs as np_abs,
+	angle,
+	arange,
+	argmax,
+	array,
+	clip,
+	cos,
+	einsum,
+	empty,
+	float64,
+	floor,
+	hanning,
+	log,
+	ones,
+	pi,
+	sign,
+	sin,
+	zeros,
+	)
+from numpy.fft import rfft
+from numpy.linalg import solve
+
+def tone_frequency(y):
+	"""
+	Estimate the frequency of the strongest tone in a sequence of samples.
+
+	Parameters
+	----------
+	y : ndarray
+	    Uniformly sampled data.
+
+	Returns
+	-------
+	omega : float
+	    Frequency in radians per sample, found by quadratic interpolation
+	    of the log-magnitude peak of the windowed spectrum.
+	"""
+	n = len(y)
+	p = np_abs(rfft((y - y.mean())*hanning(n)))
+	k = argmax(p[1:-1]) + 1
+	a,b,c = log(p[k-1:k+2] + 1e-300)
+	d = 0.5*(a - c)/(a - 2*b + c) if not a - 2*b + c == 0 else 0.0
+	return 2*pi*(k + d)/n
+
+def fit_core_phases(x,positions,groups=1,omega=None):
+	"""
+	Measure the phase of a tone in every core of an interleaved ADC.
+
+	A sine of the same frequency is fitted by linear least squares to
+	the samples of every core of every snapshot group at once, with the
+	samples placed at their position in the interleaved sequence, so
+	that cores without timing skew show the same phase.
+
+	Parameters
+	----------
+	x : ndarray
+	    (groups*m, cores)-shaped snapshot, m consecutive samples per core
+	    per group, as returned by He6CRES_DAQ._snap_per_core().
+	positions : tuple
+	    Position of every column of x within one interleaving period.
+	groups : int
+	    Number of separate snapshots in x, each fitted with its own phase.
+	    Default is 1.
+	omega : float
+	    Tone frequency in radians per sample of the interleaved sequence.
+	    If None it is estimated from the first group, see
+	    tone_frequency(). Default is None.
+
+	Returns
+	-------
+	dphi : ndarray
+	    Phase of every core relative to the first, in radians, averaged
+	    over the groups.
+	amplitude : ndarray
+	    Fitted tone amplitude per core.
+	omega : float
+	    Tone frequency used.
+	"""
+	cores = x.shape[1]
+	m = x.shape[0]/groups
+	xg = x.reshape((groups,m,cores)).astype(float64)
+	if omega is None:
+		y = empty((m,cores),dtype=float64)
+		y[:,list(positions)] = xg[0]
+		omega = tone_frequency(y.ravel())
+	n = cores*arange(m,dtype=float64)[:,None] + array(positions,dtype=float64)[None,:]
+	# design matrix per core, its normal equations are shared by all groups
+	d = empty((m,cores,3),dtype=float64)
+	d[...,0] = cos(omega*n)
+	d[...,1] = sin(omega*n)
+	d[...,2] = 1.0
+	g = einsum('mjk,mjl->jkl',d,d)
+	rhs = einsum('mjk,gmj->jkg',d,xg)
+	coef = solve(g,rhs)
+	# x = A cos(omega n) + B sin(omega n) = R cos(omega n + phi)
+	z = coef[:,0,:] - 1j*coef[:,1,:]
+	dphi = angle((z*z[:1].conj()/np_abs(z[:1])).mean(axis=1))
+	return dphi,np_abs(z).mean(axis=1),omega
+
+class CoreSolver(object):
+	"""
+	Find the register setting per ADC core that brings a measured quantity to a target.
+
+	Every core is modelled as responding linearly to its setting, y = a +
+	b*x, with a and b fitted by least squares to all measurements made
+	so far. Each step jumps straight to the predicted optimum, rounded
+	to the register resolution and clipped to the register limits, so
+	that a few snapshots suffice instead of one per resolution step.
+	Cores within tolerance keep their setting. Once the predicted
+	optimum of every other core is the setting it already has, the
+	target is closer than one register step and the search is settled,
+	since further snapshots could only hunt between neighbouring
+	register values.
+
+	The solver does not touch the hardware itself, see run().
+	"""
+
+	@property
+	def snapshots(self):
+		"""
+		Number of measurements made.
+		"""
+		return len(self._y)
+
+	@property
+	def settled(self):
+		"""
+		True if the last search stopped because no core could get closer to target.
+		"""
+		return self._settled
+
+	@property
+	def x(self):
+		"""
+		Setting per core of the last measurement.
+		"""
+		return self._x[-1] if len(self._x) > 0 else None
+
+	@property
+	def y(self):
+		"""
+		Last measurement per core.
+		"""
+		return self._y[-1] if len(self._y) > 0 else None
+
+	def __init__(self,target,tol,resolution,limits,fixed=(),slope_sign=1.0,cores=4):
+		"""
+		Initialize CoreSolver.
+
+		Parameters
+		----------
+		target : float
+		    Value the measured quantity should take in every core.
+		tol : float
+		    A core is done once its measurement is within tol of target.
+		resolution : float
+		    Register resolution, in units of the setting.
+		limits : tuple
+		    Lowest and highest setting.
+		fixed : tuple
+		    Indices of cores that keep their setting, such as a reference
+		    core. Default is ().
+		slope_sign : float
+		    Sign of the response, only used while it cannot be fitted.
+		    Default is 1.0.
+		cores : int
+		    Number of cores. Default is 4.
+		"""
+		self._target = float(target)
+		self._tol = float(tol)
+		self._res = float(resolution)
+		self._lim = (float(limits[0]),float(limits[1]))
+		self._free = ones(cores,dtype=bool)
+		self._free[list(fixed)] = False
+		self._slope_sign = sign(slope_sign)
+		self._x = []
+		self._y = []
+		self._settled = False
+
+	def add(self,x,y):
+		"""
+		Record the settings of all cores and the quantity measured with them.
+		"""
+		self._x.append(array(x,dtype=float))
+		self._y.append(array(y,dtype=float))
+
+	def done(self):
+		"""
+		Return True once every free core is within tolerance.
+		"""
+		if len(self._y) == 0:
+			return False
+		return not any((np_abs(self._y[-1] - self._target) >= self._tol) & self._free)
+
+	def fit(self):
+		"""
+		Fit the linear response of every core to all measurements.
+
+		Returns
+		-------
+		a, b : ndarray
+		    Intercept and slope per core, NaN where fewer than two
+		    distinct settings were measured.
+		"""
+		x = array(self._x)
+		y = array(self._y)
+		n = float(len(x))
+		mx = x.sum(axis=0)/n
+		my = y.sum(axis=0)/n
+		sxx = ((x - mx)**2).sum(axis=0)
+		sxy = ((x - mx)*(y - my)).sum(axis=0)
+		b = zeros(len(mx))
+		b[:] = float('nan')
+		ok = sxx > 0
+		b[ok] = sxy[ok]/sxx[ok]
+		return my - b*mx,b
+
+	def predict(self):
+		"""
+		Return the settings to measure next.
+		"""
+		x = self._x[-1].copy()
+		err = self._y[-1] - self._target
+		a,b = self.fit()
+		move = self._free & (np_abs(err) >= self._tol)
+		for ic in move.nonzero()[0]:
+			# NaN compares unequal to itself
+			if b[ic] == b[ic] and not b[ic] == 0:
+				x[ic] = self._quantize((self._target - a[ic])/b[ic])
+			else:
+				# no response measured yet, step toward the target
+				x[ic] = self._quantize(x[ic] - sign(err[ic])*self._slope_sign*self._res)
+		return x
+
+	def run(self,apply,measure,x0,step,maxiter):
+		"""
+		Search for the settings that bring all cores to target.
+
+		The response is first measured at x0 and at x0 + step, then up to
+		maxiter predicted settings are tried until all cores are within
+		tolerance or the search is settled.
+
+		Parameters
+		----------
+		apply : callable
+		    Called with the settings per core, writes them to the ADC and
+		    returns the settings as read back.
+		measure : callable
+		    Takes a snapshot and returns the measured quantity per core.
+		x0 : ndarray
+		    First settings.
+		step : float
+		    Change of the free cores' settings for the second measurement.
+		maxiter : int
+		    Maximum number of predicted settings to try.
+
+		Returns
+		-------
+		x : ndarray
+		    Settings of the last measurement.
+		"""
+		self._settled = False
+		x0 = array(x0,dtype=float)
+		self.add(apply(x0),measure())
+		self.add(apply(x0 + step*self._free),measure())
+		for ii in xrange(maxiter):
+			if self.done():
+				break
+			x = self.predict()
+			if (self._quantize(x) == self._quantize(self.x)).all():
+				self._settled = True
+				break
+			self.add(apply(x),measure())
+		return self.x
+
+	def _quantize(self,x):
+		return clip(floor(0.5 + x/self._res)*self._res,self._lim[0],self._lim[1])
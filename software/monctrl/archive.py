@@ -0,0 +1,608 @@
+#!/usr/bin/env python
+
+import bz2
+import json
+import struct
+import zlib
+from numpy import (
+	asarray,
+	concatenate,
+	dtype,
+	empty,
+	frombuffer,
+	int64,
+	searchsorted,
+	uint32,
+	uint8,
+	zeros,
+	)
+from packet_batch import PacketBatch
+
+try:
+	import lzma
+except ImportError:
+	lzma = None
+
+ARCHIVE_MAGIC = b'HE6ARCH1'
+ARCHIVE_BLOCK_MAGIC = b'HE6ABLK1'
+ARCHIVE_FOOTER_MAGIC = b'HE6AIDX1'
+
+# one record per chunk, all fields little-endian
+ARCHIVE_CHUNK_DTYPE = dtype([
+	('stream','<u4'),
+	('offset','<u8'),
+	('nbytes','<u8'),
+	('row0','<u8'),
+	('rows','<u4'),
+	('col0','<u4'),
+	('cols','<u4'),
+	('unix_time_start','<u4'),
+	('unix_time_stop','<u4'),
+	('pkt_start','<u4'),
+	('pkt_stop','<u4'),
+	('if_id','u1'),
+	('digital_id','u1'),
+	('fft_shift','<u2'),
+	])
+
+def _codec(name,level):
+	"""
+	Return (compress, decompress) functions for the named codec.
+	"""
+	if name == 'none':
+		return (lambda s: s),(lambda s: s)
+	if name == 'zlib':
+		return (lambda s: zlib.compress(s,level)),zlib.decompress
+	if name == 'bz2':
+		return (lambda s: bz2.compress(s,max(level,1))),bz2.decompress
+	if name == 'lzma':
+		if lzma is None:
+			raise ValueError("Codec 'lzma' is not available in this Python")
+		return (lambda s: lzma.compress(s,preset=level)),lzma.decompress
+	raise ValueError("Unknown codec '{0}', should be one of {1}".format(name,CODECS))
+
+CODECS = ('none','zlib','bz2','lzma')
+
+def _shuffle(x):
+	"""
+	Regroup the bytes of x by significance, which makes slowly varying
+	multi-byte samples compress better.
+	"""
+	return x.view(uint8).reshape((-1,x.dtype.itemsize)).T.tostring()
+
+def _unshuffle(s,dt,shape):
+	b = frombuffer(s,dtype=uint8).reshape((dt.itemsize,-1)).T.copy()
+	return b.view(dt).reshape(shape)
+
+def _block_header(meta,recs,ut,pkt):
+	"""
+	Return the header of a time block, see ArchiveWriter.
+	"""
+	meta_str = json.dumps(meta).encode('utf-8')
+	header = zlib.compress(struct.pack('<Q',len(meta_str)) + meta_str + recs.tostring() + asarray(ut).astype('<u4').tostring() + asarray(pkt).astype('<u4').tostring())
+	return ARCHIVE_BLOCK_MAGIC + struct.pack('<Q',len(header)) + header
+
+def _scan_blocks(fh,end):
+	"""
+	Collect the index of an archive from the headers of its time blocks.
+
+	Blocks are read from the start of the file up to offset end and
+	reading stops at the first block that is not complete, so that an
+	archive cut short is indexed up to its last complete block.
+
+	Returns
+	-------
+	meta : dict
+	    Archive fields and streams as stored in the footer, None if there
+	    is no complete block.
+	index : ndarray
+	    One ARCHIVE_CHUNK_DTYPE record per chunk.
+	columns : list
+	    unix_time and pkt_in_batch of every spectrum, one dict per stream.
+	pos : int
+	    Offset of the end of the last complete block.
+	"""
+	head = len(ARCHIVE_BLOCK_MAGIC) + 8
+	pos = len(ARCHIVE_MAGIC)
+	blocks = []
+	while pos + head <= end:
+		fh.seek(pos)
+		tag = fh.read(head)
+		if not tag[:len(ARCHIVE_BLOCK_MAGIC)] == ARCHIVE_BLOCK_MAGIC:
+			break
+		n = struct.unpack('<Q',tag[len(ARCHIVE_BLOCK_MAGIC):])[0]
+		if pos + head + n > end:
+			break
+		try:
+			header = zlib.decompress(fh.read(n))
+		except zlib.error:
+			break
+		n_meta = struct.unpack('<Q',header[:8])[0]
+		bm = json.loads(header[8:8+n_meta].decode('utf-8'))
+		p = 8 + n_meta
+		n_idx = bm['chunks']*ARCHIVE_CHUNK_DTYPE.itemsize
+		recs = frombuffer(header[p:p+n_idx],dtype=ARCHIVE_CHUNK_DTYPE).copy()
+		p = p + n_idx
+		n_col = 4*bm['rows']
+		ut = frombuffer(header[p:p+n_col],dtype='<u4').astype(uint32)
+		pkt = frombuffer(header[p+n_col:p+2*n_col],dtype='<u4').astype(uint32)
+		data = pos + head + n
+		if data + int(recs['nbytes'].sum()) > end:
+			break
+		recs['offset'] = recs['offset'] + data
+		blocks.append((bm,recs,ut,pkt))
+		pos = data + int(recs['nbytes'].sum())
+	if len(blocks) == 0:
+		return None,zeros(0,dtype=ARCHIVE_CHUNK_DTYPE),[],pos
+	meta = dict((k,blocks[0][0][k]) for k in ('version','codec','shuffle','chunk_shape','dtype','bins'))
+	# streams without a complete block are left out, renumber the others
+	nums = sorted(set([bm['stream'] for bm,recs,ut,pkt in blocks]))
+	dense = dict((num,ii) for ii,num in enumerate(nums))
+	streams = [None]*len(nums)
+	columns = [dict(unix_time=[],pkt_in_batch=[]) for num in nums]
+	for bm,recs,ut,pkt in blocks:
+		ii = dense[bm['stream']]
+		recs['stream'] = ii
+		if streams[ii] is None:
+			streams[ii] = dict(if_id=bm['if_id'],digital_id=bm['digital_id'],rows=0)
+		streams[ii]['rows'] = streams[ii]['rows'] + bm['rows']
+		columns[ii]['unix_time'].append(ut)
+		columns[ii]['pkt_in_batch'].append(pkt)
+	index = concatenate([recs for bm,recs,ut,pkt in blocks])
+	columns = [dict((k,concatenate(v)) for k,v in c.items()) for c in columns]
+	meta['chunks'] = len(index)
+	meta['streams'] = streams
+	return meta,index,columns,pos
+
+def _footer_offset(fh):
+	"""
+	Return the offset of the footer of an archive, None if it has none.
+	"""
+	fh.seek(0,2)
+	n = 8 + len(ARCHIVE_FOOTER_MAGIC)
+	if fh.tell() < len(ARCHIVE_MAGIC) + n:
+		return None
+	fh.seek(-n,2)
+	tail = fh.read(n)
+	if not tail[8:] == ARCHIVE_FOOTER_MAGIC:
+		return None
+	return struct.unpack('<Q',tail[:8])[0]
+
+def _write_footer(fh,offset,meta,index,columns):
+	"""
+	Write the footer at offset and cut the file after it.
+	"""
+	cols = []
+	for c in columns:
+		cols.append(asarray(c['unix_time']).astype('<u4').tostring())
+		cols.append(asarray(c['pkt_in_batch']).astype('<u4').tostring())
+	meta['chunks'] = len(index)
+	meta_str = json.dumps(meta).encode('utf-8')
+	footer = zlib.compress(struct.pack('<Q',len(meta_str)) + meta_str + index.tostring() + b''.join(cols))
+	fh.seek(offset)
+	fh.write(footer)
+	fh.write(struct.pack('<Q',offset))
+	fh.write(ARCHIVE_FOOTER_MAGIC)
+	fh.truncate()
+
+class ArchiveWriter(object):
+	"""
+	Write decoded spectra to a chunked, compressed archive file.
+
+	Spectra are the frequency-domain packets, the interleaved time-domain
+	packets are not archived. They are grouped into streams by (if_id,
+	digital_id). The spectra of each stream form a (time, frequency)
+	array that is cut into chunks of chunk_shape, each compressed on its
+	own. The chunks of every chunk_shape[0] spectra of a stream, a time
+	block, are written back to back after a block header with their
+	index, one record of ARCHIVE_CHUNK_DTYPE per chunk, and the unix_time
+	and pkt_in_batch of the spectra. Nothing but the spectra not yet written is kept in
+	memory, and an archive that was not closed can be recovered up to its
+	last complete time block, see recover_archive().
+
+	On close() the block headers are collected into a footer, so that a
+	reader finds the whole index in one read and can decompress only the
+	chunks a query touches.
+
+	Layout: ARCHIVE_MAGIC, time blocks, zlib-compressed footer, footer
+	offset as little-endian uint64, ARCHIVE_FOOTER_MAGIC. A time block is
+	ARCHIVE_BLOCK_MAGIC, the size of the zlib-compressed block header as
+	little-endian uint64, the block header and the chunks.
+	"""
+
+	@property
+	def path(self):
+		return self._path
+
+	def __init__(self,path,chunk_shape=(256,1024),codec='zlib',level=3,shuffle=True,fft_shift=0):
+		"""
+		Initialize ArchiveWriter and create the archive file.
+
+		Parameters
+		----------
+		path : string
+		    Archive file name, an existing file is overwritten.
+		chunk_shape : tuple
+		    (spectra, frequency bins) per chunk. Default is (256, 1024).
+		codec : string
+		    Compression codec, one of CODECS. Default is 'zlib'.
+		level : int
+		    Compression level passed to the codec. Default is 3.
+		shuffle : bool
+		    Group the bytes of multi-byte samples by significance before
+		    compression. Default is True.
+		fft_shift : int
+		    FFT shift vector in effect for the spectra, as the integer
+		    value of the bit string given to He6CRES_DAQ.set_fft_shift().
+		    Recorded with every chunk, may be changed between writes
+		    through set_fft_shift(). Default is 0.
+		"""
+		self._compress,_ = _codec(codec,level)
+		self._path = path
+		self._chunk_shape = (int(chunk_shape[0]),int(chunk_shape[1]))
+		self._codec = codec
+		self._level = level
+		self._shuffle = shuffle
+		self._fft_shift = fft_shift
+		self._dtype = None
+		self._bins = None
+		self._streams = []
+		self._stream_ids = dict()
+		# the footer is collected from the block headers on close
+		self._fh = open(path,'w+b')
+		self._fh.write(ARCHIVE_MAGIC)
+		self._offset = len(ARCHIVE_MAGIC)
+
+	def set_fft_shift(self,fft_shift):
+		"""
+		Record a new FFT shift setting for spectra written from now on.
+
+		Accepts the integer value or the bit string given to
+		He6CRES_DAQ.set_fft_shift(). Pending spectra are written out first
+		so that every chunk has a single setting.
+		"""
+		if isinstance(fft_shift,basestring):
+			fft_shift = int(fft_shift,2)
+		for st in self._streams:
+			self._flush_stream(st,final=True)
+		self._fft_shift = fft_shift
+
+	def write(self,pkts):
+		"""
+		Append spectra to the archive.
+
+		Parameters
+		----------
+		pkts : PacketBatch
+		    Decoded packets, as returned by He6CRES_DAQ.grab_packets(). A
+		    list of Packet objects is also accepted. Only the
+		    frequency-domain packets are archived, time-domain packets
+		    are skipped.
+		"""
+		if not isinstance(pkts,PacketBatch):
+			pkts = PacketBatch.FromPackets(pkts)
+		pkts = pkts.spectra()
+		if len(pkts) == 0:
+			return
+		if self._dtype is None:
+			self._dtype = pkts.data.dtype.newbyteorder('=')
+			self._bins = pkts.bins
+		elif not pkts.bins == self._bins:
+			raise ValueError("Spectra have {0} bins, but archive has {1}".format(pkts.bins,self._bins))
+		key = pkts.if_id.astype(uint32)*256 + pkts.digital_id
+		for k in sorted(set(key.tolist())):
+			sel = key == k
+			st = self._stream(int(k)>>8,int(k)&0xFF)
+			st['data'].append(pkts.data[sel])
+			st['unix_time'].append(pkts.unix_time[sel])
+			st['pkt_in_batch'].append(pkts.pkt_in_batch[sel])
+			st['pending'] = st['pending'] + int(sel.sum())
+			self._flush_stream(st,final=False)
+
+	def close(self):
+		"""
+		Write the remaining spectra and the footer, then close the file.
+		"""
+		if self._fh is None:
+			return
+		for st in self._streams:
+			self._flush_stream(st,final=True)
+		self._fh.flush()
+		meta,index,columns,end = _scan_blocks(self._fh,self._offset)
+		if meta is None:
+			meta = self._fields()
+			meta['streams'] = []
+		_write_footer(self._fh,end,meta,index,columns)
+		self._fh.close()
+		self._fh = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*exc):
+		self.close()
+
+	def _stream(self,if_id,digital_id):
+		k = (if_id,digital_id)
+		if not k in self._stream_ids:
+			self._stream_ids[k] = len(self._streams)
+			self._streams.append(dict(
+				num=len(self._streams),
+				if_id=if_id,
+				digital_id=digital_id,
+				rows=0,
+				pending=0,
+				data=[],
+				unix_time=[],
+				pkt_in_batch=[],
+				))
+		return self._streams[self._stream_ids[k]]
+
+	def _flush_stream(self,st,final):
+		rows = self._chunk_shape[0]
+		if st['pending'] == 0 or (st['pending'] < rows and not final):
+			return
+		data = concatenate(st['data'])
+		ut = concatenate(st['unix_time'])
+		pkt = concatenate(st['pkt_in_batch'])
+		n_full = (len(data)/rows)*rows
+		n_out = len(data) if final else n_full
+		for r0 in xrange(0,n_out,rows):
+			r1 = min(r0+rows,n_out)
+			self._write_time_block(st,data[r0:r1],ut[r0:r1],pkt[r0:r1])
+		st['data'] = [data[n_out:]]
+		st['unix_time'] = [ut[n_out:]]
+		st['pkt_in_batch'] = [pkt[n_out:]]
+		st['pending'] = len(data) - n_out
+
+	def _fields(self):
+		return dict(
+			version=2,
+			codec=self._codec,
+			shuffle=self._shuffle,
+			chunk_shape=self._chunk_shape,
+			dtype=self._dtype.str if not self._dtype is None else None,
+			bins=self._bins,
+			)
+
+	def _write_time_block(self,st,data,ut,pkt):
+		cols = self._chunk_shape[1]
+		bufs = []
+		recs = []
+		for c0 in xrange(0,self._bins,cols):
+			c1 = min(c0+cols,self._bins)
+			chunk = data[:,c0:c1].astype(self._dtype)
+			if self._shuffle:
+				buf = _shuffle(chunk)
+			else:
+				buf = chunk.tostring()
+			buf = self._compress(buf)
+			rec = zeros(1,dtype=ARCHIVE_CHUNK_DTYPE)
+			rec['stream'] = st['num']
+			rec['nbytes'] = len(buf)
+			rec['row0'] = st['rows']
+			rec['rows'] = len(data)
+			rec['col0'] = c0
+			rec['cols'] = c1 - c0
+			rec['unix_time_start'] = ut[0]
+			rec['unix_time_stop'] = ut[-1]
+			rec['pkt_start'] = pkt[0]
+			rec['pkt_stop'] = pkt[-1]
+			rec['if_id'] = st['if_id']
+			rec['digital_id'] = st['digital_id']
+			rec['fft_shift'] = self._fft_shift
+			bufs.append(buf)
+			recs.append(rec)
+		recs = concatenate(recs)
+		meta = self._fields()
+		meta.update(stream=st['num'],if_id=st['if_id'],digital_id=st['digital_id'],rows=len(data),chunks=len(recs))
+		# offsets in a block header count from the end of the header
+		recs['offset'] = concatenate(([0],[len(b) for b in bufs[:-1]])).cumsum()
+		header = _block_header(meta,recs,ut,pkt)
+		self._fh.write(header)
+		for buf in bufs:
+			self._fh.write(buf)
+		self._offset = self._offset + len(header) + sum([len(b) for b in bufs])
+		st['rows'] = st['rows'] + len(data)
+
+class ArchiveReader(object):
+	"""
+	Random access to an archive written by ArchiveWriter.
+
+	Only the footer is read on opening. Queries decompress only the chunks
+	that overlap the requested rows and frequency bins. An archive that
+	was not closed has no footer, its index is then collected from the
+	headers of its time blocks if recover is set.
+	"""
+
+	@property
+	def index(self):
+		return self._index
+
+	@property
+	def streams(self):
+		return [(st['if_id'],st['digital_id']) for st in self._meta['streams']]
+
+	@property
+	def meta(self):
+		return self._meta
+
+	def __init__(self,path,recover=False):
+		"""
+		Initialize ArchiveReader and read the footer.
+
+		Parameters
+		----------
+		path : string
+		    Archive file name.
+		recover : bool
+		    Open an archive that was not closed, up to its last complete
+		    time block, without changing the file. See recover_archive()
+		    to complete the file itself. Default is False.
+		"""
+		self._fh = open(path,'rb')
+		if not self._fh.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC:
+			raise ValueError("'{0}' is not an He6CRES archive".format(path))
+		footer_offset = _footer_offset(self._fh)
+		if footer_offset is None:
+			if not recover:
+				raise ValueError("Archive '{0}' has no footer, it was not closed properly. Open it with recover=True or see recover_archive()".format(path))
+			self._fh.seek(0,2)
+			self._meta,self._index,self._columns,end = _scan_blocks(self._fh,self._fh.tell())
+			if self._meta is None:
+				raise ValueError("Archive '{0}' holds no complete time block".format(path))
+			_,self._decompress = _codec(self._meta['codec'],0)
+			self._dtype = dtype(self._meta['dtype'])
+			return
+		end = self._fh.tell() - 8 - len(ARCHIVE_FOOTER_MAGIC)
+		self._fh.seek(footer_offset)
+		footer = zlib.decompress(self._fh.read(end-footer_offset))
+		n_meta = struct.unpack('<Q',footer[:8])[0]
+		self._meta = json.loads(footer[8:8+n_meta].decode('utf-8'))
+		pos = 8 + n_meta
+		n_idx = self._meta['chunks']*ARCHIVE_CHUNK_DTYPE.itemsize
+		self._index = frombuffer(footer[pos:pos+n_idx],dtype=ARCHIVE_CHUNK_DTYPE)
+		pos = pos + n_idx
+		self._columns = []
+		for st in self._meta['streams']:
+			n = st['rows']*4
+			ut = frombuffer(footer[pos:pos+n],dtype='<u4').astype(uint32)
+			pkt = frombuffer(footer[pos+n:pos+2*n],dtype='<u4').astype(uint32)
+			self._columns.append(dict(unix_time=ut,pkt_in_batch=pkt))
+			pos = pos + 2*n
+		_,self._decompress = _codec(self._meta['codec'],0)
+		self._dtype = dtype(self._meta['dtype']) if not self._meta['dtype'] is None else None
+
+	def close(self):
+		"""
+		Close the archive file.
+		"""
+		self._fh.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*exc):
+		self.close()
+
+	def rows(self,if_id,digital_id):
+		"""
+		Return the number of spectra in a stream.
+		"""
+		return self._meta['streams'][self._stream_num(if_id,digital_id)]['rows']
+
+	def columns(self,if_id,digital_id):
+		"""
+		Return the unix_time and pkt_in_batch of every spectrum in a stream.
+		"""
+		return self._columns[self._stream_num(if_id,digital_id)]
+
+	def time_slice(self,if_id,digital_id,t0,t1):
+		"""
+		Return the slice of rows of a stream with t0 <= unix_time < t1.
+		"""
+		ut = self.columns(if_id,digital_id)['unix_time']
+		return slice(int(searchsorted(ut,t0,side='left')),int(searchsorted(ut,t1,side='left')))
+
+	def read(self,if_id,digital_id,rows=slice(None),bins=slice(None)):
+		"""
+		Read a (time, frequency) block of spectra from one stream.
+
+		Parameters
+		----------
+		if_id : int
+		    IF identifier of the stream.
+		digital_id : int
+		    Digital identifier of the stream.
+		rows : slice
+		    Rows (spectra) to read, step must be 1. See time_slice() to
+		    select by unix_time. Default is all rows.
+		bins : slice
+		    Frequency bins to read, step must be 1. Default is all bins.
+
+		Returns
+		-------
+		x : ndarray
+		    The requested spectra.
+		"""
+		num = self._stream_num(if_id,digital_id)
+		r0,r1,rs = rows.indices(self._meta['streams'][num]['rows'])
+		c0,c1,cs = bins.indices(self._meta['bins'])
+		if not rs == 1 or not cs == 1:
+			raise ValueError("Only contiguous row and bin ranges are supported")
+		out = empty((max(r1-r0,0),max(c1-c0,0)),dtype=self._dtype)
+		idx = self._index
+		touched = (idx['stream'] == num) & \
+			(idx['row0'].astype(int64) < r1) & (idx['row0'].astype(int64) + idx['rows'] > r0) & \
+			(idx['col0'].astype(int64) < c1) & (idx['col0'].astype(int64) + idx['cols'] > c0)
+		for rec in idx[touched]:
+			chunk = self._read_chunk(rec)
+			cr0 = int(rec['row0'])
+			cc0 = int(rec['col0'])
+			lo_r = max(r0,cr0)
+			hi_r = min(r1,cr0+int(rec['rows']))
+			lo_c = max(c0,cc0)
+			hi_c = min(c1,cc0+int(rec['cols']))
+			out[lo_r-r0:hi_r-r0,lo_c-c0:hi_c-c0] = chunk[lo_r-cr0:hi_r-cr0,lo_c-cc0:hi_c-cc0]
+		return out
+
+	def _read_chunk(self,rec):
+		self._fh.seek(int(rec['offset']))
+		buf = self._decompress(self._fh.read(int(rec['nbytes'])))
+		shape = (int(rec['rows']),int(rec['cols']))
+		if self._meta['shuffle']:
+			return _unshuffle(buf,self._dtype,shape)
+		return frombuffer(buf,dtype=self._dtype).reshape(shape)
+
+	def _stream_num(self,if_id,digital_id):
+		for ii,st in enumerate(self._meta['streams']):
+			if st['if_id'] == if_id and st['digital_id'] == digital_id:
+				return ii
+		raise KeyError("No stream with if_id={0}, digital_id={1} in archive".format(if_id,digital_id))
+
+def archive_spool(reader,writer,rows_per_read=4096):
+	"""
+	Convert a spool of raw packets into an archive.
+
+	Parameters
+	----------
+	reader : SpoolReader
+	    Open spool to convert.
+	writer : ArchiveWriter
+	    Open archive to append the decoded spectra to.
+	rows_per_read : int
+	    Number of packets decoded at a time. Default is 4096.
+	"""
+	for start in xrange(0,len(reader),rows_per_read):
+		writer.write(reader.batch(start,start+rows_per_read))
+
+def recover_archive(path):
+	"""
+	Complete an archive that was not closed, for example after a crash.
+
+	The index is collected from the headers of the time blocks, a block
+	cut short at the end of the file is discarded and the footer is
+	written, after which the archive opens as if it had been closed. An
+	archive that has a footer is left as it is.
+
+	Parameters
+	----------
+	path : string
+	    Archive file name.
+
+	Returns
+	-------
+	rows : dict
+	    Maps (if_id, digital_id) to the number of spectra in the archive.
+	"""
+	with open(path,'r+b') as fh:
+		if not fh.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC:
+			raise ValueError("'{0}' is not an He6CRES archive".format(path))
+		if _footer_offset(fh) is None:
+			fh.seek(0,2)
+			meta,index,columns,end = _scan_blocks(fh,fh.tell())
+			if meta is None:
+				raise ValueError("Archive '{0}' holds no complete time block".format(path))
+			_write_footer(fh,end,meta,index,columns)
+	with ArchiveReader(path) as reader:
+		return dict((k,reader.rows(*k)) for k in reader.streams)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+from numpy import (
+	abs as np_abs,
+	arange,
+	complexfloating,
+	empty,
+	flatnonzero,
+	float32,
+	float64,
+	int32,
+	int64,
+	int8,
+	issubdtype,
+	less,
+	minimum,
+	percentile,
+	sqrt,
+	uint8,
+	unique,
+	zeros,
+	)
+
+class BinBaseline(object):
+	"""
+	Running per-bin noise floor of a stream of spectra.
+
+	Keeps an exponentially weighted mean and variance of every bin, with
+	weight alpha on the newest spectrum, and a running estimate of a
+	quantile of every bin, the median by default. All state is allocated
+	once and updated in place at a cost of O(bins) per spectrum.
+
+	A block of spectra is applied in one step that gives exactly the
+	mean and variance of applying them one at a time: the block is
+	centred on the current mean and reduced with the exponential weights
+	by a matrix-vector product. The quantile is tracked by stochastic
+	approximation, moving it up or down by a step proportional to the
+	running standard deviation according to the fraction of the block
+	that falls below it, which needs one comparison per sample.
+
+	Where the full rate of spectra is more than needed, update() can
+	apply every stride-th spectrum only, each standing in for stride
+	spectra, which keeps the time constants while cutting the cost.
+	"""
+
+	@property
+	def bins(self):
+		return self._bins
+
+	@property
+	def alpha(self):
+		return self._alpha
+
+	@property
+	def quantile(self):
+		return self._quantile
+
+	@property
+	def count(self):
+		"""
+		Number of spectra applied since the last reset.
+		"""
+		return self._count
+
+	@property
+	def ready(self):
+		return self._count > 0
+
+	@property
+	def mean(self):
+		return self._mean
+
+	@property
+	def var(self):
+		return self._var
+
+	@property
+	def std(self):
+		return sqrt(self._var)
+
+	@property
+	def level(self):
+		"""
+		Running quantile estimate per bin.
+		"""
+		return self._q
+
+	def __init__(self,bins,alpha=1.0/1024,quantile=0.5,eta=None):
+		"""
+		Initialize BinBaseline.
+
+		Parameters
+		----------
+		bins : int
+		    Number of bins per spectrum.
+		alpha : float
+		    Weight of the newest spectrum in the mean and variance, their
+		    time constant is 1/alpha spectra. Default is 1/1024.
+		quantile : float
+		    Quantile to track, 0 < quantile < 1. Default is 0.5.
+		eta : float
+		    Step per spectrum of the quantile estimate, in running
+		    standard deviations. If None use alpha. Default is None.
+		"""
+		if not 0 < alpha <= 1:
+			raise ValueError("Weight alpha should be in (0, 1], got {0}".format(alpha))
+		if not 0 < quantile < 1:
+			raise ValueError("Quantile should be in (0, 1), got {0}".format(quantile))
+		self._bins = bins
+		self._alpha = float(alpha)
+		self._quantile = float(quantile)
+		self._eta = self._alpha if eta is None else float(eta)
+		self._mean = empty(bins,dtype=float64)
+		self._var = empty(bins,dtype=float64)
+		self._q = empty(bins,dtype=float64)
+		self._mean32 = empty(bins,dtype=float32)
+		self._weights = dict()
+		self.reset()
+
+	def reset(self):
+		"""
+		Forget all spectra applied.
+		"""
+		self._count = 0
+		self._mean.fill(0)
+		self._var.fill(0)
+		self._q.fill(0)
+
+	def update(self,x,clip=None,stride=1):
+		"""
+		Apply spectra, oldest first.
+
+		Parameters
+		----------
+		x : ndarray
+		    (M, bins)-shaped array of spectra or a single spectrum of
+		    shape (bins,).
+		clip : ndarray
+		    If not None, spectra are limited to this value per bin before
+		    they are applied, which keeps strong signals from biasing
+		    the noise floor. Default is None.
+		stride : int
+		    Apply every stride-th spectrum only, starting with the last,
+		    weighted as stride spectra. Default is 1.
+		"""
+		if x.ndim == 1:
+			x = x[None,:]
+		n = len(x)
+		if n == 0:
+			return
+		if stride > 1:
+			x = x[(n-1)%stride::stride]
+		m = len(x)
+		if self._count == 0:
+			self._first(x,clip)
+			self._count = n
+			return
+		# deviations from the current mean are small, so single precision suffices
+		self._mean32[:] = self._mean
+		d = x.astype(float32)
+		d -= self._mean32
+		# quantile: fraction below the current estimate against the target
+		self._mean32[:] = self._q - self._mean
+		below = less(d,self._mean32).view(uint8).sum(axis=0,dtype=int32)
+		if not clip is None:
+			minimum(d,(clip - self._mean).astype(float32),out=d)
+		decay,w = self._block_weights(m,stride)
+		# weights of the previous state and of the block sum to one
+		dmean = w.dot(d)
+		d *= d
+		m2 = decay*self._var + w.dot(d)
+		self._mean += dmean
+		self._var[:] = m2 - dmean*dmean
+		g = 1.0 - (1.0 - self._eta)**n
+		self._q += g*sqrt(self._var)*(self._quantile - below/float(m))
+		self._count = self._count + n
+
+	def snapshot(self):
+		"""
+		Return a copy of the baseline.
+
+		Returns
+		-------
+		baseline : dict
+		    'mean', 'var' and 'quantile' arrays per bin and 'count', the
+		    number of spectra applied.
+		"""
+		return dict(mean=self._mean.copy(),var=self._var.copy(),quantile=self._q.copy(),count=self._count)
+
+	def _first(self,x,clip):
+		x = x.astype(float64)
+		if not clip is None:
+			minimum(x,clip,out=x)
+		self._mean[:] = x.mean(axis=0)
+		self._var[:] = x.var(axis=0)
+		self._q[:] = percentile(x,100*self._quantile,axis=0)
+
+	def _block_weights(self,m,stride):
+		bw = self._weights.get((m,stride))
+		if bw is None:
+			# weight of one spectrum standing in for stride spectra
+			a = 1.0 - (1.0 - self._alpha)**stride
+			# spectrum i of m has weight a*(1-a)**(m-1-i)
+			w = (a*(1.0 - a)**(m - 1 - arange(m,dtype=float64))).astype(float32)
+			bw = ((1.0 - a)**m,w)
+			if len(self._weights) < 8:
+				self._weights[(m,stride)] = bw
+		return bw
+
+class StreamBaselines(object):
+	"""
+	One BinBaseline per (if_id, digital_id) stream, so that every FFT engine has its own noise floor.
+
+	Baselines are of the power of complex samples and of the samples
+	themselves otherwise. Only frequency-domain packets are taken, the
+	interleaved time-domain packets are skipped.
+	"""
+
+	@property
+	def packet_cls(self):
+		return self._packet_cls
+
+	def __init__(self,packet_cls,alpha=1.0/1024,quantile=0.5,eta=None):
+		"""
+		Initialize StreamBaselines.
+
+		Parameters
+		----------
+		packet_cls : class
+		    Packet class of the stream, which fixes the number of bins and
+		    the sample type.
+		alpha : float
+		    See BinBaseline.
+		quantile : float
+		    See BinBaseline.
+		eta : float
+		    See BinBaseline.
+		"""
+		dtype = packet_cls.CODEC.dtype
+		self._packet_cls = packet_cls
+		self._bins = packet_cls.CODEC.bins
+		self._complex = issubdtype(dtype,complexfloating)
+		# 8-bit power is sent unsigned, decoded as int8 it would wrap above 127
+		self._unsigned8 = dtype == int8
+		self._power_dtype = self.power(zeros(1,dtype=dtype)).dtype
+		self._alpha = alpha
+		self._quantile = quantile
+		self._eta = eta
+		self._baselines = dict()
+
+	def keys(self):
+		"""
+		Return the (if_id, digital_id) of all streams seen.
+		"""
+		return sorted(self._baselines.keys())
+
+	def get(self,if_id=0,digital_id=0):
+		"""
+		Return the BinBaseline of a stream, created if not seen yet.
+		"""
+		key = (if_id,digital_id)
+		b = self._baselines.get(key)
+		if b is None:
+			b = BinBaseline(self._bins,alpha=self._alpha,quantile=self._quantile,eta=self._eta)
+			self._baselines[key] = b
+		return b
+
+	def reset(self):
+		"""
+		Reset the baselines of all streams.
+		"""
+		for b in self._baselines.values():
+			b.reset()
+
+	@property
+	def power_dtype(self):
+		"""
+		Data type of the arrays returned by power().
+		"""
+		return self._power_dtype
+
+	def power(self,data):
+		"""
+		Return the quantity the baselines are of for decoded payload data.
+
+		That is the squared magnitude of complex samples and the samples
+		themselves otherwise, with int8 samples taken as the unsigned
+		8-bit power the firmware sends, as a view without copying.
+		"""
+		if self._complex:
+			return np_abs(data)**2
+		if self._unsigned8:
+			return data.view(uint8)
+		return data
+
+	def process(self,pkts,stats=None):
+		"""
+		Apply a batch of spectra to the baselines of their streams.
+
+		Parameters
+		----------
+		pkts : PacketBatch
+		    Decoded packets, in order of arrival. Time-domain packets
+		    are skipped.
+		stats : PipelineStats
+		    If not None, record the time taken as stage 'baseline'.
+		    Default is None.
+		"""
+		if not stats is None:
+			with stats.stage('baseline'):
+				return self.process(pkts)
+		pkts = pkts.spectra()
+		if len(pkts) == 0:
+			return
+		key = pkts.if_id.astype(int64) << 6 | pkts.digital_id
+		keys = unique(key)
+		if len(keys) == 1:
+			self.get(int(pkts.if_id[0]),int(pkts.digital_id[0])).update(self.power(pkts.data))
+		else:
+			for k in keys:
+				idx = flatnonzero(key == k)
+				self.get(int(k >> 6),int(k & 0x3F)).update(self.power(pkts.data[idx]))
+
+	def snapshot(self):
+		"""
+		Return a copy of all baselines.
+
+		Returns
+		-------
+		baselines : dict
+		    Maps (if_id, digital_id) to BinBaseline.snapshot().
+		"""
+		return dict((k,b.snapshot()) for k,b in self._baselines.items())
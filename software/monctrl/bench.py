@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+import adc5g
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+from Queue import Empty
+from datetime import datetime
+from numpy import (
+	arange,
+	asarray,
+	int8,
+	percentile,
+	uint8,
+	__version__ as numpy_version,
+	)
+from numpy.random import RandomState
+from stats import PipelineStats
+from struct import pack
+from time import time
+
+# metrics compared against a baseline, and whether higher is better
+COMPARED_METRICS = (
+	('packets_per_s',True),
+	('mb_per_s',True),
+	('latency_p50',False),
+	('latency_p99',False),
+	('peak_rss_kb',False),
+	)
+
+class FakeRoach(adc5g.DummyRoachClient):
+	"""
+	DummyRoachClient that also serves ADC snapshots.
+
+	Snapshots hold a test ramp per core as the ADC sends it in test mode,
+	with glitches added unless the MMCM phase, advanced through the
+	adc5g_controller device as by adc5g.inc_mmcm_phase(), lies in a
+	window of clean phase steps.
+	"""
+
+	def __init__(self,snap_bytes=1<<18,clean=(20,40),seed=0):
+		adc5g.DummyRoachClient.__init__(self)
+		self._devices[adc5g.OPB_CONTROLLER] = pack('>I',0)
+		self._snap_bytes = snap_bytes
+		self._clean = clean
+		self._phase = 0
+		self._rng = RandomState(seed)
+		# ramp per core, interleaved over four cores, Gray-coded and offset as sent by the ADC
+		ramp = (arange(snap_bytes)/4) % 256
+		binary = ramp.copy()
+		for shift in (1,2,4):
+			binary = binary ^ (binary >> shift)
+		self._ramp = (binary - 128).astype(int8)
+
+	def blindwrite(self,device_name,data,offset=0):
+		if device_name == adc5g.OPB_CONTROLLER and len(data) == 4:
+			# an MMCM phase increment sets the enable bit of its ZDOK
+			word = ord(data[0])<<8 | ord(data[1])
+			if word & 0x11:
+				self._phase = (self._phase + 1) % 56
+		adc5g.DummyRoachClient.blindwrite(self,device_name,data,offset)
+
+	def snapshot_get(self,device_name,man_trig=False,man_valid=False,wait_period=1,offset=-1,circular_capture=False,get_extra_val=False):
+		x = self._ramp.copy()
+		if not self._clean[0] <= self._phase < self._clean[1]:
+			x[self._rng.randint(0,len(x),16)] = 0
+		return dict(length=len(x),data=x.tostring())
+
+def offline_daq(module,roach):
+	"""
+	Return an He6CRES_DAQ of the given module without connecting to a board.
+	"""
+	daq = module.He6CRES_DAQ.__new__(module.He6CRES_DAQ)
+	daq._roach2 = roach
+	daq._stats = PipelineStats()
+	return daq
+
+def _stats(latencies,items,nbytes):
+	"""
+	Summarize per-call latencies in seconds for calls that each handled
+	items packets of nbytes bytes in total.
+
+	Throughput is derived from the median latency, so that a few calls
+	disturbed by the rest of the system do not mask a regression.
+	"""
+	lat = asarray(latencies)
+	p50 = float(percentile(lat,50))
+	return dict(
+		calls=len(lat),
+		seconds=float(lat.sum()),
+		packets_per_s=items/p50 if p50 > 0 else None,
+		mb_per_s=nbytes/p50/1e6 if p50 > 0 and nbytes else None,
+		latency_p50=p50,
+		latency_p90=float(percentile(lat,90)),
+		latency_p99=float(percentile(lat,99)),
+		latency_max=float(lat.max()),
+		)
+
+def _timed(fn,repeat):
+	lat = []
+	for ii in xrange(repeat):
+		t0 = time()
+		fn()
+		lat.append(time() - t0)
+	return lat
+
+def _packet_module(bits):
+	if bits == 8:
+		import He6DAQ
+		return He6DAQ
+	import He6DAQ_16bit
+	return He6DAQ_16bit
+
+def bench_from_byte_string(bits,n=2000,seed=0):
+	"""
+	Decode single packets with Packet.FromByteString.
+	"""
+	Packet = _packet_module(bits).Packet
+	raw = RandomState(seed).randint(0,256,(n,Packet.BYTES_IN_PACKET)).astype(uint8)
+	bytestrs = [raw[ii].tostring() for ii in xrange(n)]
+	it = iter(bytestrs*2)
+	lat = _timed(lambda: Packet.FromByteString(next(it)),n)
+	return _stats(lat,1,Packet.BYTES_IN_PACKET)
+
+def bench_from_buffer(bits,n=1024,repeat=50,seed=0):
+	"""
+	Decode blocks of n packets with PacketBatch.FromBuffer.
+	"""
+	from packet_batch import PacketBatch
+	Packet = _packet_module(bits).Packet
+	raw = RandomState(seed).randint(0,256,(n,Packet.BYTES_IN_PACKET)).astype(uint8)
+	lat = _timed(lambda: PacketBatch.FromBuffer(raw,Packet),repeat)
+	return _stats(lat,n,n*Packet.BYTES_IN_PACKET)
+
+def bench_grab_packets(bits,rate,n=1024,repeat=20,ring_slots=4096,port=4101):
+	"""
+	Grab packets over loopback from a replay running at the given rate.
+
+	The replay runs in a separate process and keeps sending until all
+	grabs are done, so that lost packets do not stall the benchmark.
+	"""
+	module = _packet_module(bits)
+	daq = offline_daq(module,None)
+	daq.open_dsoc(('127.0.0.1',port),ring_slots=ring_slots)
+	proc = multiprocessing.Process(target=_replay_forever,args=(module.Packet,rate,port))
+	proc.daemon = True
+	proc.start()
+	try:
+		# first grab waits for the sender to come up
+		daq.grab_packets(n)
+		lat = _timed(lambda: daq.grab_packets(n),repeat)
+		loss = daq.packet_loss()['dsoc']
+	finally:
+		proc.terminate()
+		proc.join()
+		daq.close_dsoc()
+	res = _stats(lat,n,n*module.Packet.BYTES_IN_PACKET)
+	res['rate'] = rate
+	res['lost'] = loss['lost']
+	res['out_of_order'] = loss['out_of_order']
+	return res
+
+def _replay_forever(packet_cls,rate,port):
+	import replay
+	replay.PacketReplay(packet_cls,dest_port=port,rate=rate,burst=8).run()
+
+def bench_snap_per_core(bits,groups=4,repeat=10):
+	"""
+	Read ADC snapshots with He6CRES_DAQ._snap_per_core.
+	"""
+	roach = FakeRoach()
+	daq = offline_daq(_packet_module(bits),roach)
+	lat = _timed(lambda: daq._snap_per_core(0,groups=groups),repeat)
+	# one item is one snapshot
+	return _stats(lat,groups,groups*roach._snap_bytes)
+
+def bench_total_glitches(length=1<<16,repeat=10):
+	"""
+	Count glitches in a clean test ramp with adc5g.total_glitches.
+	"""
+	core = list(arange(length) % 256)
+	lat = _timed(lambda: adc5g.total_glitches(core,8),repeat)
+	return _stats(lat,1,length)
+
+def bench_calibrate_mmcm_phase(snap_bytes=1<<14,repeat=1):
+	"""
+	Scan the MMCM phase with adc5g.calibrate_mmcm_phase.
+	"""
+	roach = FakeRoach(snap_bytes=snap_bytes)
+	lat = _timed(lambda: adc5g.calibrate_mmcm_phase(roach,0,['snap_0_snapshot',]),repeat)
+	res = _stats(lat,1,56*snap_bytes)
+	# the scan is relative to the phase it starts from, so check on a fresh board
+	res['optimal_phase'] = adc5g.calibrate_mmcm_phase(FakeRoach(snap_bytes=snap_bytes),0,['snap_0_snapshot',])[0]
+	return res
+
+def benchmarks(quick=False,rates=(1e4,5e4,1e5)):
+	"""
+	Return the list of (name, function, kwargs) benchmarks to run.
+	"""
+	scale = 10 if quick else 1
+	cases = []
+	for bits in (8,16):
+		cases.append(("from_byte_string_{0}bit".format(bits),bench_from_byte_string,dict(bits=bits,n=2000/scale)))
+		cases.append(("from_buffer_{0}bit".format(bits),bench_from_buffer,dict(bits=bits,repeat=50/scale)))
+		cases.append(("snap_per_core_{0}bit".format(bits),bench_snap_per_core,dict(bits=bits,repeat=10/scale)))
+	for bits in (8,16):
+		for r in rates:
+			cases.append(("grab_packets_{0}bit_{1:g}pps".format(bits,r),bench_grab_packets,dict(bits=bits,rate=r,repeat=20/scale)))
+	cases.append(("total_glitches",bench_total_glitches,dict(repeat=10/scale)))
+	cases.append(("calibrate_mmcm_phase",bench_calibrate_mmcm_phase,dict(snap_bytes=(1<<14)/scale)))
+	return cases
+
+def _run_child(q,fn,kwargs):
+	try:
+		rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		res = fn(**kwargs)
+		res['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		res['rss_growth_kb'] = res['peak_rss_kb'] - rss0
+		q.put(res)
+	except Exception as e:
+		q.put(dict(error="{0}: {1}".format(type(e).__name__,e)))
+
+def _wait_child(q,proc,timeout=None,poll=1.0):
+	"""
+	Return the result a benchmark process puts on q.
+
+	An error result is returned instead if the process exits without a
+	result or, unless timeout is None, is still running after timeout
+	seconds, in which case it is terminated.
+	"""
+	t0 = time()
+	while proc.is_alive():
+		try:
+			return q.get(timeout=poll)
+		except Empty:
+			if not timeout is None and time() - t0 > timeout:
+				proc.terminate()
+				return dict(error="timed out after {0:.0f} s".format(timeout))
+	# the result may have been put just before the process exited
+	try:
+		return q.get(timeout=poll)
+	except Empty:
+		return dict(error="benchmark process exited with code {0}".format(proc.exitcode))
+
+def run(cases,verbose=True,timeout=None):
+	"""
+	Run benchmarks, each in a fresh process so that peak memory is its own.
+
+	Parameters
+	----------
+	cases : list
+	    (name, function, keyword arguments) of every benchmark, see
+	    benchmarks().
+	verbose : bool
+	    Print every result as it comes in. Default is True.
+	timeout : float
+	    Seconds after which a benchmark is stopped and reported as an
+	    error. If None wait as long as its process runs. Default is None.
+
+	Returns
+	-------
+	results : dict
+	    Machine information under 'meta' and the result of every
+	    benchmark, keyed by name, under 'results'.
+	"""
+	results = dict()
+	for name,fn,kwargs in cases:
+		q = multiprocessing.Queue()
+		proc = multiprocessing.Process(target=_run_child,args=(q,fn,kwargs))
+		proc.start()
+		res = _wait_child(q,proc,timeout=timeout)
+		proc.join()
+		res['params'] = kwargs
+		results[name] = res
+		if verbose:
+			print _format(name,res)
+	meta = dict(
+		date=datetime.utcnow().isoformat(),
+		host=platform.node(),
+		platform=platform.platform(),
+		python=platform.python_version(),
+		numpy=numpy_version,
+		)
+	return dict(meta=meta,results=results)
+
+def compare(results,baseline,tolerance=0.1):
+	"""
+	Compare results against a baseline.
+
+	Parameters
+	----------
+	results : dict
+	    Output of run().
+	baseline : dict
+	    Output of an earlier run(), for example loaded from its JSON file.
+	tolerance : float
+	    Relative change beyond which a metric counts as regressed.
+	    Default is 0.1.
+
+	Returns
+	-------
+	regressions : list
+	    (name, metric, baseline value, new value) for every regressed
+	    metric of every benchmark present in both.
+	"""
+	regressions = []
+	for name,res in sorted(results['results'].items()):
+		base = baseline['results'].get(name)
+		if base is None or 'error' in base or 'error' in res:
+			continue
+		for metric,higher_is_better in COMPARED_METRICS:
+			old = base.get(metric)
+			new = res.get(metric)
+			if old is None or new is None or old == 0:
+				continue
+			change = (new - old)/float(old)
+			if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+				regressions.append((name,metric,old,new))
+	return regressions
+
+def _format(name,res):
+	if 'error' in res:
+		return "{0:36s} ERROR {1}".format(name,res['error'])
+	pps = res['packets_per_s']
+	mbs = res['mb_per_s']
+	return "{0:36s} {1:>12s} pkt/s {2:>9s} MB/s  p50 {3:9.3f} ms  p99 {4:9.3f} ms  peak {5:8d} kB".format(
+		name,
+		"{0:.1f}".format(pps) if not pps is None else "-",
+		"{0:.1f}".format(mbs) if not mbs is None else "-",
+		res['latency_p50']*1e3,
+		res['latency_p99']*1e3,
+		res['peak_rss_kb'],
+		)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark packet decode, capture and calibration paths.")
+	parser.add_argument('--only',default=None,help="Run only benchmarks whose name contains this string.")
+	parser.add_argument('--quick',action='store_true',help="Run fewer repetitions.")
+	parser.add_argument('--rates',type=float,nargs='+',default=[1e4,5e4,1e5],help="Replay rates for grab_packets in packets/s.")
+	parser.add_argument('--save',default=None,help="Write results to this JSON file.")
+	parser.add_argument('--baseline',default=None,help="Compare against results in this JSON file.")
+	parser.add_argument('--tolerance',type=float,default=0.1,help="Relative change counted as a regression. Default is 0.1.")
+	parser.add_argument('--timeout',type=float,default=None,help="Stop a benchmark after this many seconds.")
+	args = parser.parse_args(argv)
+	cases = benchmarks(quick=args.quick,rates=args.rates)
+	if not args.only is None:
+		cases = [c for c in cases if args.only in c[0]]
+	results = run(cases,timeout=args.timeout)
+	if not args.save is None:
+		with open(args.save,'w') as fh:
+			json.dump(results,fh,indent=2,sort_keys=True)
+	if not args.baseline is None:
+		with open(args.baseline,'r') as fh:
+			baseline = json.load(fh)
+		regressions = compare(results,baseline,args.tolerance)
+		for name,metric,old,new in regressions:
+			print "REGRESSION {0} {1}: {2:.6g} -> {3:.6g}".format(name,metric,old,new)
+		if len(regressions) > 0:
+			return 1
+		print "No regressions against {0}".format(args.baseline)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
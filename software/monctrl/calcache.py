@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import errno
+import json
+import os
+from time import time
+
+class CalibrationCache(object):
+	"""
+	Persistent store of ADC core calibrations.
+
+	Offset, gain and phase settings of the four cores of an ADC are kept
+	in a JSON file, keyed by the board hostname, the ZDOK slot, the
+	bitcode version and the board clock, so that a board can be brought
+	up again from the settings found last time instead of from zero.
+	Clocks are keyed to a resolution of clock_resolution MHz, because
+	the measured clock differs slightly from run to run. Every entry
+	carries the time it was stored and entries older than max_age are
+	evicted when the file is loaded or saved.
+
+	The file is replaced atomically on save, so a reader never sees a
+	partially written store.
+	"""
+
+	DEFAULT_PATH = os.path.join(os.path.expanduser('~'),'.he6cres','adc_calibration.json')
+
+	# fields of a calibration, one value per core
+	FIELDS = ('offset','gain','phase')
+
+	@property
+	def path(self):
+		return self._path
+
+	@property
+	def max_age(self):
+		return self._max_age
+
+	def __init__(self,path=DEFAULT_PATH,max_age=7*24*3600.0,clock_resolution=1.0):
+		"""
+		Initialize CalibrationCache and load the store if it exists.
+
+		Parameters
+		----------
+		path : string
+		    JSON file of the store, created on the first save. Default is
+		    DEFAULT_PATH.
+		max_age : float
+		    Age in seconds after which an entry is evicted. Default is
+		    one week.
+		clock_resolution : float
+		    Resolution in MHz to which board clocks are keyed. Default is
+		    1.0.
+		"""
+		self._path = path
+		self._max_age = float(max_age)
+		self._clock_resolution = float(clock_resolution)
+		self._entries = dict()
+		self.load()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def key(self,hostname,zdok,version,clock):
+		"""
+		Return the key of a calibration.
+
+		Parameters
+		----------
+		hostname : string
+		    Address of the ROACH2 on the control network.
+		zdok : int
+		    ZDOK slot of the ADC.
+		version : tuple
+		    Bitcode version as read from the rcs_lib, rcs_app and rcs_user
+		    registers.
+		clock : float
+		    Measured board clock in MHz.
+
+		Returns
+		-------
+		key : string
+		"""
+		clock = int(round(clock/self._clock_resolution))
+		return "{0}/zdok{1}/{2}/{3}".format(hostname,zdok,"-".join(["{0:08x}".format(v & 0xFFFFFFFF) for v in version]),clock)
+
+	def get(self,hostname,zdok,version,clock,now=None):
+		"""
+		Look up a calibration.
+
+		Returns
+		-------
+		ogp : dict
+		    'offset', 'gain' and 'phase' lists with one value per core and
+		    'age', the age of the entry in seconds. None if there is no
+		    entry for the key or it is stale.
+		"""
+		if now is None:
+			now = time()
+		entry = self._entries.get(self.key(hostname,zdok,version,clock))
+		if entry is None or now - entry['time'] > self._max_age:
+			return None
+		ogp = dict((k,list(entry[k])) for k in self.FIELDS)
+		ogp['age'] = now - entry['time']
+		return ogp
+
+	def put(self,hostname,zdok,version,clock,ogp,now=None):
+		"""
+		Store a calibration, replacing any for the same key.
+
+		Parameters
+		----------
+		ogp : dict
+		    'offset', 'gain' and 'phase' with one value per core, as
+		    returned by He6CRES_DAQ.calibrate_adc_ogp().
+		"""
+		if now is None:
+			now = time()
+		entry = dict((k,[float(v) for v in ogp[k]]) for k in self.FIELDS)
+		entry['time'] = now
+		entry['hostname'] = hostname
+		entry['zdok'] = zdok
+		entry['clock'] = clock
+		self._entries[self.key(hostname,zdok,version,clock)] = entry
+
+	def evict(self,now=None):
+		"""
+		Remove entries older than max_age.
+
+		Returns
+		-------
+		n : int
+		    Number of entries removed.
+		"""
+		if now is None:
+			now = time()
+		stale = [k for k,e in self._entries.items() if now - e['time'] > self._max_age]
+		for k in stale:
+			del self._entries[k]
+		return len(stale)
+
+	def load(self):
+		"""
+		Replace the entries in memory with those in the file, if it exists.
+		"""
+		try:
+			with open(self._path,'r') as fh:
+				self._entries = json.load(fh)
+		except IOError as e:
+			if not e.errno == errno.ENOENT:
+				raise
+			self._entries = dict()
+		except ValueError:
+			# a corrupt store only costs a calibration, start over
+			self._entries = dict()
+		self.evict()
+
+	def save(self):
+		"""
+		Write the entries to the file, without stale ones.
+		"""
+		self.evict()
+		d = os.path.dirname(self._path)
+		if d and not os.path.isdir(d):
+			os.makedirs(d)
+		tmp = "{0}.{1}.tmp".format(self._path,os.getpid())
+		with open(tmp,'w') as fh:
+			json.dump(self._entries,fh,indent=2,sort_keys=True)
+		os.rename(tmp,self._path)
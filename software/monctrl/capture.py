@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+
+from numpy import lexsort
+from packet_batch import PacketBatch
+from packet_ring import PacketRing
+from sequence import SequenceTracker
+from socket_tuning import KernelDropMonitor, tune_socket
+from stats import monotonic
+from Queue import Empty, Queue
+from socket import socket, AF_INET, SOCK_DGRAM
+import sys
+import threading
+
+class MultiPortCapture(object):
+	"""
+	Capture the packet streams sent to several 10GbE ports at once.
+
+	One datagram socket with its own receive ring is bound per port and
+	each port is served by its own receiver thread, so that the combined
+	output of all 10GbE cores can be received. The per-port streams are
+	merged into a single stream ordered by (unix_time, pkt_in_batch).
+	"""
+
+	@property
+	def ports(self):
+		return [s.getsockname()[1] for s in self._sockets]
+
+	@property
+	def channels(self):
+		return self._channels
+
+	@property
+	def packet_cls(self):
+		return self._packet_cls
+
+	@property
+	def options(self):
+		"""
+		Socket options as applied per port, see tune_socket().
+		"""
+		return dict(zip(self._channels,self._options))
+
+	def __init__(self,host,ports,packet_cls,channels=None,ring_slots=4096,timeout=None,seq_stride=1,stats=None,rcvbuf=32<<20,busy_poll=None):
+		"""
+		Initialize MultiPortCapture and bind one socket per port.
+
+		Parameters
+		----------
+		host : string
+		    IP address / hostname on the data network, as passed to
+		    socket.bind().
+		ports : list
+		    Port numbers to receive on, one per 10GbE core.
+		packet_cls : class
+		    Packet class that defines the header and payload layout.
+		channels : list
+		    Digital channel names, one per port, used in messages. If None
+		    the port numbers are used. Default is None.
+		ring_slots : int
+		    Number of packet slots in the receive ring of each port. Default
+		    is 4096.
+		timeout : float
+		    Socket timeout in seconds, if None then block indefinitely.
+		    Default is None.
+		seq_stride : int
+		    Expected pkt_in_batch increment between consecutive packet
+		    pairs on one port, see SequenceTracker. Default is 1.
+		stats : PipelineStats
+		    If not None, record per port the recv.<channel> and
+		    decode.<channel> stages and packet counters, and the merge
+		    stage. Default is None.
+		rcvbuf : int
+		    Kernel receive buffer size per port in bytes, if None keep the
+		    system default. Default is 32 MiB.
+		busy_poll : int
+		    SO_BUSY_POLL time in microseconds, if None leave off. Default
+		    is None.
+		"""
+		if channels is None:
+			channels = list(ports)
+		if not len(channels) == len(ports):
+			raise ValueError("Need one channel name per port, got {0} names for {1} ports".format(len(channels),len(ports)))
+		self._packet_cls = packet_cls
+		self._channels = list(channels)
+		self._stats = stats
+		self._sockets = []
+		self._rings = []
+		self._options = []
+		self._kernel_drops = []
+		self._trackers = [SequenceTracker(stride=seq_stride) for p in ports]
+		try:
+			for port in ports:
+				s = socket(AF_INET,SOCK_DGRAM)
+				self._sockets.append(s)
+				self._options.append(tune_socket(s,rcvbuf=rcvbuf,busy_poll=busy_poll))
+				s.bind((host,port))
+				s.settimeout(timeout)
+				self._kernel_drops.append(KernelDropMonitor(s))
+				self._rings.append(PacketRing(ring_slots,packet_cls.BYTES_IN_PACKET))
+		except:
+			self.close()
+			raise
+
+	def loss(self):
+		"""
+		Return running sequence accounting per port.
+
+		Returns
+		-------
+		totals : dict
+		    Maps channel name to SequenceTracker.summary() of its port,
+		    with the datagrams discarded by the kernel under
+		    'kernel_drops'.
+		"""
+		totals = dict()
+		for ch,t,kd in zip(self._channels,self._trackers,self._kernel_drops):
+			totals[ch] = t.summary()
+			totals[ch]['kernel_drops'] = kd.drops(force=True)
+		return totals
+
+	def close(self):
+		"""
+		Close all receive sockets.
+		"""
+		for kd in self._kernel_drops:
+			kd.close()
+		for s in self._sockets:
+			s.close()
+
+	def grab(self,n):
+		"""
+		Receive n packets from every port and merge them.
+
+		Parameters
+		----------
+		n : int
+		    Number of packets to receive per port.
+
+		Returns
+		-------
+		pkts : PacketBatch
+		    Packets from all ports, ordered by unix_time and then by
+		    pkt_in_batch. Packets with equal keys keep their port order.
+		    The loss attribute maps channel name to the sequence report
+		    of that port for this grab.
+		"""
+		batches = self._run_receivers(n)
+		t0 = monotonic()
+		pkts = self.merge(batches)
+		if not self._stats is None:
+			self._stats.add_time('merge',monotonic() - t0)
+		pkts.loss = dict((ch,b.loss) for ch,b in zip(self._channels,batches))
+		return pkts
+
+	def grab_per_port(self,n):
+		"""
+		Receive n packets from every port without merging.
+
+		Returns
+		-------
+		pkts : list
+		    One PacketBatch per port, in the order of the ports property,
+		    each carrying the sequence report of its port.
+		"""
+		return self._run_receivers(n)
+
+	@staticmethod
+	def merge(batches):
+		"""
+		Merge PacketBatch objects into a single time-ordered batch.
+		"""
+		pkts = PacketBatch.concatenate(batches)
+		# lexsort is stable, sorts on the last key first
+		order = lexsort((pkts.pkt_in_batch,pkts.unix_time))
+		return pkts.take(order)
+
+	def _run_receivers(self,n):
+		results = [None]*len(self._sockets)
+		errors = [None]*len(self._sockets)
+		threads = []
+		for ii in xrange(len(self._sockets)):
+			t = threading.Thread(
+				target=self._receive,
+				args=(ii,n,results,errors),
+				name="rx-{0}".format(self._channels[ii]),
+				)
+			t.daemon = True
+			threads.append(t)
+			t.start()
+		for t in threads:
+			t.join()
+		for ii,err in enumerate(errors):
+			if not err is None:
+				raise RuntimeError("Receive on channel {0} failed: {1}".format(self._channels[ii],err[1])), None, err[2]
+		return results
+
+	def _receive(self,ii,n,results,errors):
+		try:
+			sock = self._sockets[ii]
+			ring = self._rings[ii]
+			ch = self._channels[ii]
+			stats = self._stats
+			batches = []
+			for jj in xrange(0,n,ring.slots):
+				t0 = monotonic()
+				raw = ring.recv(sock,min(ring.slots,n-jj))
+				t1 = monotonic()
+				batches.append(PacketBatch.FromBuffer(raw,self._packet_cls))
+				if not stats is None:
+					# stages are per channel since the receivers run concurrently
+					stats.add_time('recv.{0}'.format(ch),t1 - t0)
+					stats.add_time('decode.{0}'.format(ch),monotonic() - t1)
+					stats.count(ch,raw.shape[0],raw.nbytes)
+			if len(batches) == 1:
+				pkts = batches[0]
+			else:
+				pkts = PacketBatch.concatenate(batches)
+			pkts.loss = self._kernel_drops[ii].annotate(self._trackers[ii].update_batch(pkts))
+			results[ii] = pkts
+		except Exception:
+			errors[ii] = sys.exc_info()
+
+class PacketStream(object):
+	"""
+	Receive packets continuously on a background thread into bounded memory.
+
+	The stream owns a receive ring divided into max_in_flight segments of
+	batch_size slots. The receiver thread fills free segments and queues
+	them, the consumer takes filled segments from the queue and hands them
+	back once done. When all segments are in flight the receiver waits, so
+	the memory footprint is fixed no matter how long the stream runs.
+	"""
+
+	@property
+	def batch_size(self):
+		return self._batch_size
+
+	@property
+	def max_in_flight(self):
+		return self._max_in_flight
+
+	@property
+	def tracker(self):
+		return self._tracker
+
+	def __init__(self,sock,packet_cls,batch_size=1024,max_in_flight=4,poll=0.1,stats=None,name='dsoc',kernel_drops=None,max_latency=None):
+		"""
+		Initialize PacketStream.
+
+		Parameters
+		----------
+		sock : socket
+		    Bound datagram socket. The stream does not close it.
+		packet_cls : class
+		    Packet class that defines the header and payload layout.
+		batch_size : int
+		    Number of packets per segment. Default is 1024.
+		max_in_flight : int
+		    Number of segments, which bounds the number of filled or
+		    partially filled buffers at any time. Should be at least 2 for
+		    the receiver to run while a batch is being consumed. Default
+		    is 4.
+		poll : float
+		    Interval in seconds at which the receiver checks for a stop
+		    request while waiting for data. A partially filled segment
+		    is handed out once no packet arrived for this long, so that
+		    a batch is never held back by a pause in the stream. Default
+		    is 0.1.
+		stats : PipelineStats
+		    If not None, record the recv, parse_header, decode_payload,
+		    sequence and consume stages, the packet counters under name
+		    and the depth of the queue of filled segments as the
+		    ready_queue gauge. Default is None.
+		name : string
+		    Port name for the packet counters. Default is 'dsoc'.
+		kernel_drops : KernelDropMonitor
+		    If not None, add the datagrams discarded by the kernel to the
+		    sequence report of every batch, read at most once per
+		    interval of the monitor. Default is None.
+		max_latency : float
+		    If not None, hand out a partially filled segment once its
+		    first packet has waited this many seconds, see
+		    PacketRing.recv_at(). Default is None.
+		"""
+		if max_in_flight < 1:
+			raise ValueError("Need at least one buffer in flight")
+		self._sock = sock
+		self._packet_cls = packet_cls
+		self._batch_size = batch_size
+		self._max_in_flight = max_in_flight
+		self._poll = poll
+		self._max_latency = max_latency
+		self._stats = stats
+		self._name = name
+		self._kernel_drops = kernel_drops
+		self._ring = PacketRing(batch_size*max_in_flight,packet_cls.BYTES_IN_PACKET)
+		self._free = Queue()
+		self._ready = Queue()
+		for ii in xrange(max_in_flight):
+			self._free.put(ii)
+		self._stop = threading.Event()
+		self._thread = None
+		self._tracker = SequenceTracker()
+
+	def start(self):
+		"""
+		Start the receiver thread.
+		"""
+		if not self._thread is None:
+			raise RuntimeError("PacketStream already started")
+		self._thread = threading.Thread(target=self._receive,name="rx-stream")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self,timeout=None):
+		"""
+		Ask the receiver thread to stop and wait for it to finish.
+		"""
+		self._stop.set()
+		# unblock a receiver waiting for a free segment
+		self._free.put(None)
+		if not self._thread is None:
+			self._thread.join(timeout)
+
+	def batches(self,n=None,raw=False):
+		"""
+		Iterate over received packets batch by batch.
+
+		Parameters
+		----------
+		n : int
+		    Stop after this many packets in total. If None then continue
+		    until stop() is called. Default is None.
+		raw : bool
+		    If True yield (k, BYTES_IN_PACKET) uint8 views into the ring,
+		    each valid until the next iteration. Otherwise yield decoded
+		    PacketBatch objects, which own their memory. Default is False.
+
+		Yields
+		------
+		pkts : PacketBatch or ndarray
+		    Up to batch_size packets, in order of arrival. Decoded batches
+		    carry the sequence report in their loss attribute.
+		"""
+		count = 0
+		held = None
+		stats = self._stats
+		try:
+			while n is None or count < n:
+				item = self._next_ready()
+				if item is None:
+					break
+				if not stats is None:
+					stats.gauge('ready_queue',self._ready.qsize(),self._max_in_flight)
+				if isinstance(item,tuple) and len(item) == 3:
+					raise RuntimeError("Packet stream receiver failed: {0}".format(item[1])), None, item[2]
+				seg,k = item
+				if not n is None:
+					k = min(k,n-count)
+				view = self._ring.slot_view(seg*self._batch_size,k)
+				t0 = monotonic()
+				hdr = self._packet_cls._unpack_header(self._packet_cls._header_view(view))
+				report = self._tracker.update(hdr[0],hdr[1],hdr[8])
+				if not self._kernel_drops is None:
+					self._kernel_drops.annotate(report)
+				if not stats is None:
+					stats.add_time('sequence',monotonic() - t0)
+				count = count + k
+				if raw:
+					held = seg
+					t0 = monotonic()
+					yield view
+					if not stats is None:
+						stats.add_time('consume',monotonic() - t0)
+					held = None
+					self._free.put(seg)
+				else:
+					pkts = PacketBatch.FromBuffer(view,self._packet_cls,stats=stats)
+					pkts.loss = report
+					self._free.put(seg)
+					t0 = monotonic()
+					yield pkts
+					if not stats is None:
+						stats.add_time('consume',monotonic() - t0)
+		finally:
+			if not held is None:
+				self._free.put(held)
+
+	def _next_ready(self):
+		"""
+		Wait for the next filled segment, None once the stream has ended.
+
+		The queue is polled every poll seconds, since a blocking get cannot
+		be interrupted on Python 2 and a KeyboardInterrupt would not arrive
+		while the stream is idle.
+		"""
+		while True:
+			try:
+				return self._ready.get(timeout=self._poll)
+			except Empty:
+				pass
+			if self._stop.is_set():
+				return None
+			if not self._thread is None and not self._thread.is_alive():
+				# the receiver queues its last item before it exits
+				try:
+					return self._ready.get_nowait()
+				except Empty:
+					return None
+
+	def _receive(self):
+		try:
+			while not self._stop.is_set():
+				seg = self._free.get()
+				if seg is None:
+					break
+				t0 = monotonic()
+				k = self._ring.recv_at(self._sock,seg*self._batch_size,self._batch_size,stop=self._stop,poll=self._poll,max_latency=self._max_latency)
+				if not self._stats is None and k > 0:
+					self._stats.add_time('recv',monotonic() - t0)
+					self._stats.count(self._name,k,k*self._ring.packet_bytes)
+				if k > 0:
+					self._ready.put((seg,k))
+				else:
+					self._free.put(seg)
+		except Exception:
+			self._ready.put(sys.exc_info())
+		self._ready.put(None)
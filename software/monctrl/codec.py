@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+
+from numpy import (
+	array,
+	complex64,
+	dtype,
+	empty,
+	frombuffer,
+	ndarray,
+	uint32,
+	uint64,
+	uint8,
+	)
+
+class PacketCodec(object):
+	"""
+	Decode and encode He6CRES packets for one payload sample type.
+
+	The header layout is the same for every bitcode build. The payload is
+	sent as big-endian 64-bit words holding the first sample in the least
+	significant position, so that the sample type fixes both the wire
+	dtype and the number of samples per word. Both are worked out once
+	when the codec is constructed; decoding is then a strided view plus a
+	single conversion pass regardless of the sample type.
+
+	Supported sample types are given in SAMPLE_TYPES:
+
+	    * 'int8' : signed 8-bit samples,
+	    * 'uint8' : unsigned 8-bit samples,
+	    * 'uint16' : unsigned 16-bit samples,
+	    * 'complex' : pairs of signed 8-bit real and imaginary parts,
+	      real part in the more significant byte, decoded to complex64.
+	"""
+
+	BYTES_IN_PAYLOAD = 8192
+	BYTES_IN_HEADER = 32
+	BYTES_IN_PACKET = BYTES_IN_PAYLOAD + BYTES_IN_HEADER
+
+	# header is four big-endian 64-bit words, the first two of which are split into 32-bit halves
+	HEADER_DTYPE = dtype([
+		('id_word','>u4'),
+		('unix_time','>u4'),
+		('user_data_0','>u4'),
+		('user_data_1','>u4'),
+		('reserved_0','>u8'),
+		('reserved_1','>u8'),
+		])
+
+	# dtypes of the arrays returned by unpack_header(), in order
+	HEADER_COLUMN_DTYPES = (
+		dtype('u4'),
+		dtype('u4'),
+		dtype('u1'),
+		dtype('u1'),
+		dtype('u4'),
+		dtype('u4'),
+		dtype('u8'),
+		dtype('u8'),
+		dtype('?'),
+		)
+
+	# sample type: (wire dtype, decoded dtype)
+	SAMPLE_TYPES = {
+		'int8' : (dtype('i1'),dtype('i1')),
+		'uint8' : (dtype('u1'),dtype('u1')),
+		'uint16' : (dtype('>u2'),dtype('u2')),
+		'complex' : (dtype([('re','i1'),('im','i1')]),dtype(complex64)),
+		}
+
+	@property
+	def sample_type(self):
+		return self._sample_type
+
+	@property
+	def wire_dtype(self):
+		return self._wire_dtype
+
+	@property
+	def dtype(self):
+		return self._dtype
+
+	@property
+	def samples_per_word(self):
+		return self._samples_per_word
+
+	@property
+	def bins(self):
+		return self._bins
+
+	def __init__(self,sample_type='int8'):
+		"""
+		Initialize PacketCodec.
+
+		Parameters
+		----------
+		sample_type : string
+		    Payload sample type, one of the keys of SAMPLE_TYPES. Default
+		    is 'int8'.
+		"""
+		if not sample_type in self.SAMPLE_TYPES:
+			raise ValueError("Unknown sample type '{0}', should be one of {1}".format(sample_type,sorted(self.SAMPLE_TYPES.keys())))
+		self._sample_type = sample_type
+		self._wire_dtype,self._dtype = self.SAMPLE_TYPES[sample_type]
+		self._samples_per_word = 8/self._wire_dtype.itemsize
+		self._bins = self.BYTES_IN_PAYLOAD/self._wire_dtype.itemsize
+		self._header_items = self.BYTES_IN_HEADER/self._wire_dtype.itemsize
+
+	def __repr__(self):
+		return "PacketCodec('{0}')".format(self._sample_type)
+
+	def header_view(self,raw):
+		"""
+		Return a structured view of the packet headers in a raw buffer.
+
+		Parameters
+		----------
+		raw : ndarray
+		    C-contiguous uint8 array of shape (N, BYTES_IN_PACKET).
+
+		Returns
+		-------
+		hdr : ndarray
+		    (N,)-shaped array of dtype HEADER_DTYPE sharing memory with raw.
+		"""
+		return ndarray(shape=raw.shape[:1],dtype=self.HEADER_DTYPE,buffer=raw,strides=raw.strides[:1])
+
+	def payload_view(self,raw):
+		"""
+		Return a view of the packet payloads in a raw buffer with samples in order.
+
+		Parameters
+		----------
+		raw : ndarray
+		    C-contiguous uint8 array of shape (N, BYTES_IN_PACKET).
+
+		Returns
+		-------
+		x : ndarray
+		    (N, BYTES_IN_PAYLOAD/8, samples_per_word)-shaped array of dtype
+		    wire_dtype sharing memory with raw. The sample order within
+		    each 64-bit word is reversed by negative striding.
+		"""
+		x = raw.view(self._wire_dtype)[:,self._header_items:]
+		return x.reshape((raw.shape[0],self.BYTES_IN_PAYLOAD/8,self._samples_per_word))[:,:,::-1]
+
+	def unpack_header(self,hdr):
+		"""
+		Extract the header fields from structured header data.
+
+		Parameters
+		----------
+		hdr : ndarray
+		    Array of dtype HEADER_DTYPE, as returned by header_view().
+
+		Returns
+		-------
+		fields : tuple
+		    Arrays (unix_time, pkt_in_batch, digital_id, if_id, user_data_0,
+		    user_data_1, reserved_0, reserved_1, freq_not_time) with the same
+		    shape as hdr.
+		"""
+		id_word = hdr['id_word']
+		ut = hdr['unix_time'].astype(uint32)
+		pktnum = (id_word & 0xFFFFF).astype(uint32)
+		did = (id_word>>20 & 0x3F).astype(uint8)
+		ifid = (id_word>>26 & 0x3F).astype(uint8)
+		ud0 = hdr['user_data_0'].astype(uint32)
+		ud1 = hdr['user_data_1'].astype(uint32)
+		res0 = hdr['reserved_0'].astype(uint64)
+		res1 = (hdr['reserved_1'] & uint64(0x7FFFFFFFFFFFFFFF)).astype(uint64)
+		fnt = (hdr['reserved_1'] & uint64(0x8000000000000000)) != 0
+		return (ut,pktnum,did,ifid,ud0,ud1,res0,res1,fnt)
+
+	def decode_payload(self,raw,out=None):
+		"""
+		Decode the packet payloads in a raw buffer.
+
+		Parameters
+		----------
+		raw : ndarray
+		    C-contiguous uint8 array of shape (N, BYTES_IN_PACKET).
+		out : ndarray
+		    If not None, C-contiguous (N, bins) array of dtype dtype to
+		    decode into, such as a slice of preallocated shared memory.
+		    Default is None.
+
+		Returns
+		-------
+		x : ndarray
+		    (N, bins)-shaped array of dtype dtype, out if given. This is
+		    the only pass over the payload, it lays out the word-reversed
+		    view contiguously.
+		"""
+		v = self.payload_view(raw)
+		shape = (raw.shape[0],self._bins)
+		if not out is None:
+			if not out.shape == shape or not out.dtype == self._dtype or not out.flags['C_CONTIGUOUS']:
+				raise ValueError("Output should be a C-contiguous {0} array of dtype {1}".format(shape,self._dtype))
+			x = out.reshape(v.shape)
+		else:
+			x = empty(v.shape,dtype=self._dtype)
+		if self._sample_type == 'complex':
+			x.real = v['re']
+			x.imag = v['im']
+		else:
+			x[...] = v
+		return x.reshape(shape)
+
+	def encode_payload(self,raw,data):
+		"""
+		Write payload samples into a raw buffer, the inverse of decode_payload().
+
+		Parameters
+		----------
+		raw : ndarray
+		    C-contiguous uint8 array of shape (N, BYTES_IN_PACKET).
+		data : ndarray
+		    (N, bins)-shaped array of samples.
+		"""
+		data = data.reshape((raw.shape[0],self.BYTES_IN_PAYLOAD/8,self._samples_per_word))
+		v = self.payload_view(raw)
+		if self._sample_type == 'complex':
+			v['re'] = data.real
+			v['im'] = data.imag
+		else:
+			v[...] = data
+
+	def check_length(self,bytestr):
+		"""
+		Raise ValueError unless bytestr holds exactly one packet.
+		"""
+		len_bytes = len(bytestr)
+		if not len_bytes == self.BYTES_IN_PACKET:
+			raise ValueError("Packet should comprise {0} bytes, but has {1} bytes".format(self.BYTES_IN_PACKET,len_bytes))
+
+class BasePacket(object):
+	"""
+	Encapsulate an He6CRES packet. Header length and structure are retained from R2DAQ (aka ArtooDaq)
+
+	Subclasses set CODEC to the PacketCodec of their bitcode build.
+	"""
+
+	CODEC = None
+
+	BYTES_IN_PAYLOAD = PacketCodec.BYTES_IN_PAYLOAD
+	BYTES_IN_HEADER = PacketCodec.BYTES_IN_HEADER
+	BYTES_IN_PACKET = PacketCodec.BYTES_IN_PACKET
+	HEADER_DTYPE = PacketCodec.HEADER_DTYPE
+
+	@property
+	def unix_time(self):
+		return self._unix_time
+
+	@property
+	def pkt_in_batch(self):
+		return self._pkt_in_batch
+
+	@property
+	def digital_id(self):
+		return self._digital_id
+
+	@property
+	def if_id(self):
+		return self._if_id
+
+	@property
+	def user_data_1(self):
+		return self._user_data_1
+
+	@property
+	def user_data_0(self):
+		return self._user_data_0
+
+	@property
+	def reserved_0(self):
+		return self._reserved_0
+
+	@property
+	def reserverd_1(self):
+		return self._reserved_1
+
+	@property
+	def freq_not_time(self):
+		return self._freq_not_time
+
+	@property
+	def data(self):
+		return self._data
+
+	def __init__(self,ut=0,pktnum=0,did=0,ifid=0,ud0=0,ud1=0,res0=0,res1=0,fnt=False,data=None):
+		"""
+		Initialize Packet with the given attributes
+		"""
+		# assign attributes
+		self._unix_time = ut
+		self._pkt_in_batch = pktnum
+		self._digital_id = did
+		self._if_id = ifid
+		self._user_data_0 = ud0
+		self._user_data_1 = ud1
+		self._reserved_0 = res0
+		self._reserved_1 = res1
+		self._freq_not_time = fnt
+		self._data = data
+
+	def interpret_data(self):
+		"""
+		Returns
+		-------
+		x : ndarray
+		    array represented by the data, of the sample type of the codec.
+		"""
+		x = array(self.data, dtype = self.CODEC.dtype)
+		return x
+
+	@classmethod
+	def _header_view(cls,raw):
+		"""
+		See PacketCodec.header_view().
+		"""
+		return cls.CODEC.header_view(raw)
+
+	@classmethod
+	def _payload_view(cls,raw):
+		"""
+		See PacketCodec.payload_view().
+		"""
+		return cls.CODEC.payload_view(raw)
+
+	@classmethod
+	def _unpack_header(cls,hdr):
+		"""
+		See PacketCodec.unpack_header().
+		"""
+		return cls.CODEC.unpack_header(hdr)
+
+	@classmethod
+	def _decode_payload(cls,raw,out=None):
+		"""
+		See PacketCodec.decode_payload().
+		"""
+		return cls.CODEC.decode_payload(raw,out=out)
+
+	@classmethod
+	def FromByteString(cls,bytestr):
+		"""
+		Parse packet header and data from the given byte string, return an object of type Packet
+		"""
+		# check correct size packet
+		cls.CODEC.check_length(bytestr)
+		raw = frombuffer(bytestr,dtype=uint8).reshape((1,cls.BYTES_IN_PACKET))
+		# unpack header
+		hdr = cls._unpack_header(cls._header_view(raw))
+		ut,pktnum,did,ifid,ud0,ud1,res0,res1 = [h[0] for h in hdr[:-1]]
+		fnt = bool(hdr[-1][0])
+		data = cls._decode_payload(raw)[0]
+		return cls(ut,pktnum,did,ifid,ud0,ud1,res0,res1,fnt,data)
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+
+from capture import MultiPortCapture, PacketStream
+from numpy import concatenate
+from packet_batch import PacketBatch
+from packet_ring import PacketRing
+from pipeline import DecodePipeline
+from sequence import SequenceTracker
+from socket import socket, AF_INET, SOCK_DGRAM
+from socket_tuning import KernelDropMonitor, failed_options, tune_socket
+from spool import SpoolWriter
+from stats import monotonic
+
+class DataCapture(object):
+	"""
+	Receive the 10GbE packet streams of a DAQ.
+
+	Holds the data socket and multi-port capture methods shared by the
+	He6CRES_DAQ classes of the 8-bit and 16-bit bitcode, which differ only
+	in the packet class set as _PACKET. The class expects _stats to be a
+	PipelineStats and, for open_capture(), implemented_digital_channels
+	to be known.
+	"""
+
+	# packet class of the bitcode, set by subclasses
+	_PACKET = None
+
+	def grab_packets(self,n=1,dsoc_desc=None,close_soc=False,raw=False):
+		"""
+		Grab packets using open data socket.
+
+		Calls to this method should only be made while a data socket is
+		open, unless a socket descriptor is provided. See open_dsoc() for
+		details.
+
+		Parameters
+		----------
+		n : int
+		    Number of packets to grab, default is 1.
+		dsoc_desc : tuple
+		    Socket descriptor tuple as for open_dsoc() method. If None,
+		    a data socket should already be open. Default is None.
+		close_soc : boolean
+		    Close socket after grabbing the given number of packets.
+		raw : boolean
+		    Return the packets exactly as received instead of decoding
+		    them. Requires a receive ring, see open_dsoc(). Default is
+		    False.
+
+		Returns
+		-------
+		pkts : PacketBatch
+		    The decoded packets in columnar form. Indexing or iterating
+		    over the batch yields Packet objects. The loss attribute holds
+		    the sequence report for these packets, see packet_loss(). If
+		    raw is True this is instead a (n, Packet.BYTES_IN_PACKET) uint8
+		    view into the receive ring, valid until the ring wraps onto
+		    the same slots.
+		"""
+		if not dsoc_desc is None:
+			self.open_dsoc(dsoc_desc)
+		try:
+			dsoc = self._data_socket
+		except AttributeError:
+			raise RuntimeError("No open data socket. Call open_dsoc() first.")
+		stats = self._stats
+		ring = getattr(self,'_ring',None)
+		if not ring is None:
+			pkts = self._grab_ring(dsoc,ring,n,raw)
+		elif raw:
+			raise RuntimeError("Grabbing raw packets requires a receive ring. Call open_dsoc() with ring_slots set.")
+		else:
+			bytestrs = []
+			t0 = monotonic()
+			for ii in xrange(n):
+				bytestrs.append(dsoc.recv(self._PACKET.BYTES_IN_PACKET))
+			stats.add_time('recv',monotonic() - t0)
+			pkts = PacketBatch.FromByteStrings(bytestrs,self._PACKET,stats=stats)
+		stats.count('dsoc',n,n*self._PACKET.BYTES_IN_PACKET)
+		t0 = monotonic()
+		if raw:
+			hdr = self._PACKET._unpack_header(self._PACKET._header_view(pkts))
+			self._sequence.update(hdr[0],hdr[1],hdr[8])
+		else:
+			pkts.loss = self._kernel_drops.annotate(self._sequence.update_batch(pkts))
+		stats.add_time('sequence',monotonic() - t0)
+		if close_soc:
+			self.close_dsoc()
+		return pkts
+
+	def iter_packets(self,batch_size=1024,max_in_flight=4,n=None,dsoc_desc=None,close_soc=False,raw=False,workers=0,max_latency=None):
+		"""
+		Iterate over packets received continuously using open data socket.
+
+		Packets are received on a background thread into a fixed number of
+		buffers and handed out batch by batch, so that an unbounded run
+		can be processed in constant memory. If the consumer falls behind
+		the receiver waits for a free buffer and the kernel queues or
+		drops datagrams, see packet_loss().
+
+		Calls to this method should only be made while a data socket is
+		open, unless a socket descriptor is provided. See open_dsoc() for
+		details.
+
+		Parameters
+		----------
+		batch_size : int
+		    Number of packets per batch, default is 1024.
+		max_in_flight : int
+		    Number of receive buffers of batch_size packets each. Default
+		    is 4.
+		n : int
+		    Stop after this many packets. If None then iterate until the
+		    generator is closed. Default is None.
+		dsoc_desc : tuple
+		    Socket descriptor tuple as for open_dsoc() method. If None,
+		    a data socket should already be open. Default is None.
+		close_soc : boolean
+		    Close socket when iteration ends.
+		raw : boolean
+		    Yield packets exactly as received instead of decoding them,
+		    see PacketStream.batches(). Default is False.
+		workers : int
+		    If positive, receive in a separate process and decode in this
+		    many worker processes over shared memory, see DecodePipeline,
+		    for packet rates beyond what one process can decode. If None
+		    use all but two cores, max_in_flight is then not used.
+		    Default is 0, receive on a thread and decode in the calling
+		    process.
+		max_latency : float
+		    If not None, yield a partial batch once its first packet has
+		    waited this many seconds, for consumers that need data in
+		    time at low packet rates. A partial batch is yielded anyway
+		    when the stream pauses. Default is None.
+
+		Yields
+		------
+		pkts : PacketBatch
+		    Up to batch_size decoded packets, carrying the sequence report
+		    in their loss attribute. If raw is True a view into the receive
+		    buffers, valid until the next iteration. With decode workers
+		    the batches are views into shared memory, also valid until
+		    the next iteration.
+		"""
+		if raw and not workers == 0:
+			raise ValueError("Raw packets are not available with decode workers")
+		if not dsoc_desc is None:
+			self.open_dsoc(dsoc_desc)
+		try:
+			dsoc = self._data_socket
+		except AttributeError:
+			raise RuntimeError("No open data socket. Call open_dsoc() first.")
+		if workers == 0:
+			stream = PacketStream(dsoc,self._PACKET,batch_size=batch_size,max_in_flight=max_in_flight,stats=self._stats,kernel_drops=self._kernel_drops,max_latency=max_latency)
+			batches = stream.batches(n=n,raw=raw)
+		else:
+			stream = DecodePipeline(dsoc,self._PACKET,batch_size=batch_size,workers=workers,stats=self._stats,kernel_drops=self._kernel_drops,max_latency=max_latency)
+			batches = stream.batches(n=n)
+		# account for the stream in packet_loss()
+		self._sequence = stream.tracker
+		stream.start()
+		try:
+			for pkts in batches:
+				yield pkts
+		finally:
+			stream.stop()
+			if close_soc:
+				self.close_dsoc()
+
+	def spool_packets(self,prefix,n=None,batch_size=1024,max_in_flight=8,file_bytes=4<<30,dsoc_desc=None,close_soc=False):
+		"""
+		Write packets to disk exactly as received.
+
+		Packets are received on a background thread as for iter_packets()
+		and appended undecoded to spool files by the calling thread, see
+		SpoolWriter. Spooling stops after n packets or on KeyboardInterrupt.
+
+		Parameters
+		----------
+		prefix : string
+		    Path prefix of the spool files and index, see SpoolWriter.
+		n : int
+		    Number of packets to write. If None then write until
+		    interrupted. Default is None.
+		batch_size : int
+		    Number of packets per write, default is 1024.
+		max_in_flight : int
+		    Number of receive buffers of batch_size packets each, which
+		    absorb stalls of the disk. Default is 8.
+		file_bytes : int
+		    Maximum size of each spool file. Default is 4 GiB.
+		dsoc_desc : tuple
+		    Socket descriptor tuple as for open_dsoc() method. If None,
+		    a data socket should already be open. Default is None.
+		close_soc : boolean
+		    Close socket when spooling ends.
+
+		Returns
+		-------
+		n_written : int
+		    Number of packets written.
+		"""
+		writer = SpoolWriter(prefix,self._PACKET,file_bytes=file_bytes)
+		try:
+			for raw in self.iter_packets(batch_size=batch_size,max_in_flight=max_in_flight,n=n,dsoc_desc=dsoc_desc,close_soc=close_soc,raw=True):
+				with self._stats.stage('write'):
+					writer.write(raw)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			writer.close()
+		return writer.packets_written
+
+	def _grab_ring(self,dsoc,ring,n,raw):
+		"""
+		Receive n packets through the receive ring.
+
+		See grab_packets() for details.
+		"""
+		stats = self._stats
+		if raw:
+			with stats.stage('recv'):
+				return ring.recv(dsoc,n)
+		batches = []
+		rx_time = []
+		for ii in xrange(0,n,ring.slots):
+			with stats.stage('recv'):
+				buf = ring.recv(dsoc,min(ring.slots,n-ii))
+			batches.append(PacketBatch.FromBuffer(buf,self._PACKET,stats=stats))
+			if ring.timestamped:
+				rx_time.append(ring.timestamps(ring.slot_of(buf),buf.shape[0]))
+		if len(batches) == 1:
+			pkts = batches[0]
+		else:
+			pkts = PacketBatch.concatenate(batches)
+		if len(rx_time) > 0:
+			pkts.rx_time = concatenate(rx_time)
+		return pkts
+
+	def open_dsoc(self,dsoc_desc,ring_slots=None,rcvbuf=32<<20,busy_poll=None,timestamps=False):
+		"""
+		Open socket for data reception and bind.
+
+		The requested socket options are read back after they are set and
+		any that did not take effect are reported, see dsoc_options. The
+		kernel drop counter of the socket is followed from here on, see
+		packet_loss().
+
+		Parameters
+		----------
+		dsoc_desc: tuple
+		    Tuple of IP address / hostname and port as passed to socket.bind().
+		ring_slots : int
+		    If not None, receive through a preallocated ring of this many
+		    packet slots. Packets are then received in batches directly
+		    into the ring without per-packet allocation. The ring is kept
+		    when the socket is closed and reopened with the same number
+		    of slots. Default is None.
+		rcvbuf : int
+		    Kernel receive buffer size in bytes, which absorbs bursts while
+		    user space is busy. If None keep the system default. Default
+		    is 32 MiB.
+		busy_poll : int
+		    Microseconds to busy poll the network device on receive
+		    (SO_BUSY_POLL), trading CPU time for latency. If None leave
+		    off. Default is None.
+		timestamps : bool
+		    Enable kernel receive timestamps (SO_TIMESTAMPNS). With a
+		    receive ring the time of every packet is then returned in the
+		    rx_time attribute of grab_packets() batches. Default is False.
+		"""
+		self._data_socket = socket(AF_INET,SOCK_DGRAM)
+		self._dsoc_options = tune_socket(self._data_socket,rcvbuf=rcvbuf,busy_poll=busy_poll,timestamps=timestamps)
+		failed = failed_options(self._dsoc_options)
+		if len(failed) > 0:
+			print "Socket options not applied as requested: {0}".format(
+				", ".join(["{0} (requested {1}, got {2})".format(k,self._dsoc_options[k]['requested'],self._dsoc_options[k]['actual']) for k in failed])
+			)
+		self._data_socket.bind(dsoc_desc)
+		self._sequence = SequenceTracker()
+		self._kernel_drops = KernelDropMonitor(self._data_socket)
+		if ring_slots is None:
+			self._ring = None
+		elif getattr(self,'_ring',None) is None or not self._ring.slots == ring_slots or not self._ring.timestamped == timestamps:
+			self._ring = PacketRing(ring_slots,self._PACKET.BYTES_IN_PACKET,timestamps=timestamps)
+		return self._data_socket
+
+	@property
+	def dsoc_options(self):
+		"""
+		Socket options of the data socket as applied, see tune_socket().
+		"""
+		return self._dsoc_options
+
+	def close_dsoc(self):
+		"""
+		Close socket used for data reception.
+
+		The kernel drop count is read a last time, so that packet_loss()
+		still reports it after the socket is closed.
+		"""
+		self._kernel_drops.close()
+		self._data_socket.close()
+
+	def stats(self,reset=False):
+		"""
+		Return timing and counter statistics of the receive pipeline.
+
+		Stages are recv, parse_header, decode_payload, sequence, consume
+		(time spent by the caller of iter_packets() per batch) and write
+		(spool_packets()), and for grab_packets_all() recv.<channel>,
+		decode.<channel> and merge. With decode workers, see
+		iter_packets(), parse_header and decode_payload are timed in the
+		workers. Ports are named as in packet_loss().
+		Statistics can be read while packets are being received.
+
+		Parameters
+		----------
+		reset : bool
+		    Zero all statistics after reading them. Default is False.
+
+		Returns
+		-------
+		stats : dict
+		    See PipelineStats.snapshot().
+		"""
+		snap = self._stats.snapshot()
+		if reset:
+			self._stats.reset()
+		return snap
+
+	def packet_loss(self):
+		"""
+		Return running sequence accounting of the open data sockets.
+
+		Packets received through grab_packets() since the last call to
+		open_dsoc() are reported under the key 'dsoc', packets received
+		through grab_packets_all() since the last call to open_capture()
+		under the name of their digital channel. Each also holds under
+		'kernel_drops' the datagrams the kernel discarded on that socket
+		before they were read, None where /proc/net/udp is not available.
+
+		Returns
+		-------
+		totals : dict
+		    Maps stream name to SequenceTracker.summary() for the stream.
+		"""
+		totals = dict()
+		if hasattr(self,'_sequence'):
+			totals['dsoc'] = self._sequence.summary()
+			totals['dsoc']['kernel_drops'] = self._kernel_drops.drops(force=True)
+		if hasattr(self,'_capture'):
+			totals.update(self._capture.loss())
+		return totals
+
+	def open_capture(self,host='',dest_port=4001,ring_slots=4096,timeout=None,seq_stride=1,rcvbuf=32<<20,busy_poll=None):
+		"""
+		Open one receive socket per implemented 10GbE core.
+
+		The ports follow the assignment made in _start(), that is the
+		core for the i-th entry in implemented_digital_channels sends to
+		port dest_port+i.
+
+		Parameters
+		----------
+		host : string
+		    IP address / hostname of the data interface as passed to
+		    socket.bind(). Default is '' (all interfaces).
+		dest_port : int
+		    Port of the first 10GbE core. Default is 4001.
+		ring_slots : int
+		    Number of packet slots in the receive ring of each port.
+		    Default is 4096.
+		timeout : float
+		    Socket timeout in seconds, if None then block indefinitely.
+		    Default is None.
+		seq_stride : int
+		    Expected pkt_in_batch increment between consecutive packet
+		    pairs on one port, used for packet-loss accounting. Default is 1.
+		rcvbuf : int
+		    Kernel receive buffer size per port, see open_dsoc(). Default
+		    is 32 MiB.
+		busy_poll : int
+		    SO_BUSY_POLL time in microseconds, see open_dsoc(). Default is
+		    None.
+
+		Returns
+		-------
+		cap : MultiPortCapture
+		    The capture engine, also kept for grab_packets_all().
+		"""
+		try:
+			channels = self.implemented_digital_channels
+		except AttributeError:
+			raise RuntimeError("Implemented digital channels unknown. Call _start() first.")
+		ports = [dest_port+ii for ii in xrange(len(channels))]
+		self._capture = MultiPortCapture(host,ports,self._PACKET,channels=channels,ring_slots=ring_slots,timeout=timeout,seq_stride=seq_stride,stats=self._stats,rcvbuf=rcvbuf,busy_poll=busy_poll)
+		return self._capture
+
+	def grab_packets_all(self,n=1,close_cap=False):
+		"""
+		Grab packets from all 10GbE ports at once.
+
+		Calls to this method should only be made after open_capture().
+
+		Parameters
+		----------
+		n : int
+		    Number of packets to grab per port, default is 1.
+		close_cap : boolean
+		    Close the capture sockets after grabbing the packets.
+
+		Returns
+		-------
+		pkts : PacketBatch
+		    Packets from all ports merged into a single stream ordered by
+		    unix_time and pkt_in_batch. The loss attribute maps channel
+		    name to the sequence report of that port for these packets.
+		"""
+		try:
+			cap = self._capture
+		except AttributeError:
+			raise RuntimeError("No open capture. Call open_capture() first.")
+		pkts = cap.grab(n)
+		if close_cap:
+			self.close_capture()
+		return pkts
+
+	def close_capture(self):
+		"""
+		Close sockets used for multi-port data reception.
+		"""
+		self._capture.close()
+		del self._capture
@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+
+from numpy import (
+	abs as np_abs,
+	arange,
+	asarray,
+	bartlett,
+	blackman,
+	concatenate,
+	cos,
+	empty,
+	hamming,
+	hanning,
+	int64,
+	int8,
+	ones,
+	pi,
+	rint,
+	sin,
+	sinc,
+	uint16,
+	uint8,
+	where,
+	zeros,
+	)
+
+class FirmwareModel(object):
+	"""
+	Bit-accurate software model of the He6CRES FPGA signal chain.
+
+	Follows the chain described in the design document, in integer
+	arithmetic with the bit widths of the bitcode:
+
+	    1. Two streams of Fix_8_7 ADC samples, red and blue, are
+	       multiplied sample by sample into Fix_15_14 products.
+	    2. A real polyphase FIR filter bank with taps*2**14 coefficients
+	       of window times sinc, quantized to Fix_<coeff_bits>_<coeff_bits-1>,
+	       filters the products to Fix_<data_bits>_<data_bits-1>.
+	    3. The 2**14 real samples of every frame are packed as 2**13
+	       complex samples (even samples real, odd samples imaginary) and
+	       transformed by a 13-stage radix-2 decimation-in-frequency FFT.
+	       Stage k shifts its outputs right by one bit if bit k of the
+	       shift vector is set, with the least significant bit of the
+	       shift vector for the first stage as in set_fft_shift().
+	       Twiddle factors are Fix_<coeff_bits>_<coeff_bits-1>, data
+	       stays Fix_<data_bits>_<data_bits-1> throughout.
+	    4. The 2**13 spectra of the real input are split from the
+	       complex FFT output without a shift.
+	    5. Real and imaginary parts, sliced to Fix_18_17, are squared
+	       and added to full precision.
+	    6. Groups of BINS/bins adjacent bins are summed to full
+	       precision, if the packets carry fewer than BINS bins.
+	    7. The power is rounded to unsigned output_bits-bit integers with
+	       output_binpt fractional bits and saturated.
+
+	Every rounding is to the nearest value with ties away from zero, and
+	every result outside its bit width is either saturated or wrapped,
+	as set by overflow. The number of values that overflowed is counted
+	per step, see overflows, which shows whether a shift schedule is
+	adequate for given input.
+
+	Parameters that the design document does not fix, such as the
+	number of PFB taps and the window, default to the CASPER library
+	defaults and must match the bitcode for the spectra to agree with
+	packets bit for bit. The same holds for step 6: the 16-bit bitcode
+	sends 4096 bins over the band the 8-bit bitcode sends in 8192, and
+	the model assumes each packet bin is the power of two adjacent
+	bins, so that packet bin b covers bins 2b and 2b+1 of the FFT.
+
+	Only the frequency-domain packets of the stream carry spectra, and
+	8-bit ones are decoded as int8 by He6DAQ.Packet. See compare() for
+	checking model output against a PacketBatch.
+
+	Frames are processed in blocks of spectra, and all steps are
+	vectorized over the frames of a block.
+	"""
+
+	FFT_POINTS = 2**14
+	BINS = 2**13
+	FFT_STAGES = 13
+	ADC_FRAC = 7
+	PRODUCT_BITS = 15
+	PRODUCT_FRAC = 14
+	POWER_BITS = 18
+	WINDOWS = {
+		'hamming' : hamming,
+		'hanning' : hanning,
+		'blackman' : blackman,
+		'bartlett' : bartlett,
+		'rectangular' : ones,
+		}
+	OVERFLOW_MODES = ('saturate','wrap')
+
+	@property
+	def shift_vec(self):
+		return self._shift_vec
+
+	@property
+	def output_bits(self):
+		return self._output_bits
+
+	@property
+	def output_binpt(self):
+		return self._output_binpt
+
+	@property
+	def taps(self):
+		return self._taps
+
+	@property
+	def bins(self):
+		return self._bins
+
+	@property
+	def coefficients(self):
+		"""
+		Quantized PFB coefficients as integers, shape (taps, FFT_POINTS).
+		"""
+		return self._coeffs
+
+	@property
+	def overflows(self):
+		"""
+		Maps each step to the number of values that overflowed since the last reset.
+		"""
+		return dict(self._overflows)
+
+	def __init__(self,shift_vec='1010101010101',output_bits=8,output_binpt=None,taps=4,window='hamming',fwidth=1.0,coeff_bits=18,data_bits=18,overflow='saturate',block=64,bins=None):
+		"""
+		Initialize FirmwareModel.
+
+		Parameters
+		----------
+		shift_vec : string
+		    FFT shift vector as for He6CRES_DAQ.set_fft_shift(). Default
+		    is '1010101010101'.
+		output_bits : int
+		    Bits per output sample, 8 or 16. Default is 8.
+		output_binpt : int
+		    Fractional bits of the output. If None use output_bits-1,
+		    which keeps the most significant bits of the power. Default
+		    is None.
+		taps : int
+		    Number of PFB taps. Default is 4.
+		window : string
+		    PFB window, one of the keys of WINDOWS. Default is 'hamming'.
+		fwidth : float
+		    Width of the PFB sinc in bins. Default is 1.0.
+		coeff_bits : int
+		    Bits of PFB coefficients and FFT twiddle factors. Default is
+		    18.
+		data_bits : int
+		    Bits of PFB output and FFT data. Default is 18.
+		overflow : string
+		    'saturate' or 'wrap' values that do not fit their bit width.
+		    Default is 'saturate'.
+		block : int
+		    Number of frames processed at once, which bounds memory use.
+		    Default is 64.
+		bins : int
+		    Bins per output spectrum, a divisor of BINS. If None use the
+		    number of bins of the packets for output_bits, BINS for 8
+		    and BINS/2 for 16 bits. Default is None.
+		"""
+		if not output_bits in (8,16):
+			raise ValueError("Output should be 8 or 16 bits, got {0}".format(output_bits))
+		if not window in self.WINDOWS:
+			raise ValueError("Unknown window '{0}', should be one of {1}".format(window,sorted(self.WINDOWS.keys())))
+		if not overflow in self.OVERFLOW_MODES:
+			raise ValueError("Unknown overflow mode '{0}', should be one of {1}".format(overflow,self.OVERFLOW_MODES))
+		if taps < 1:
+			raise ValueError("Number of taps should be positive, got {0}".format(taps))
+		if bins is None:
+			bins = self.BINS if output_bits == 8 else self.BINS/2
+		if bins < 1 or not self.BINS % bins == 0:
+			raise ValueError("Number of bins should divide {0}, got {1}".format(self.BINS,bins))
+		self.set_fft_shift(shift_vec)
+		self._output_bits = output_bits
+		self._output_binpt = output_bits - 1 if output_binpt is None else output_binpt
+		self._taps = taps
+		self._bins = bins
+		self._coeff_bits = coeff_bits
+		self._data_bits = data_bits
+		self._overflow = overflow
+		self._block = block
+		self._coeffs = self._pfb_coefficients(taps,window,fwidth)
+		self._twiddles = self._fft_twiddles()
+		n = self.BINS
+		k = arange(n)
+		self._unscramble = self._quantize_twiddle(2*pi*k/(2*n))
+		self._mirror = (n - k) % n
+		# bit-reversed order of the decimation-in-frequency output
+		rev = zeros(n,dtype=int64)
+		for b in xrange(self.FFT_STAGES):
+			rev |= ((k >> b) & 1) << (self.FFT_STAGES - 1 - b)
+		self._bitrev = rev
+		self.reset()
+
+	def set_fft_shift(self,shift_vec):
+		"""
+		Set the FFT shift vector, see He6CRES_DAQ.set_fft_shift().
+		"""
+		s = int(shift_vec,2) & 0x1FFF
+		self._shift_vec = shift_vec
+		self._shifts = [(s >> k) & 1 for k in xrange(self.FFT_STAGES)]
+
+	def reset(self):
+		"""
+		Clear the PFB history, buffered samples and overflow counts.
+		"""
+		self._history = zeros(((self._taps - 1)*self.FFT_POINTS,),dtype=int64)
+		self._pending = empty((0,),dtype=int64)
+		self._overflows = dict()
+
+	def process(self,red,blue):
+		"""
+		Turn red and blue ADC samples into the spectra the packets carry.
+
+		Samples beyond the last whole frame are kept and used by the
+		next call, as is the PFB history, so that a long capture may be
+		passed in pieces of any length.
+
+		Parameters
+		----------
+		red : ndarray
+		    Samples of the first ADC, as int8 or integers in [-128, 127].
+		blue : ndarray
+		    Samples of the second ADC, the same number as red.
+
+		Returns
+		-------
+		x : ndarray
+		    (M, bins)-shaped array of uint8 or uint16 spectra, one per
+		    whole frame of FFT_POINTS samples.
+		"""
+		red = asarray(red).ravel()
+		blue = asarray(blue).ravel()
+		if not len(red) == len(blue):
+			raise ValueError("Need as many red as blue samples, got {0} and {1}".format(len(red),len(blue)))
+		x = concatenate([self._pending,self.product(red,blue)])
+		m = len(x)/self.FFT_POINTS
+		self._pending = x[m*self.FFT_POINTS:]
+		out = empty((m,self._bins),dtype=uint8 if self._output_bits == 8 else uint16)
+		for f in xrange(0,m,self._block):
+			frames = x[f*self.FFT_POINTS:min(f+self._block,m)*self.FFT_POINTS]
+			out[f:f+len(frames)/self.FFT_POINTS] = self.output(self.combine(self.power(*self.fft(self.pfb(frames)))))
+		return out
+
+	def product(self,red,blue):
+		"""
+		Multiply Fix_8_7 samples into Fix_15_14 products.
+
+		Returns
+		-------
+		p : ndarray
+		    Products as int64, 2**14 representing 1.0.
+		"""
+		p = asarray(red,dtype=int64)*asarray(blue,dtype=int64)
+		# only (-1)*(-1) does not fit
+		return self._fit(p,self.PRODUCT_BITS,'product')
+
+	def pfb(self,x):
+		"""
+		Filter whole frames of products with the polyphase FIR.
+
+		Parameters
+		----------
+		x : ndarray
+		    Products from product(), a whole number of frames. The last
+		    taps-1 frames are kept as history for the next call.
+
+		Returns
+		-------
+		y : ndarray
+		    (M, FFT_POINTS)-shaped int64 array with data_bits-1
+		    fractional bits.
+		"""
+		n = self.FFT_POINTS
+		m = len(x)/n
+		h = concatenate([self._history,x])
+		frames = h.reshape((m + self._taps - 1,n))
+		acc = zeros((m,n),dtype=int64)
+		# tap 0 weighs the oldest frame
+		for t in xrange(self._taps):
+			acc += frames[t:t+m]*self._coeffs[t]
+		if self._taps > 1:
+			self._history = h[m*n:]
+		frac = self.PRODUCT_FRAC + self._coeff_bits - 1
+		return self._fit(self._round(acc,frac - (self._data_bits - 1)),self._data_bits,'pfb')
+
+	def fft(self,y):
+		"""
+		Transform frames of real samples with the fixed-point FFT.
+
+		Parameters
+		----------
+		y : ndarray
+		    (M, FFT_POINTS)-shaped array from pfb().
+
+		Returns
+		-------
+		re, im : ndarray
+		    (M, BINS)-shaped int64 arrays with data_bits-1 fractional
+		    bits, bins in natural order from DC.
+		"""
+		m = len(y)
+		n = self.BINS
+		re = y[:,0::2].copy()
+		im = y[:,1::2].copy()
+		cb = self._coeff_bits - 1
+		for s in xrange(self.FFT_STAGES):
+			half = n >> (s + 1)
+			shape = (m,1 << s,2,half)
+			re = re.reshape(shape)
+			im = im.reshape(shape)
+			ar,ai = re[:,:,0,:],im[:,:,0,:]
+			br,bi = re[:,:,1,:],im[:,:,1,:]
+			sr = ar + br
+			si = ai + bi
+			dr = ar - br
+			di = ai - bi
+			wr,wi = self._twiddles[s]
+			# (dr + j di)(wr + j wi), rounded back to data precision
+			tr = self._round(dr*wr - di*wi,cb)
+			ti = self._round(dr*wi + di*wr,cb)
+			sh = self._shifts[s]
+			name = 'fft_{0}'.format(s)
+			out_r = empty(shape,dtype=int64)
+			out_i = empty(shape,dtype=int64)
+			out_r[:,:,0,:] = self._fit(self._round(sr,sh),self._data_bits,name)
+			out_i[:,:,0,:] = self._fit(self._round(si,sh),self._data_bits,name)
+			out_r[:,:,1,:] = self._fit(self._round(tr,sh),self._data_bits,name)
+			out_i[:,:,1,:] = self._fit(self._round(ti,sh),self._data_bits,name)
+			re = out_r.reshape((m,n))
+			im = out_i.reshape((m,n))
+		zr = re[:,self._bitrev]
+		zi = im[:,self._bitrev]
+		return self._split(zr,zi)
+
+	def power(self,re,im):
+		"""
+		Return re**2 + im**2 of parts sliced to Fix_18_17.
+
+		Returns
+		-------
+		p : ndarray
+		    int64 power with 34 fractional bits.
+		"""
+		drop = self._data_bits - self.POWER_BITS
+		if drop > 0:
+			re = self._round(re,drop)
+			im = self._round(im,drop)
+		elif drop < 0:
+			re = re << -drop
+			im = im << -drop
+		re = self._fit(re,self.POWER_BITS,'power')
+		im = self._fit(im,self.POWER_BITS,'power')
+		return re*re + im*im
+
+	def combine(self,p):
+		"""
+		Sum the power of groups of BINS/bins adjacent bins.
+
+		Returns
+		-------
+		p : ndarray
+		    (M, bins)-shaped int64 power, p itself if bins is BINS.
+		"""
+		k = self.BINS/self._bins
+		if k == 1:
+			return p
+		return p.reshape((len(p),self._bins,k)).sum(axis=2)
+
+	def output(self,p):
+		"""
+		Round power from power() to unsigned output samples.
+		"""
+		q = self._round(p,2*(self.POWER_BITS - 1) - self._output_binpt)
+		top = (1 << self._output_bits) - 1
+		over = q > top
+		n = int(over.sum())
+		if n:
+			self._overflows['output'] = self._overflows.get('output',0) + n
+			if self._overflow == 'saturate':
+				q = where(over,top,q)
+			else:
+				q = q & top
+		return q.astype(uint8 if self._output_bits == 8 else uint16)
+
+	@staticmethod
+	def packet_spectra(pkts):
+		"""
+		Return the spectra of the frequency-domain packets in a PacketBatch.
+
+		Returns
+		-------
+		x : ndarray
+		    (M, bins)-shaped array of the unsigned samples the bitcode
+		    sent, 8-bit samples decoded as int8 viewed as uint8.
+		"""
+		data = pkts.data[asarray(pkts.freq_not_time,dtype=bool)]
+		if data.dtype == int8:
+			return data.view(uint8)
+		return data
+
+	def compare(self,x,pkts):
+		"""
+		Compare model spectra with the spectra in a PacketBatch.
+
+		Spectra are matched in order, the first row of x with the first
+		frequency-domain packet, up to the shorter of the two.
+
+		Parameters
+		----------
+		x : ndarray
+		    (M, bins)-shaped spectra from process().
+		pkts : PacketBatch
+		    Received packets, see packet_spectra().
+
+		Returns
+		-------
+		result : dict
+		    'spectra', the number compared, 'mismatched', the number of
+		    them that differ, 'samples', the number of differing
+		    samples, and 'max_error', the largest absolute difference.
+		"""
+		y = self.packet_spectra(pkts)
+		if not x.shape[1] == y.shape[1]:
+			raise ValueError("Model spectra have {0} bins, but packets carry {1}".format(x.shape[1],y.shape[1]))
+		m = min(len(x),len(y))
+		d = np_abs(x[:m].astype(int64) - y[:m].astype(int64))
+		bad = d > 0
+		return dict(spectra=m,mismatched=int(bad.any(axis=1).sum()),samples=int(bad.sum()),max_error=int(d.max()) if m > 0 else 0)
+
+	@staticmethod
+	def interleave_cores(x):
+		"""
+		Return the time series of a snapshot in the layout of He6CRES_DAQ._snap_per_core().
+
+		Parameters
+		----------
+		x : ndarray
+		    (N, 4)-shaped array with columns in spi core order.
+
+		Returns
+		-------
+		t : ndarray
+		    (4N,)-shaped array of samples in the order they were taken.
+		"""
+		return asarray(x)[:,[0,2,1,3]].ravel()
+
+	def _split(self,zr,zi):
+		# X[k] = (Z[k] + conj Z[-k])/2 + W^k (Z[k] - conj Z[-k])/(2j), W = exp(-2 pi j/FFT_POINTS)
+		mr = zr[:,self._mirror]
+		mi = zi[:,self._mirror]
+		er = zr + mr
+		ei = zi - mi
+		# -j (Z[k] - conj Z[-k])
+		or_ = zi + mi
+		oi = mr - zr
+		wr,wi = self._unscramble
+		cb = self._coeff_bits - 1
+		xr = (er << cb) + or_*wr - oi*wi
+		xi = (ei << cb) + or_*wi + oi*wr
+		xr = self._fit(self._round(xr,cb + 1),self._data_bits,'split')
+		xi = self._fit(self._round(xi,cb + 1),self._data_bits,'split')
+		return xr,xi
+
+	def _round(self,v,s):
+		"""
+		Divide by 2**s and round to nearest, ties away from zero.
+		"""
+		if s <= 0:
+			return v << -s if s < 0 else v
+		# v >> 63 is -1 for negative v, which turns the tie of floor((v + h)/2**s) away from zero
+		return (v + ((1 << (s - 1)) + (v >> 63))) >> s
+
+	def _fit(self,v,bits,name):
+		"""
+		Saturate or wrap signed integers to the given number of bits.
+		"""
+		hi = (1 << (bits - 1)) - 1
+		lo = -(1 << (bits - 1))
+		over = (v > hi) | (v < lo)
+		n = int(over.sum())
+		if n == 0:
+			return v
+		self._overflows[name] = self._overflows.get(name,0) + n
+		if self._overflow == 'saturate':
+			return v.clip(lo,hi)
+		return ((v - lo) & ((1 << bits) - 1)) + lo
+
+	def _quantize_twiddle(self,phase):
+		# exp(-j phase) as Fix_<coeff_bits>_<coeff_bits-1>, where 1.0 saturates
+		scale = 1 << (self._coeff_bits - 1)
+		wr = rint(cos(phase)*scale).astype(int64).clip(-scale,scale - 1)
+		wi = rint(-sin(phase)*scale).astype(int64).clip(-scale,scale - 1)
+		return wr,wi
+
+	def _fft_twiddles(self):
+		tw = []
+		for s in xrange(self.FFT_STAGES):
+			ns = self.BINS >> s
+			tw.append(self._quantize_twiddle(2*pi*arange(ns/2)/ns))
+		return tw
+
+	def _pfb_coefficients(self,taps,window,fwidth):
+		n = self.FFT_POINTS
+		total = taps*n
+		h = self.WINDOWS[window](total)*sinc(fwidth*(arange(total)/float(n) - taps/2.0))
+		scale = 1 << (self._coeff_bits - 1)
+		c = rint(h*scale).astype(int64).clip(-scale,scale - 1)
+		return c.reshape((taps,n))
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+
+from numpy import (
+	abs as np_abs,
+	array,
+	complexfloating,
+	concatenate,
+	empty,
+	flatnonzero,
+	float32,
+	float64,
+	int64,
+	int8,
+	issubdtype,
+	lexsort,
+	maximum,
+	uint32,
+	uint8,
+	unique,
+	zeros,
+	)
+
+class IntegratedSpectra(object):
+	"""
+	Encapsulate a sequence of integrated spectra in columnar form.
+
+	Every row is the mean or maximum of count consecutive spectra of one
+	(if_id, digital_id) stream. The first spectrum integrated is
+	identified by (start_time, start_pkt) and the last by (stop_time,
+	stop_pkt), the unix_time and pkt_in_batch header fields of those
+	packets.
+	"""
+
+	FIELDS = (
+		'if_id',
+		'digital_id',
+		'start_time',
+		'start_pkt',
+		'stop_time',
+		'stop_pkt',
+		'count',
+		)
+
+	@property
+	def if_id(self):
+		return self._columns['if_id']
+
+	@property
+	def digital_id(self):
+		return self._columns['digital_id']
+
+	@property
+	def start_time(self):
+		return self._columns['start_time']
+
+	@property
+	def start_pkt(self):
+		return self._columns['start_pkt']
+
+	@property
+	def stop_time(self):
+		return self._columns['stop_time']
+
+	@property
+	def stop_pkt(self):
+		return self._columns['stop_pkt']
+
+	@property
+	def count(self):
+		return self._columns['count']
+
+	@property
+	def data(self):
+		return self._data
+
+	@property
+	def bins(self):
+		return self._data.shape[1]
+
+	def __init__(self,columns,data):
+		"""
+		Initialize IntegratedSpectra.
+
+		Parameters
+		----------
+		columns : dict
+		    Maps each name in FIELDS to a (N,)-shaped array.
+		data : ndarray
+		    (N, bins)-shaped array of integrated spectra.
+		"""
+		self._columns = dict((k,columns[k]) for k in self.FIELDS)
+		self._data = data
+
+	def __len__(self):
+		return self._data.shape[0]
+
+	def __repr__(self):
+		return "IntegratedSpectra({0} spectra x {1} bins)".format(len(self),self.bins)
+
+	def __getitem__(self,idx):
+		return IntegratedSpectra(dict((k,v[idx]) for k,v in self._columns.items()),self._data[idx])
+
+class _Accumulation(object):
+	"""
+	Integration in progress for one stream.
+	"""
+
+	def __init__(self,bins,acc_dtype):
+		self.acc = zeros(bins,dtype=acc_dtype)
+		self.n = 0
+		self.count = 0
+		self.start = None
+		self.stop = None
+
+class SpectrumIntegrator(object):
+	"""
+	Integrate consecutive spectra to reduce the output data rate.
+
+	Spectra are integrated separately per (if_id, digital_id) stream, in
+	the order they are given, into accumulators wide enough not to
+	overflow: 64-bit integers for integer samples and 64-bit floats for
+	the power of complex samples. 8-bit samples are taken as the unsigned
+	power the firmware sends. Time-domain packets are skipped. Every n spectra of a stream give one
+	output spectrum, either their mean or their maximum (max-hold). Runs
+	of whole integrations within a batch are reduced in one pass, only
+	integrations that straddle batches are carried over.
+
+	The number of spectra integrated can be changed at any time through
+	the n property. Integrations in progress complete with the n they
+	were started with, the new value applies from the next one.
+	"""
+
+	MODES = ('mean','max')
+
+	@property
+	def n(self):
+		return self._n
+
+	@n.setter
+	def n(self,value):
+		value = int(value)
+		if value < 1:
+			raise ValueError("Number of spectra to integrate should be positive, got {0}".format(value))
+		self._n = value
+
+	@property
+	def mode(self):
+		return self._mode
+
+	@property
+	def packet_cls(self):
+		return self._packet_cls
+
+	@property
+	def pending(self):
+		"""
+		Maps (if_id, digital_id) to the number of spectra in its integration in progress.
+		"""
+		return dict((k,a.count) for k,a in self._streams.items() if a.count > 0)
+
+	def __init__(self,packet_cls,n=16,mode='mean'):
+		"""
+		Initialize SpectrumIntegrator.
+
+		Parameters
+		----------
+		packet_cls : class
+		    Packet class of the stream, which fixes the number of bins and
+		    the sample type.
+		n : int
+		    Number of spectra per integration. Default is 16.
+		mode : string
+		    'mean' to average spectra or 'max' to hold their maximum.
+		    Default is 'mean'.
+		"""
+		if not mode in self.MODES:
+			raise ValueError("Unknown mode '{0}', should be one of {1}".format(mode,self.MODES))
+		self._packet_cls = packet_cls
+		self._mode = mode
+		self.n = n
+		self._bins = packet_cls.CODEC.bins
+		sample_dtype = packet_cls.CODEC.dtype
+		self._complex = issubdtype(sample_dtype,complexfloating)
+		# 8-bit power is sent unsigned, decoded as int8 it would wrap above 127
+		self._unsigned8 = sample_dtype == int8
+		if self._complex:
+			self._acc_dtype = float64
+			self._max_dtype = float32
+		elif self._unsigned8:
+			self._acc_dtype = int64
+			self._max_dtype = uint8
+		else:
+			self._acc_dtype = int64
+			self._max_dtype = sample_dtype
+		self.reset()
+
+	def reset(self):
+		"""
+		Discard all integrations in progress.
+		"""
+		self._streams = dict()
+		self._out = []
+
+	def process(self,pkts,stats=None):
+		"""
+		Integrate a batch of spectra.
+
+		Parameters
+		----------
+		pkts : PacketBatch
+		    Decoded packets, in order of arrival. Only the
+		    frequency-domain packets are integrated.
+		stats : PipelineStats
+		    If not None, record the time taken as stage 'integrate'.
+		    Default is None.
+
+		Returns
+		-------
+		out : IntegratedSpectra
+		    Integrations completed by this batch, ordered by start time.
+		    May be empty.
+		"""
+		if not stats is None:
+			with stats.stage('integrate'):
+				return self.process(pkts)
+		pkts = pkts.spectra()
+		if len(pkts) > 0:
+			key = pkts.if_id.astype(int64) << 6 | pkts.digital_id
+			keys = unique(key)
+			if len(keys) == 1:
+				self._integrate((int(pkts.if_id[0]),int(pkts.digital_id[0])),pkts.data,pkts.unix_time,pkts.pkt_in_batch)
+			else:
+				for k in keys:
+					idx = flatnonzero(key == k)
+					self._integrate((int(k >> 6),int(k & 0x3F)),pkts.data[idx],pkts.unix_time[idx],pkts.pkt_in_batch[idx])
+		return self._collect()
+
+	def flush(self):
+		"""
+		Complete all integrations in progress, with fewer than n spectra.
+
+		Returns
+		-------
+		out : IntegratedSpectra
+		    The partial integrations, ordered by start time.
+		"""
+		for k,a in sorted(self._streams.items()):
+			if a.count > 0:
+				self._emit_partial(k,a)
+		return self._collect()
+
+	def integrate(self,batches,stats=None):
+		"""
+		Integrate an iterable of batches, such as He6CRES_DAQ.iter_packets().
+
+		Yields
+		------
+		out : IntegratedSpectra
+		    Completed integrations, whenever a batch completes any. When
+		    the batches are exhausted the partial integrations are
+		    yielded, see flush().
+		"""
+		for pkts in batches:
+			out = self.process(pkts,stats=stats)
+			if len(out) > 0:
+				yield out
+		out = self.flush()
+		if len(out) > 0:
+			yield out
+
+	def _integrate(self,key,data,unix_time,pkt_in_batch):
+		if self._complex:
+			data = np_abs(data)**2
+		elif self._unsigned8:
+			data = data.view(uint8)
+		a = self._streams.get(key)
+		if a is None:
+			a = _Accumulation(self._bins,self._acc_dtype if self._mode == 'mean' else self._max_dtype)
+			self._streams[key] = a
+		m = len(data)
+		pos = 0
+		# complete the integration carried over from the previous batch
+		if a.count > 0:
+			take = min(a.n - a.count,m)
+			self._accumulate(a,data[:take])
+			a.count = a.count + take
+			a.stop = (unix_time[take-1],pkt_in_batch[take-1])
+			pos = take
+			if a.count == a.n:
+				self._emit_partial(key,a)
+		# whole integrations within this batch
+		n = self._n
+		nb = (m - pos)/n
+		if nb > 0:
+			blocks = data[pos:pos+nb*n].reshape((nb,n,self._bins))
+			if self._mode == 'mean':
+				x = (blocks.sum(axis=1,dtype=self._acc_dtype)/float(n)).astype(float32)
+			else:
+				x = blocks.max(axis=1).astype(self._max_dtype)
+			first = slice(pos,pos+nb*n,n)
+			last = slice(pos+n-1,pos+nb*n,n)
+			self._out.append((key,unix_time[first],pkt_in_batch[first],unix_time[last],pkt_in_batch[last],n,x))
+			pos = pos + nb*n
+		# start the integration to carry over
+		if pos < m:
+			a.n = n
+			a.count = m - pos
+			a.start = (unix_time[pos],pkt_in_batch[pos])
+			a.stop = (unix_time[m-1],pkt_in_batch[m-1])
+			if self._mode == 'mean':
+				data[pos:].sum(axis=0,dtype=self._acc_dtype,out=a.acc)
+			else:
+				data[pos:].max(axis=0,out=a.acc)
+
+	def _accumulate(self,a,data):
+		if self._mode == 'mean':
+			a.acc += data.sum(axis=0,dtype=self._acc_dtype)
+		else:
+			maximum(a.acc,data.max(axis=0),out=a.acc)
+
+	def _emit_partial(self,key,a):
+		if self._mode == 'mean':
+			x = (a.acc/float(a.count)).astype(float32)
+		else:
+			x = a.acc.astype(self._max_dtype)
+		self._out.append((key,array([a.start[0]]),array([a.start[1]]),array([a.stop[0]]),array([a.stop[1]]),a.count,x[None,:]))
+		a.count = 0
+
+	def _collect(self):
+		out = self._out
+		self._out = []
+		if len(out) == 0:
+			columns = dict((k,empty(0,dtype=uint32)) for k in IntegratedSpectra.FIELDS)
+			dt = float32 if self._mode == 'mean' else self._max_dtype
+			return IntegratedSpectra(columns,empty((0,self._bins),dtype=dt))
+		lens = [len(o[-1]) for o in out]
+		columns = dict(
+			if_id=concatenate([[o[0][0]]*l for o,l in zip(out,lens)]).astype(uint8),
+			digital_id=concatenate([[o[0][1]]*l for o,l in zip(out,lens)]).astype(uint8),
+			start_time=concatenate([o[1] for o in out]).astype(uint32),
+			start_pkt=concatenate([o[2] for o in out]).astype(uint32),
+			stop_time=concatenate([o[3] for o in out]).astype(uint32),
+			stop_pkt=concatenate([o[4] for o in out]).astype(uint32),
+			count=concatenate([[o[5]]*l for o,l in zip(out,lens)]).astype(uint32),
+			)
+		data = concatenate([o[-1] for o in out])
+		order = lexsort((columns['digital_id'],columns['if_id'],columns['start_pkt'],columns['start_time']))
+		return IntegratedSpectra(dict((k,v[order]) for k,v in columns.items()),data[order])
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+from numpy import (
+	asarray,
+	concatenate,
+	empty,
+	frombuffer,
+	uint8,
+	)
+
+class PacketBatch(object):
+	"""
+	Encapsulate a sequence of He6CRES packets in columnar form.
+
+	Header fields are held as one contiguous array per field and payloads
+	as a single (N, samples) array, so that operations over many packets
+	need not loop in Python. Indexing with an integer returns a Packet
+	view of a single row, indexing with a slice, mask or index array
+	returns a new PacketBatch.
+
+	Batches returned by a capture carry the sequence accounting for the
+	captured packets in the loss attribute, see SequenceTracker.update().
+	It is None for batches that are built otherwise. Likewise rx_time
+	holds the kernel receive time of every packet where the capture
+	recorded it, and is None otherwise.
+	"""
+
+	HEADER_FIELDS = (
+		'unix_time',
+		'pkt_in_batch',
+		'digital_id',
+		'if_id',
+		'user_data_0',
+		'user_data_1',
+		'reserved_0',
+		'reserved_1',
+		'freq_not_time',
+		)
+
+	@property
+	def unix_time(self):
+		return self._columns['unix_time']
+
+	@property
+	def pkt_in_batch(self):
+		return self._columns['pkt_in_batch']
+
+	@property
+	def digital_id(self):
+		return self._columns['digital_id']
+
+	@property
+	def if_id(self):
+		return self._columns['if_id']
+
+	@property
+	def user_data_0(self):
+		return self._columns['user_data_0']
+
+	@property
+	def user_data_1(self):
+		return self._columns['user_data_1']
+
+	@property
+	def reserved_0(self):
+		return self._columns['reserved_0']
+
+	@property
+	def reserved_1(self):
+		return self._columns['reserved_1']
+
+	@property
+	def freq_not_time(self):
+		return self._columns['freq_not_time']
+
+	@property
+	def data(self):
+		return self._data
+
+	@property
+	def bins(self):
+		return self._data.shape[1]
+
+	@property
+	def packet_cls(self):
+		return self._packet_cls
+
+	def __init__(self,columns,data,packet_cls):
+		"""
+		Initialize PacketBatch from header columns and payload data.
+
+		Parameters
+		----------
+		columns : dict
+		    Maps each name in HEADER_FIELDS to a (N,)-shaped array.
+		data : ndarray
+		    (N, samples)-shaped array of decoded payloads.
+		packet_cls : class
+		    Packet class used to decode the data and to construct
+		    single-packet views.
+		"""
+		missing = [k for k in self.HEADER_FIELDS if not k in columns]
+		if missing:
+			raise ValueError("Missing header columns {0}".format(missing))
+		for k in self.HEADER_FIELDS:
+			if not len(columns[k]) == len(data):
+				raise ValueError("Column '{0}' has {1} entries, but there are {2} payloads".format(k,len(columns[k]),len(data)))
+		self._columns = dict((k,columns[k]) for k in self.HEADER_FIELDS)
+		self._data = data
+		self._packet_cls = packet_cls
+		self.loss = None
+		self.rx_time = None
+
+	def __len__(self):
+		return self._data.shape[0]
+
+	def __getitem__(self,idx):
+		if isinstance(idx,(int,long)) or (hasattr(idx,'ndim') and idx.ndim == 0):
+			return self.packet(idx)
+		if not isinstance(idx,slice):
+			idx = asarray(idx)
+		return PacketBatch(
+			dict((k,v[idx]) for k,v in self._columns.items()),
+			self._data[idx],
+			self._packet_cls,
+			)
+
+	def __iter__(self):
+		for ii in xrange(len(self)):
+			yield self.packet(ii)
+
+	def __repr__(self):
+		return "PacketBatch({0} packets x {1} samples)".format(len(self),self.bins)
+
+	def packet(self,ii):
+		"""
+		Return a Packet view of a single row.
+
+		The data of the returned Packet shares memory with this batch.
+
+		Parameters
+		----------
+		ii : int
+		    Row index.
+		"""
+		c = self._columns
+		return self._packet_cls(
+			c['unix_time'][ii],
+			c['pkt_in_batch'][ii],
+			c['digital_id'][ii],
+			c['if_id'][ii],
+			c['user_data_0'][ii],
+			c['user_data_1'][ii],
+			c['reserved_0'][ii],
+			c['reserved_1'][ii],
+			bool(c['freq_not_time'][ii]),
+			self._data[ii],
+			)
+
+	def spectra(self):
+		"""
+		Return the frequency-domain packets of the batch.
+
+		The ROACH2 sends a time-domain packet after every frequency-domain
+		packet of a digital channel, see SequenceTracker. Stages that work
+		on spectra take them from here. The batch itself is returned if
+		it holds only frequency-domain packets.
+		"""
+		freq = asarray(self._columns['freq_not_time'],dtype=bool)
+		if freq.all():
+			return self
+		return self[freq]
+
+	def take(self,idx):
+		"""
+		Return a PacketBatch with rows selected (and ordered) by idx.
+		"""
+		return self[asarray(idx)]
+
+	@classmethod
+	def concatenate(cls,batches):
+		"""
+		Concatenate PacketBatch objects.
+
+		Parameters
+		----------
+		batches : sequence
+		    PacketBatch objects, all decoded with the same packet class.
+
+		Returns
+		-------
+		batch : PacketBatch
+		    A new batch holding copies of all rows, in order.
+		"""
+		batches = list(batches)
+		if len(batches) == 0:
+			raise ValueError("Need at least one PacketBatch to concatenate")
+		packet_cls = batches[0].packet_cls
+		if any([not b.packet_cls is packet_cls for b in batches]):
+			raise ValueError("Cannot concatenate batches decoded with different packet classes")
+		columns = dict((k,concatenate([b._columns[k] for b in batches])) for k in cls.HEADER_FIELDS)
+		data = concatenate([b.data for b in batches])
+		return PacketBatch(columns,data,packet_cls)
+
+	@classmethod
+	def FromBuffer(cls,raw,packet_cls,stats=None):
+		"""
+		Decode a buffer of raw packets.
+
+		Parameters
+		----------
+		raw : ndarray
+		    C-contiguous uint8 array of shape (N, BYTES_IN_PACKET) holding
+		    packets exactly as received.
+		packet_cls : class
+		    Packet class that defines the header and payload layout.
+		stats : PipelineStats
+		    If not None, record the time spent in the parse_header and
+		    decode_payload stages. Default is None.
+
+		Returns
+		-------
+		batch : PacketBatch
+		    The header columns and payloads are decoded into new arrays,
+		    raw may be reused afterwards.
+		"""
+		if not raw.flags['C_CONTIGUOUS'] or not raw.ndim == 2 or not raw.shape[1] == packet_cls.BYTES_IN_PACKET:
+			raise ValueError("Raw packet buffer should be a C-contiguous (N, {0}) array".format(packet_cls.BYTES_IN_PACKET))
+		if stats is None:
+			hdr = packet_cls._unpack_header(packet_cls._header_view(raw))
+			data = packet_cls._decode_payload(raw)
+		else:
+			with stats.stage('parse_header'):
+				hdr = packet_cls._unpack_header(packet_cls._header_view(raw))
+			with stats.stage('decode_payload'):
+				data = packet_cls._decode_payload(raw)
+		columns = dict(zip(cls.HEADER_FIELDS,hdr))
+		return PacketBatch(columns,data,packet_cls)
+
+	@classmethod
+	def FromByteStrings(cls,bytestrs,packet_cls,stats=None):
+		"""
+		Decode a sequence of packet byte strings, as returned by socket.recv().
+
+		See FromBuffer() for the stats argument.
+		"""
+		bytestrs = list(bytestrs)
+		for ii,b in enumerate(bytestrs):
+			if not len(b) == packet_cls.BYTES_IN_PACKET:
+				raise ValueError("Packet {0} should comprise {1} bytes, but has {2} bytes".format(ii,packet_cls.BYTES_IN_PACKET,len(b)))
+		if len(bytestrs) == 0:
+			raw = empty((0,packet_cls.BYTES_IN_PACKET),dtype=uint8)
+		else:
+			raw = frombuffer(b''.join(bytestrs),dtype=uint8).reshape((len(bytestrs),packet_cls.BYTES_IN_PACKET))
+		return cls.FromBuffer(raw,packet_cls,stats=stats)
+
+	@classmethod
+	def FromPackets(cls,pkts):
+		"""
+		Build a PacketBatch from a list of Packet objects.
+		"""
+		pkts = list(pkts)
+		if len(pkts) == 0:
+			raise ValueError("Need at least one Packet to build a PacketBatch")
+		packet_cls = type(pkts[0])
+		columns = dict()
+		for k in cls.HEADER_FIELDS:
+			# Packet spells the reserved_1 accessor 'reserverd_1'
+			attr = 'reserverd_1' if k == 'reserved_1' else k
+			columns[k] = asarray([getattr(p,attr) for p in pkts])
+		data = asarray([p.data for p in pkts])
+		return PacketBatch(columns,data,packet_cls)
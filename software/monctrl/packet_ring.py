@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+import ctypes
+import ctypes.util
+import errno
+import mmap
+from select import select
+from stats import monotonic
+from numpy import (
+	dtype,
+	frombuffer,
+	nan,
+	ndarray,
+	uint32,
+	uint64,
+	uint8,
+	where,
+	zeros,
+	)
+
+# only Linux provides recvmmsg(2), fall back to one recv_into() per slot elsewhere
+_MSG_DONTWAIT = 0x40
+_MSG_WAITFORONE = 0x10000
+_SOL_SOCKET = 1
+_SCM_TIMESTAMPNS = 35
+
+# control message holding one struct timespec, as delivered with SO_TIMESTAMPNS
+_CMSG_TIMESTAMP_DTYPE = dtype([
+	('len','=u8'),
+	('level','=i4'),
+	('type','=i4'),
+	('tv_sec','=i8'),
+	('tv_nsec','=i8'),
+	])
+
+class _iovec(ctypes.Structure):
+	_fields_ = [
+		('iov_base',ctypes.c_void_p),
+		('iov_len',ctypes.c_size_t),
+		]
+
+class _msghdr(ctypes.Structure):
+	_fields_ = [
+		('msg_name',ctypes.c_void_p),
+		('msg_namelen',ctypes.c_uint32),
+		('msg_iov',ctypes.POINTER(_iovec)),
+		('msg_iovlen',ctypes.c_size_t),
+		('msg_control',ctypes.c_void_p),
+		('msg_controllen',ctypes.c_size_t),
+		('msg_flags',ctypes.c_int),
+		]
+
+class _mmsghdr(ctypes.Structure):
+	_fields_ = [
+		('msg_hdr',_msghdr),
+		('msg_len',ctypes.c_uint),
+		]
+
+def _load_recvmmsg():
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+		f = libc.recvmmsg
+	except (OSError,AttributeError,TypeError):
+		return None
+	f.argtypes = [ctypes.c_int,ctypes.POINTER(_mmsghdr),ctypes.c_uint,ctypes.c_int,ctypes.c_void_p]
+	f.restype = ctypes.c_int
+	return f
+
+_recvmmsg = _load_recvmmsg()
+
+class PacketRing(object):
+	"""
+	Preallocated ring of fixed-size packet slots.
+
+	The ring is a single page-aligned anonymous memory map that is
+	allocated once. Datagrams are received directly into consecutive
+	slots, with recvmmsg(2) where available and socket.recv_into()
+	otherwise, so that no memory is allocated per packet. Received packets
+	are returned as views into the ring, which remain valid until the ring
+	wraps around onto the same slots.
+	"""
+
+	@property
+	def slots(self):
+		return self._slots.shape[0]
+
+	@property
+	def packet_bytes(self):
+		return self._slots.shape[1]
+
+	@property
+	def batched(self):
+		return self._mmsg is not None
+
+	@property
+	def timestamped(self):
+		return self._ctrl is not None
+
+	def __init__(self,slots,packet_bytes,use_recvmmsg=True,timestamps=False):
+		"""
+		Initialize PacketRing.
+
+		Parameters
+		----------
+		slots : int
+		    Number of packet slots in the ring.
+		packet_bytes : int
+		    Size of each slot, should be the exact size of one datagram.
+		use_recvmmsg : bool
+		    Batch receives through recvmmsg(2) if the platform provides it.
+		    Default is True.
+		timestamps : bool
+		    Keep the kernel receive time of every packet, see
+		    timestamps(). Requires recvmmsg(2) and a socket with
+		    SO_TIMESTAMPNS enabled. Default is False.
+		"""
+		self._buf = mmap.mmap(-1,slots*packet_bytes)
+		self._slots = frombuffer(self._buf,dtype=uint8).reshape((slots,packet_bytes))
+		self._views = [memoryview(self._slots[ii]) for ii in xrange(slots)]
+		self._head = 0
+		self._mmsg = None
+		self._ctrl = None
+		if use_recvmmsg and _recvmmsg is not None:
+			base = self._slots.ctypes.data
+			self._iov = (_iovec*slots)()
+			self._mmsg = (_mmsghdr*slots)()
+			for ii in xrange(slots):
+				self._iov[ii].iov_base = base + ii*packet_bytes
+				self._iov[ii].iov_len = packet_bytes
+				self._mmsg[ii].msg_hdr.msg_iov = ctypes.pointer(self._iov[ii])
+				self._mmsg[ii].msg_hdr.msg_iovlen = 1
+			# view on the msg_len fields so that received sizes can be checked in one go
+			self._msg_len = ndarray(
+				shape=(slots,),
+				dtype=uint32,
+				buffer=self._mmsg,
+				offset=_mmsghdr.msg_len.offset,
+				strides=(ctypes.sizeof(_mmsghdr),),
+				)
+			if timestamps:
+				# one control buffer per slot, msg_controllen is reset before every receive
+				self._ctrl = zeros(slots,dtype=_CMSG_TIMESTAMP_DTYPE)
+				cbase = self._ctrl.ctypes.data
+				for ii in xrange(slots):
+					self._mmsg[ii].msg_hdr.msg_control = cbase + ii*_CMSG_TIMESTAMP_DTYPE.itemsize
+				self._ctrl_len = ndarray(
+					shape=(slots,),
+					dtype=uint64,
+					buffer=self._mmsg,
+					offset=_mmsghdr.msg_hdr.offset + _msghdr.msg_controllen.offset,
+					strides=(ctypes.sizeof(_mmsghdr),),
+					)
+
+	def recv(self,sock,n):
+		"""
+		Receive n packets into consecutive slots of the ring.
+
+		If the n slots following the current position would run past the
+		end of the ring, reception starts again at the first slot so that
+		the returned view is always contiguous.
+
+		Parameters
+		----------
+		sock : socket
+		    Bound datagram socket.
+		n : int
+		    Number of packets to receive, at most the number of slots.
+
+		Returns
+		-------
+		raw : ndarray
+		    C-contiguous (n, packet_bytes) uint8 view into the ring.
+		"""
+		if n > self.slots:
+			raise ValueError("Cannot receive {0} packets into a ring of {1} slots".format(n,self.slots))
+		if self._head + n > self.slots:
+			self._head = 0
+		first = self._head
+		self.recv_at(sock,first,n)
+		self._head = first + n
+		return self._slots[first:first+n]
+
+	def recv_at(self,sock,first,n,stop=None,poll=0.1,max_latency=None):
+		"""
+		Receive packets into the given slots of the ring.
+
+		Unlike recv() this does not move the current position of the ring,
+		so that callers can manage the slots themselves.
+
+		Parameters
+		----------
+		sock : socket
+		    Bound datagram socket.
+		first : int
+		    Index of the first slot to fill.
+		n : int
+		    Number of packets to receive.
+		stop : threading.Event
+		    If not None, wait for data in intervals of poll seconds,
+		    return early once the event is set and return the packets
+		    received so far once none arrived for poll seconds. Default is
+		    None.
+		poll : float
+		    Polling interval in seconds, only used if stop is given.
+		    Default is 0.1.
+		max_latency : float
+		    If not None, also return the packets received so far once the
+		    first of them has waited max_latency seconds, so that a slow
+		    but steady stream is handed on in time. Only used if stop is
+		    given. Default is None.
+
+		Returns
+		-------
+		k : int
+		    Number of packets received into slots first to first+k-1. Less
+		    than n only if stop was given and was set, the stream paused
+		    or max_latency passed.
+		"""
+		if first < 0 or first + n > self.slots:
+			raise ValueError("Slots {0} to {1} are outside a ring of {2} slots".format(first,first+n-1,self.slots))
+		if not stop is None:
+			return self._recv_polled(sock,first,n,stop,poll,max_latency)
+		# recvmmsg() bypasses the timeout emulation of Python sockets, so only use it when blocking
+		if self._mmsg is not None and sock.gettimeout() is None:
+			self._recv_batched(sock,first,n,_MSG_WAITFORONE)
+		else:
+			self._recv_single(sock,first,n)
+		return n
+
+	def slot_view(self,first,n):
+		"""
+		Return a (n, packet_bytes) view of the ring starting at slot first.
+		"""
+		return self._slots[first:first+n]
+
+	def slot_of(self,view):
+		"""
+		Return the index of the slot holding the first packet of a view.
+		"""
+		return (view.__array_interface__['data'][0] - self._slots.__array_interface__['data'][0])/self.packet_bytes
+
+	def timestamps(self,first,n):
+		"""
+		Return the kernel receive times of the packets in n slots.
+
+		Returns
+		-------
+		t : ndarray
+		    Seconds since the epoch as float64, NaN for packets that came
+		    without a timestamp. None if the ring was not created with
+		    timestamps enabled.
+		"""
+		if self._ctrl is None:
+			return None
+		c = self._ctrl[first:first+n]
+		ok = (c['level'] == _SOL_SOCKET) & (c['type'] == _SCM_TIMESTAMPNS)
+		return where(ok,c['tv_sec'] + c['tv_nsec']*1e-9,nan)
+
+	def _recv_polled(self,sock,first,n,stop,poll,max_latency):
+		ii = first
+		deadline = None
+		while ii < first + n and not stop.is_set():
+			wait = poll
+			if not deadline is None:
+				wait = min(poll,deadline - monotonic())
+				if wait <= 0:
+					break
+			readable,_,_ = select([sock],[],[],wait)
+			if not readable:
+				# the stream paused, hand on what has arrived
+				if ii > first:
+					break
+				continue
+			# at least one datagram is queued, take what is there without blocking
+			if self._mmsg is not None:
+				ii = ii + self._recv_batched(sock,ii,first+n-ii,_MSG_DONTWAIT)
+			else:
+				self._recv_single(sock,ii,1)
+				ii = ii + 1
+			if deadline is None and not max_latency is None:
+				deadline = monotonic() + max_latency
+		return ii - first
+
+	def _recv_single(self,sock,first,n):
+		nbytes = self.packet_bytes
+		if self._ctrl is not None:
+			# recv_into() delivers no control messages
+			self._ctrl['type'][first:first+n] = 0
+		for ii in xrange(first,first+n):
+			got = sock.recv_into(self._views[ii],nbytes)
+			if not got == nbytes:
+				raise ValueError("Packet should comprise {0} bytes, but has {1} bytes".format(nbytes,got))
+
+	def _recv_batched(self,sock,first,n,flags):
+		fd = sock.fileno()
+		nbytes = self.packet_bytes
+		size = ctypes.sizeof(_mmsghdr)
+		base = ctypes.addressof(self._mmsg)
+		if self._ctrl is not None:
+			self._ctrl_len[first:first+n] = _CMSG_TIMESTAMP_DTYPE.itemsize
+			self._ctrl['type'][first:first+n] = 0
+		ii = first
+		while ii < first + n:
+			vec = ctypes.cast(base + ii*size,ctypes.POINTER(_mmsghdr))
+			got = _recvmmsg(fd,vec,first+n-ii,flags,None)
+			if got < 0:
+				err = ctypes.get_errno()
+				if err == errno.EINTR:
+					continue
+				if err in (errno.EAGAIN,errno.EWOULDBLOCK) and flags & _MSG_DONTWAIT:
+					break
+				raise IOError(err,"recvmmsg failed")
+			ii = ii + got
+			if flags & _MSG_DONTWAIT:
+				break
+		bad = self._msg_len[first:ii] != nbytes
+		if bad.any():
+			raise ValueError("Packet should comprise {0} bytes, but has {1} bytes".format(nbytes,self._msg_len[first:ii][bad][0]))
+		return ii - first
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+from numpy import frombuffer
+from packet_batch import PacketBatch
+from packet_ring import PacketRing
+from sequence import SequenceTracker
+from stats import monotonic
+import mmap
+import multiprocessing
+import traceback
+
+# alignment of the arrays carved out of the shared output region
+_ALIGN = 64
+
+class _SharedBatches(object):
+	"""
+	Fixed number of decoded batch slabs in one shared anonymous memory map.
+
+	Every header column and the payload data are laid out as arrays with
+	the slab index as first axis, so that a worker in another process can
+	decode straight into a slab and the consumer can take views of it.
+	The map is shared with processes forked after it was created.
+	"""
+
+	def __init__(self,packet_cls,slabs,batch_size):
+		codec = packet_cls.CODEC
+		layout = [(k,dt,(slabs,batch_size)) for k,dt in zip(PacketBatch.HEADER_FIELDS,codec.HEADER_COLUMN_DTYPES)]
+		layout.append(('data',codec.dtype,(slabs,batch_size,codec.bins)))
+		offsets = []
+		size = 0
+		for k,dt,shape in layout:
+			offsets.append(size)
+			nbytes = dt.itemsize
+			for s in shape:
+				nbytes = nbytes*s
+			size = size + (nbytes + _ALIGN - 1)/_ALIGN*_ALIGN
+		self._buf = mmap.mmap(-1,max(size,1))
+		self._arrays = dict()
+		for (k,dt,shape),offset in zip(layout,offsets):
+			count = 1
+			for s in shape:
+				count = count*s
+			self._arrays[k] = frombuffer(self._buf,dtype=dt,count=count,offset=offset).reshape(shape)
+
+	def columns(self,slab,k):
+		"""
+		Return the header columns of the first k packets of a slab as views.
+		"""
+		return dict((name,self._arrays[name][slab,:k]) for name in PacketBatch.HEADER_FIELDS)
+
+	def data(self,slab,k):
+		"""
+		Return the payload data of the first k packets of a slab as a view.
+		"""
+		return self._arrays['data'][slab,:k]
+
+class DecodePipeline(object):
+	"""
+	Receive and decode packets in separate processes over shared memory.
+
+	A lean receiver process does nothing but receive datagrams into the
+	slabs of a shared PacketRing, each slab batch_size slots, and hand
+	the index of every slab to a pool of decoder processes once it is
+	filled, or once the stream pauses with packets in it. A
+	decoder unpacks the headers and decodes the payloads of a slab
+	directly into a slab of a second shared region and hands its index
+	back to the consumer, which restores the order of arrival. Only slab
+	indices and timings go through the queues between processes, packet
+	data is never pickled, so that decoding scales with the number of
+	cores rather than being bound by the interpreter lock of one process.
+
+	Both regions are allocated once when the pipeline is constructed.
+	When the consumer falls behind, decoders wait for free output slabs
+	and the receiver waits for free input slabs, so memory is bounded
+	and the kernel socket buffer absorbs the backlog.
+
+	Processes are forked by start(), so the pipeline is only available
+	where multiprocessing forks, as on Linux.
+	"""
+
+	@property
+	def batch_size(self):
+		return self._batch_size
+
+	@property
+	def workers(self):
+		return self._workers
+
+	@property
+	def in_slabs(self):
+		return self._in_slabs
+
+	@property
+	def out_slabs(self):
+		return self._out_slabs
+
+	@property
+	def tracker(self):
+		return self._tracker
+
+	def __init__(self,sock,packet_cls,batch_size=1024,workers=None,in_slabs=None,out_slabs=None,poll=0.1,stats=None,name='dsoc',kernel_drops=None,max_latency=None):
+		"""
+		Initialize DecodePipeline and allocate its shared memory.
+
+		Parameters
+		----------
+		sock : socket
+		    Bound datagram socket. The pipeline does not close it.
+		packet_cls : class
+		    Packet class that defines the header and payload layout.
+		batch_size : int
+		    Number of packets per slab. Default is 1024.
+		workers : int
+		    Number of decoder processes. If None use all but two cores,
+		    which are left to the receiver and the consumer, and at least
+		    one. Default is None.
+		in_slabs : int
+		    Number of raw packet slabs. If None use two per decoder plus
+		    two. Default is None.
+		out_slabs : int
+		    Number of decoded batch slabs. If None use two per decoder
+		    plus two. Default is None.
+		poll : float
+		    Interval in seconds at which the receiver checks for a stop
+		    request while waiting for data. A partially filled slab is
+		    handed to the decoders once no packet arrived for this long.
+		    Default is 0.1.
+		stats : PipelineStats
+		    If not None, record the recv, parse_header and
+		    decode_payload stages as timed in the receiver and
+		    decoders, as for decoding in the calling process, the
+		    sequence and consume stages,
+		    the packet counters under name and the number of decoded
+		    slabs waiting to be put back in order as the reorder gauge.
+		    Default is None.
+		name : string
+		    Port name for the packet counters. Default is 'dsoc'.
+		kernel_drops : KernelDropMonitor
+		    If not None, add the datagrams discarded by the kernel to the
+		    sequence report of every batch, read at most once per
+		    interval of the monitor. Default is None.
+		max_latency : float
+		    If not None, hand a partially filled slab to the decoders
+		    once its first packet has waited this many seconds, see
+		    PacketRing.recv_at(). Default is None.
+		"""
+		if workers is None:
+			workers = max(1,multiprocessing.cpu_count() - 2)
+		if workers < 1:
+			raise ValueError("Need at least one decoder, got {0}".format(workers))
+		if in_slabs is None:
+			in_slabs = 2*workers + 2
+		if out_slabs is None:
+			out_slabs = 2*workers + 2
+		if in_slabs < 1 or out_slabs < 1:
+			raise ValueError("Need at least one input and one output slab")
+		self._sock = sock
+		self._packet_cls = packet_cls
+		self._batch_size = batch_size
+		self._workers = workers
+		self._in_slabs = in_slabs
+		self._out_slabs = out_slabs
+		self._poll = poll
+		self._max_latency = max_latency
+		self._stats = stats
+		self._name = name
+		self._kernel_drops = kernel_drops
+		# anonymous maps are shared with the processes forked by start()
+		self._ring = PacketRing(batch_size*in_slabs,packet_cls.BYTES_IN_PACKET)
+		self._out = _SharedBatches(packet_cls,out_slabs,batch_size)
+		self._in_free = multiprocessing.Queue()
+		self._out_free = multiprocessing.Queue()
+		self._work = multiprocessing.Queue()
+		self._done = multiprocessing.Queue()
+		for ii in xrange(in_slabs):
+			self._in_free.put(ii)
+		for ii in xrange(out_slabs):
+			self._out_free.put(ii)
+		self._stop = multiprocessing.Event()
+		self._procs = []
+		self._tracker = SequenceTracker()
+
+	def start(self):
+		"""
+		Start the receiver and decoder processes.
+		"""
+		if len(self._procs) > 0:
+			raise RuntimeError("DecodePipeline already started")
+		procs = [multiprocessing.Process(target=self._receive,name="rx-pipeline")]
+		for ii in xrange(self._workers):
+			procs.append(multiprocessing.Process(target=self._decode,name="decode-{0}".format(ii)))
+		for p in procs:
+			p.daemon = True
+			p.start()
+			self._procs.append(p)
+
+	def stop(self,timeout=None):
+		"""
+		Ask the receiver and decoders to stop and wait for them to finish.
+
+		Processes still running after timeout seconds are terminated.
+		"""
+		self._stop.set()
+		# unblock a receiver waiting for a free input slab and decoders waiting for a free output slab
+		self._in_free.put(None)
+		for ii in xrange(self._workers):
+			self._out_free.put(None)
+		for p in self._procs:
+			p.join(timeout)
+		for p in self._procs:
+			if p.is_alive():
+				p.terminate()
+				p.join()
+
+	def is_alive(self):
+		"""
+		Return True while any process of the pipeline runs.
+		"""
+		return any([p.is_alive() for p in self._procs])
+
+	def batches(self,n=None,copy=False):
+		"""
+		Iterate over decoded packets batch by batch, in order of arrival.
+
+		Parameters
+		----------
+		n : int
+		    Stop after this many packets in total. If None then continue
+		    until stop() is called. Default is None.
+		copy : bool
+		    If True yield batches that own their memory. Otherwise yield
+		    batches of views into the shared output region, each valid
+		    until the next iteration. Default is False.
+
+		Yields
+		------
+		pkts : PacketBatch
+		    Up to batch_size packets, carrying the sequence report in
+		    their loss attribute.
+		"""
+		count = 0
+		seq = 0
+		running = self._workers
+		pending = dict()
+		held = None
+		stats = self._stats
+		try:
+			while n is None or count < n:
+				# decoders finish out of order, hold slabs until their turn comes
+				while not seq in pending and running > 0:
+					item = self._done.get()
+					if item is None:
+						running = running - 1
+					elif len(item) == 2:
+						raise RuntimeError("Decode pipeline {0} failed:\n{1}".format(item[0],item[1]))
+					else:
+						pending[item[0]] = item[1:]
+				if not seq in pending:
+					break
+				slab,k,t_recv,t_header,t_payload = pending.pop(seq)
+				seq = seq + 1
+				held = slab
+				if not stats is None:
+					stats.add_time('recv',t_recv)
+					stats.add_time('parse_header',t_header)
+					stats.add_time('decode_payload',t_payload)
+					stats.count(self._name,k,k*self._packet_cls.BYTES_IN_PACKET)
+					stats.gauge('reorder',len(pending),self._out_slabs)
+				if not n is None:
+					k = min(k,n-count)
+				columns = self._out.columns(slab,k)
+				t0 = monotonic()
+				report = self._tracker.update(columns['unix_time'],columns['pkt_in_batch'],columns['freq_not_time'])
+				if not self._kernel_drops is None:
+					self._kernel_drops.annotate(report)
+				if not stats is None:
+					stats.add_time('sequence',monotonic() - t0)
+				count = count + k
+				pkts = PacketBatch(columns,self._out.data(slab,k),self._packet_cls)
+				if copy:
+					pkts = PacketBatch.concatenate([pkts])
+					held = None
+					self._out_free.put(slab)
+				pkts.loss = report
+				t0 = monotonic()
+				yield pkts
+				if not stats is None:
+					stats.add_time('consume',monotonic() - t0)
+				if not held is None:
+					held = None
+					self._out_free.put(slab)
+		finally:
+			if not held is None:
+				self._out_free.put(held)
+			for item in pending.values():
+				self._out_free.put(item[0])
+
+	def _receive(self):
+		seq = 0
+		bs = self._batch_size
+		try:
+			while not self._stop.is_set():
+				slab = self._in_free.get()
+				if slab is None:
+					break
+				t0 = monotonic()
+				k = self._ring.recv_at(self._sock,slab*bs,bs,stop=self._stop,poll=self._poll,max_latency=self._max_latency)
+				if k > 0:
+					self._work.put((seq,slab,k,monotonic() - t0))
+					seq = seq + 1
+				else:
+					self._in_free.put(slab)
+		except Exception:
+			self._done.put(('receiver',traceback.format_exc()))
+		for ii in xrange(self._workers):
+			self._work.put(None)
+
+	def _decode(self):
+		bs = self._batch_size
+		cls = self._packet_cls
+		try:
+			while True:
+				# take an output slab before a job, so that a job taken can always be finished
+				out = self._out_free.get()
+				if out is None:
+					break
+				item = self._work.get()
+				if item is None:
+					break
+				seq,slab,k,t_recv = item
+				t0 = monotonic()
+				raw = self._ring.slot_view(slab*bs,k)
+				hdr = cls._unpack_header(cls._header_view(raw))
+				columns = self._out.columns(out,k)
+				for name,x in zip(PacketBatch.HEADER_FIELDS,hdr):
+					columns[name][:] = x
+				t1 = monotonic()
+				cls._decode_payload(raw,out=self._out.data(out,k))
+				self._in_free.put(slab)
+				self._done.put((seq,out,k,t_recv,t1 - t0,monotonic() - t1))
+		except Exception:
+			self._done.put((multiprocessing.current_process().name,traceback.format_exc()))
+		self._done.put(None)
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+
+import argparse
+import multiprocessing
+import sys
+import threading
+from capture import PacketStream
+from sequence import SequenceTracker
+from numpy import (
+	arange,
+	asarray,
+	concatenate,
+	diff,
+	flatnonzero,
+	iinfo,
+	int64,
+	minimum,
+	uint32,
+	uint64,
+	uint8,
+	where,
+	zeros,
+	)
+from numpy.random import RandomState
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_RCVBUF, SO_SNDBUF
+from time import sleep, time
+
+def encode_packets(packet_cls,data,unix_time,pkt_in_batch,digital_id=0,if_id=0,freq_not_time=True,out=None):
+	"""
+	Build raw packets, the inverse of Packet.FromByteString.
+
+	Parameters
+	----------
+	packet_cls : class
+	    Packet class that defines the header and payload layout.
+	data : ndarray
+	    (N, samples) array of payload samples.
+	unix_time : ndarray or int
+	    unix_time header field, per packet or for all packets.
+	pkt_in_batch : ndarray or int
+	    pkt_in_batch header field, per packet or for all packets. Only the
+	    low 20 bits are sent.
+	digital_id : ndarray or int
+	    digital_id header field. Default is 0.
+	if_id : ndarray or int
+	    if_id header field. Default is 0.
+	freq_not_time : ndarray or bool
+	    freq_not_time header flag, per packet or for all packets.
+	    Default is True.
+	out : ndarray
+	    If given, a C-contiguous (N, BYTES_IN_PACKET) uint8 array to
+	    write the packets into. Default is None.
+
+	Returns
+	-------
+	raw : ndarray
+	    (N, BYTES_IN_PACKET) uint8 array of packets as sent by the ROACH2.
+	"""
+	data = asarray(data)
+	n = data.shape[0]
+	if out is None:
+		out = zeros((n,packet_cls.BYTES_IN_PACKET),dtype=uint8)
+	pack_headers(packet_cls,out,unix_time,pkt_in_batch,digital_id,if_id,freq_not_time)
+	packet_cls.CODEC.encode_payload(out,data)
+	return out
+
+def pack_headers(packet_cls,raw,unix_time,pkt_in_batch,digital_id=0,if_id=0,freq_not_time=True):
+	"""
+	Write the header fields of the packets in raw in place.
+
+	See encode_packets() for the parameters. The payload is left as is.
+	"""
+	hdr = packet_cls._header_view(raw)
+	id_word = (asarray(if_id,dtype=uint32) & 0x3F) << 26
+	id_word = id_word | (asarray(digital_id,dtype=uint32) & 0x3F) << 20
+	id_word = id_word | (asarray(pkt_in_batch,dtype=uint32) & 0xFFFFF)
+	hdr['id_word'] = id_word
+	hdr['unix_time'] = unix_time
+	hdr['user_data_0'] = 0
+	hdr['user_data_1'] = 0
+	hdr['reserved_0'] = 0
+	hdr['reserved_1'] = where(asarray(freq_not_time,dtype=bool),uint64(0x8000000000000000),uint64(0))
+
+def synthetic_spectra(packet_cls,n,tones=(),seed=None):
+	"""
+	Generate noise-like spectra with optional narrow-band tones.
+
+	Parameters
+	----------
+	packet_cls : class
+	    Packet class whose payload sample type is used.
+	n : int
+	    Number of spectra.
+	tones : list
+	    Frequency bins at which a tone is added. Default is ().
+	seed : int
+	    Seed for the random number generator. Default is None.
+
+	Returns
+	-------
+	x : ndarray
+	    (n, samples) array of payload samples.
+	"""
+	codec = packet_cls.CODEC
+	rng = RandomState(seed)
+	if codec.sample_type == 'complex':
+		# complex noise with 8-bit parts, tones at full scale
+		re = rng.normal(0,16.0,(n,codec.bins)).clip(-127,127).round()
+		im = rng.normal(0,16.0,(n,codec.bins)).clip(-127,127).round()
+		x = (re + 1j*im).astype(codec.dtype)
+		for t in tones:
+			x[:,t] = 127
+		return x
+	top = iinfo(codec.dtype).max
+	x = minimum(rng.exponential(top/16.0,(n,codec.bins)),top)
+	for t in tones:
+		x[:,t] = top
+	return x.astype(codec.dtype)
+
+class PacketReplay(object):
+	"""
+	Emulate the 10GbE packet streams of the ROACH2 over UDP.
+
+	Each port receives the stream of one digital channel: port
+	dest_port+i carries digital_id i, as configured by
+	He6CRES_DAQ._start(). Spectra are taken in turn from a pool that is
+	encoded once, only the headers are rewritten before sending.
+
+	Packets are sent in bursts of burst packets per port, scheduled
+	against an absolute timeline so that the mean rate does not drift.
+	Packets are numbered per port and sent as the frequency- and
+	time-domain packet pairs of the ROACH2: packet s carries pkt_in_batch
+	s/2 modulo SequenceTracker.COUNTS_PER_WINDOW and has freq_not_time
+	set if s is even. Loss and reordering are applied to the packet
+	numbers: a lost packet consumes a number without being sent and a
+	reordered packet swaps numbers with its successor, so that the
+	receiving SequenceTracker reports them as lost and out of order. The
+	numbers injected are returned by run() for comparison.
+	"""
+
+	# counters are drawn in blocks of this size
+	BLOCK = 1024
+
+	@property
+	def ports(self):
+		return list(self._ports)
+
+	@property
+	def rate(self):
+		return self._rate
+
+	def __init__(self,packet_cls,host='127.0.0.1',dest_port=4001,ports=1,rate=1e4,burst=1,loss=0.0,reorder=0.0,spectra=None,if_id=0,seed=None):
+		"""
+		Initialize PacketReplay and encode the spectrum pool.
+
+		Parameters
+		----------
+		packet_cls : class
+		    Packet class that defines the header and payload layout.
+		host : string
+		    Destination IP address / hostname. Default is '127.0.0.1'.
+		dest_port : int
+		    Port of the first channel. Default is 4001.
+		ports : int
+		    Number of channels, sent to consecutive ports. Default is 1.
+		rate : float
+		    Packets per second per port. Default is 1e4.
+		burst : int
+		    Packets sent back to back per port at each tick. Default is 1.
+		loss : float
+		    Probability that a packet is dropped. Default is 0.0.
+		reorder : float
+		    Probability that a packet is swapped with its successor.
+		    Default is 0.0.
+		spectra : ndarray
+		    (M, samples) array of spectra to replay, for example the data
+		    of a PacketBatch. If None then 64 synthetic spectra are used.
+		    Default is None.
+		if_id : int
+		    if_id header field of all packets. Default is 0.
+		seed : int
+		    Seed for loss and reordering. Default is None.
+		"""
+		if rate <= 0 or burst < 1:
+			raise ValueError("Rate and burst should be positive, got rate={0} and burst={1}".format(rate,burst))
+		if spectra is None:
+			spectra = synthetic_spectra(packet_cls,64,seed=seed)
+		self._packet_cls = packet_cls
+		self._host = host
+		self._ports = [dest_port+ii for ii in xrange(ports)]
+		self._rate = float(rate)
+		self._burst = int(burst)
+		self._loss = loss
+		self._reorder = reorder
+		self._if_id = if_id
+		self._rng = RandomState(seed)
+		self._pool = encode_packets(packet_cls,spectra,0,0,if_id=if_id)
+		self._views = [memoryview(self._pool[ii]) for ii in xrange(self._pool.shape[0])]
+		self._pool_next = 0
+		self._next_count = [0]*ports
+		self._last_kept = [-1]*ports
+		self._pending = [zeros((3,0),dtype=int64) for p in self._ports]
+		self._stats = [dict(sent=0,dropped=0,reordered=0) for p in self._ports]
+		self._stop = threading.Event()
+		self._thread = None
+		self._sock = socket(AF_INET,SOCK_DGRAM)
+		self._sock.setsockopt(SOL_SOCKET,SO_SNDBUF,4<<20)
+
+	def close(self):
+		"""
+		Stop sending and close the socket.
+		"""
+		self.stop()
+		self._sock.close()
+
+	def start(self,n=None,duration=None):
+		"""
+		Run the replay on a background thread, see run().
+		"""
+		if not self._thread is None and self._thread.is_alive():
+			raise RuntimeError("PacketReplay already running")
+		self._stop.clear()
+		self._thread = threading.Thread(target=self.run,args=(n,duration),name="replay")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self,timeout=None):
+		"""
+		Ask a background replay to stop and wait for it to finish.
+		"""
+		self._stop.set()
+		if not self._thread is None:
+			self._thread.join(timeout)
+
+	def join(self,timeout=None):
+		"""
+		Wait for a background replay to finish.
+		"""
+		if not self._thread is None:
+			self._thread.join(timeout)
+
+	def run(self,n=None,duration=None):
+		"""
+		Send packets until n per port are sent, duration has passed or
+		stop() is called.
+
+		Parameters
+		----------
+		n : int
+		    Packets to send per port, dropped ones not included. If None
+		    then no limit. Default is None.
+		duration : float
+		    Seconds to send for. If None then no limit. Default is None.
+
+		Returns
+		-------
+		stats : dict
+		    Per port dicts of sent, dropped and reordered packets under
+		    'ports', the elapsed time and the achieved send rate per port.
+		"""
+		period = self._burst/self._rate
+		t0 = time()
+		tick = 0
+		done = 0
+		while not self._stop.is_set():
+			if not n is None and done >= n:
+				break
+			if not duration is None and time() - t0 >= duration:
+				break
+			self._wait_until(t0 + tick*period)
+			k = self._burst if n is None else min(self._burst,n-done)
+			ut = int(time())
+			for ii,port in enumerate(self._ports):
+				self._send_burst(ii,port,k,ut)
+			done = done + k
+			tick = tick + 1
+		elapsed = time() - t0
+		sent = sum(s['sent'] for s in self._stats)
+		return dict(
+			ports=dict((port,dict(s)) for port,s in zip(self._ports,self._stats)),
+			elapsed=elapsed,
+			rate=sent/float(len(self._ports))/elapsed if elapsed > 0 else 0.0,
+			)
+
+	def _wait_until(self,t):
+		# sleep for the bulk of the wait, then spin for precision
+		while True:
+			dt = t - time()
+			if dt <= 0:
+				return
+			if dt > 2e-3:
+				sleep(dt - 1e-3)
+
+	def _counters(self,ii,k):
+		"""
+		Return the next k counters of port ii after loss and reordering.
+		"""
+		# rows are counter, packets dropped just before it and swap flag, so
+		# that injected faults are accounted for when the packet is sent
+		while self._pending[ii].shape[1] < k:
+			c0 = self._next_count[ii]
+			self._next_count[ii] = c0 + self.BLOCK
+			block = arange(c0-1,c0+self.BLOCK,dtype=int64)
+			block[0] = self._last_kept[ii]
+			if self._loss > 0:
+				keep = self._rng.random_sample(self.BLOCK) >= self._loss
+				block = block[concatenate(([True],keep))]
+			counters = zeros((3,len(block)-1),dtype=int64)
+			counters[0] = block[1:]
+			counters[1] = diff(block) - 1
+			if len(block) > 1:
+				self._last_kept[ii] = block[-1]
+			if self._reorder > 0 and counters.shape[1] > 1:
+				jj = flatnonzero(self._rng.random_sample(counters.shape[1]-1) < self._reorder)
+				# keep the swapped pairs apart
+				jj = jj[concatenate(([True],diff(jj) > 1))] if len(jj) else jj
+				counters[2,jj] = 1
+				counters[:,jj],counters[:,jj+1] = counters[:,jj+1].copy(),counters[:,jj].copy()
+			self._pending[ii] = concatenate((self._pending[ii],counters),axis=1)
+		out = self._pending[ii][:,:k]
+		self._pending[ii] = self._pending[ii][:,k:]
+		self._stats[ii]['dropped'] = self._stats[ii]['dropped'] + int(out[1].sum())
+		self._stats[ii]['reordered'] = self._stats[ii]['reordered'] + int(out[2].sum())
+		return out[0]
+
+	def _send_burst(self,ii,port,k,ut):
+		counters = self._counters(ii,k)
+		m = self._pool.shape[0]
+		dest = (self._host,port)
+		first = 0
+		while first < len(counters):
+			# headers are written for a contiguous run of the pool at once
+			jj = self._pool_next
+			seg = min(len(counters)-first,m-jj)
+			s = counters[first:first+seg]
+			pack_headers(self._packet_cls,self._pool[jj:jj+seg],ut,(s >> 1) % SequenceTracker.COUNTS_PER_WINDOW,digital_id=ii,if_id=self._if_id,freq_not_time=(s & 1) == 0)
+			for view in self._views[jj:jj+seg]:
+				self._sock.sendto(view,dest)
+			self._pool_next = (jj + seg) % m
+			first = first + seg
+		self._stats[ii]['sent'] = self._stats[ii]['sent'] + len(counters)
+
+def measure_rate(packet_cls,rate,n,ports=1,host='127.0.0.1',dest_port=4001,batch_size=1024,grace=0.5,**kwargs):
+	"""
+	Replay n packets per port at the given rate and receive them locally.
+
+	Packets are sent from a separate process. Every port is received
+	through a PacketStream whose batches are decoded, so that the whole
+	host receive and decode path is exercised.
+
+	Parameters
+	----------
+	packet_cls : class
+	    Packet class that defines the header and payload layout.
+	rate : float
+	    Packets per second per port.
+	n : int
+	    Packets to send per port.
+	grace : float
+	    Seconds to wait for stragglers after the last packet is sent.
+	    Default is 0.5.
+	kwargs
+	    Further arguments for PacketReplay.
+
+	Returns
+	-------
+	result : dict
+	    The replay statistics of PacketReplay.run() under 'sent' and the
+	    per port SequenceTracker summary of the receiver under
+	    'received'. 'missing' is the number of packets sent but not
+	    received, summed over ports.
+	"""
+	socks = []
+	streams = []
+	consumers = []
+	try:
+		for ii in xrange(ports):
+			s = socket(AF_INET,SOCK_DGRAM)
+			socks.append(s)
+			s.setsockopt(SOL_SOCKET,SO_RCVBUF,64<<20)
+			s.bind((host,dest_port+ii))
+			stream = PacketStream(s,packet_cls,batch_size=batch_size)
+			streams.append(stream)
+			stream.start()
+			t = threading.Thread(target=_drain,args=(stream,),name="drain-{0}".format(ii))
+			t.daemon = True
+			consumers.append(t)
+			t.start()
+		# send from another process so that sender and receiver do not share the interpreter lock
+		q = multiprocessing.Queue()
+		proc = multiprocessing.Process(target=_replay_process,args=(q,packet_cls,n,host,dest_port,ports,rate,kwargs))
+		proc.start()
+		sent = q.get()
+		proc.join()
+		if isinstance(sent,Exception):
+			raise RuntimeError("Replay failed: {0}".format(sent))
+		sleep(grace)
+	finally:
+		for stream in streams:
+			stream.stop()
+		for t in consumers:
+			t.join()
+		for s in socks:
+			s.close()
+	received = dict((dest_port+ii,stream.tracker.summary()) for ii,stream in enumerate(streams))
+	missing = sum(sent['ports'][p]['sent'] - received[p]['packets'] for p in received)
+	return dict(sent=sent,received=received,missing=missing)
+
+def _replay_process(q,packet_cls,n,host,dest_port,ports,rate,kwargs):
+	try:
+		replay = PacketReplay(packet_cls,host=host,dest_port=dest_port,ports=ports,rate=rate,**kwargs)
+		try:
+			q.put(replay.run(n=n))
+		finally:
+			replay.close()
+	except Exception as e:
+		q.put(e)
+
+def _drain(stream):
+	for pkts in stream.batches():
+		pass
+
+def find_max_rate(packet_cls,rates,n,**kwargs):
+	"""
+	Find the highest rate at which no packet is missed.
+
+	Rates are tried in increasing order with measure_rate() and the
+	search stops at the first rate with missing packets, or at which the
+	replay itself falls more than 1% short of the requested rate.
+
+	Returns
+	-------
+	rate : float
+	    Highest rate in rates that was sustained, None if none was.
+	results : list
+	    (rate, measure_rate() result) for every rate tried.
+	"""
+	best = None
+	results = []
+	for r in sorted(rates):
+		res = measure_rate(packet_cls,r,n,**kwargs)
+		results.append((r,res))
+		if res['missing'] > 0 or res['sent']['rate'] < 0.99*r:
+			break
+		best = r
+	return best,results
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Replay He6CRES spectra over UDP in place of the ROACH2.")
+	parser.add_argument('--bits',type=int,choices=(8,16),default=8,help="Payload sample width. Default is 8.")
+	parser.add_argument('--host',default='127.0.0.1',help="Destination host. Default is 127.0.0.1.")
+	parser.add_argument('--port',type=int,default=4001,help="Port of the first channel. Default is 4001.")
+	parser.add_argument('--ports',type=int,default=1,help="Number of channels. Default is 1.")
+	parser.add_argument('--rate',type=float,default=1e4,help="Packets per second per port. Default is 1e4.")
+	parser.add_argument('--burst',type=int,default=1,help="Packets per port per tick. Default is 1.")
+	parser.add_argument('--loss',type=float,default=0.0,help="Probability of dropping a packet. Default is 0.")
+	parser.add_argument('--reorder',type=float,default=0.0,help="Probability of swapping a packet with its successor. Default is 0.")
+	parser.add_argument('--count',type=int,default=None,help="Packets to send per port. Default is no limit.")
+	parser.add_argument('--duration',type=float,default=None,help="Seconds to send for. Default is no limit.")
+	parser.add_argument('--spool',default=None,help="Replay spectra from the spool with this prefix.")
+	parser.add_argument('--seed',type=int,default=None,help="Random seed.")
+	parser.add_argument('--sweep',type=float,nargs='+',default=None,help="Find the highest sustained rate among these, receiving locally.")
+	args = parser.parse_args(argv)
+	if args.bits == 8:
+		from He6DAQ import Packet
+	else:
+		from He6DAQ_16bit import Packet
+	spectra = None
+	if not args.spool is None:
+		from spool import SpoolReader
+		with SpoolReader(args.spool,Packet) as reader:
+			spectra = reader.batch(0,4096).data.copy()
+	kwargs = dict(burst=args.burst,loss=args.loss,reorder=args.reorder,spectra=spectra,seed=args.seed)
+	if not args.sweep is None:
+		n = args.count if not args.count is None else 100000
+		best,results = find_max_rate(Packet,args.sweep,n,ports=args.ports,host=args.host,dest_port=args.port,**kwargs)
+		for r,res in results:
+			print "rate {0:12.1f} pkt/s/port: sent {1:.1f} pkt/s/port, missing {2}".format(r,res['sent']['rate'],res['missing'])
+		print "Highest sustained rate: {0}".format(best)
+		return 0
+	replay = PacketReplay(Packet,host=args.host,dest_port=args.port,ports=args.ports,rate=args.rate,**kwargs)
+	try:
+		stats = replay.run(n=args.count,duration=args.duration)
+	except KeyboardInterrupt:
+		return 1
+	finally:
+		replay.close()
+	for port in replay.ports:
+		s = stats['ports'][port]
+		print "port {0}: sent {1}, dropped {2}, reordered {3}".format(port,s['sent'],s['dropped'],s['reordered'])
+	print "{0:.1f} pkt/s per port over {1:.2f} s".format(stats['rate'],stats['elapsed'])
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+from collections import deque
+from numpy import (
+	arange,
+	asarray,
+	concatenate,
+	cumsum,
+	flatnonzero,
+	int64,
+	maximum,
+	minimum,
+	rint,
+	where,
+	)
+
+class SequenceTracker(object):
+	"""
+	Account for lost, duplicated and out-of-order packets in one stream.
+
+	The ROACH2 sends every digital channel as packet pairs: a packet of
+	frequency-domain data followed by a packet of time-domain data over
+	the same STFT window. Both packets of a pair carry the same
+	pkt_in_batch value, which counts pairs within a window of
+	WINDOW_SECONDS seconds and starts over at 0 after COUNTS_PER_WINDOW
+	pairs. Every packet is placed at a position in the stream
+
+	    position = (window*COUNTS_PER_WINDOW + pkt_in_batch)/stride*packets_per_count + member
+
+	where member is 0 for the frequency-domain and 1 for the time-domain
+	packet of a pair. The counter is unwrapped modulo COUNTS_PER_WINDOW,
+	so that the reset at the end of a window is a step of one pair, and
+	the number of whole windows between two packets is taken from their
+	unix_time. Positions are compared to the highest position seen so
+	far:
+
+	    * a packet ahead of the highest position by more than one opens a
+	      gap of lost packets,
+	    * a packet at the same position as its predecessor is counted as
+	      a duplicate,
+	    * a packet behind the highest position that falls in an open gap
+	      arrived out of order; it fills the gap, so the lost count is
+	      decremented,
+	    * any other packet behind the highest position, but within
+	      reorder_window of it, is a duplicate of a packet received
+	      earlier. Packets further behind are counted as out of order
+	      and assumed to fill a gap reported earlier.
+
+	Gaps stay open until the stream is reorder_window positions past
+	them and are only reported if packets are still missing then, so
+	that reordered packets do not show up as gaps. Consecutive packets
+	whose unix_time advances by more than one second are counted as time
+	jumps. All checks run vectorized over the header columns of a batch,
+	only gaps and late packets are handled one by one.
+	"""
+
+	# pkt_in_batch counts pairs within a window of this many seconds ...
+	WINDOW_SECONDS = 16
+	# ... and takes this many values, 0 to COUNTS_PER_WINDOW-1
+	COUNTS_PER_WINDOW = 390626
+
+	@property
+	def stride(self):
+		return self._stride
+
+	@property
+	def packets_per_count(self):
+		return self._per_count
+
+	@property
+	def reorder_window(self):
+		return self._reorder_window
+
+	def __init__(self,stride=1,max_gaps=1024,packets_per_count=2,reorder_window=4096):
+		"""
+		Initialize SequenceTracker.
+
+		Parameters
+		----------
+		stride : int
+		    Expected pkt_in_batch increment from one packet pair of the
+		    stream to the next. Default is 1.
+		max_gaps : int
+		    Number of most recent gaps for which the affected unix_time
+		    range is retained. Default is 1024.
+		packets_per_count : int
+		    Number of packets sharing a pkt_in_batch value, 2 for the
+		    frequency- and time-domain packet pairs sent by the ROACH2, 1
+		    for a stream that carries only one packet of every pair.
+		    Default is 2.
+		reorder_window : int
+		    Number of positions a gap is kept open for late packets
+		    before it is reported. Default is 4096.
+		"""
+		if stride < 1 or not packets_per_count in (1,2):
+			raise ValueError("Invalid stride {0} or packets_per_count {1}".format(stride,packets_per_count))
+		self._stride = stride
+		self._per_count = packets_per_count
+		self._reorder_window = reorder_window
+		self._gaps = deque(maxlen=max_gaps)
+		self.reset()
+
+	def reset(self):
+		"""
+		Forget the stream position and zero all counters.
+		"""
+		self._origin = None
+		self._last_count = 0
+		self._last_abs = 0
+		self._last_rank = 0
+		self._last_pos = 0
+		self._high = 0
+		self._last_ut = None
+		# open gaps as [first position, last position + 1, unix_time before, unix_time after, positions filled]
+		self._open = []
+		self._totals = dict(packets=0,lost=0,duplicated=0,out_of_order=0,time_jumps=0)
+		self._gaps.clear()
+
+	def summary(self):
+		"""
+		Return running counters.
+
+		Returns
+		-------
+		totals : dict
+		    Counts of packets, lost, duplicated, out_of_order and
+		    time_jumps since the last reset, and the list of the most
+		    recent gaps as (unix_time before, unix_time after, lost)
+		    tuples. Gaps that are still open come last, late packets
+		    may still fill them.
+		"""
+		totals = dict(self._totals)
+		totals['gaps'] = list(self._gaps) + [g for g in [self._gap_entry(g) for g in self._open] if g[2] > 0]
+		return totals
+
+	def update_batch(self,pkts):
+		"""
+		Update counters with the packets in a PacketBatch.
+
+		See update() for details.
+		"""
+		return self.update(pkts.unix_time,pkts.pkt_in_batch,pkts.freq_not_time)
+
+	def update(self,unix_time,pkt_in_batch,freq_not_time=None):
+		"""
+		Update counters with the next packets in the stream.
+
+		Parameters
+		----------
+		unix_time : ndarray
+		    unix_time header column of the packets, in order of arrival.
+		pkt_in_batch : ndarray
+		    pkt_in_batch header column of the packets, in order of arrival.
+		freq_not_time : ndarray
+		    freq_not_time header column of the packets, in order of
+		    arrival. Tells the packets of a pair apart if packets_per_count
+		    is 2. If None, the first of consecutive packets with the same
+		    pkt_in_batch is taken as the frequency-domain packet, which
+		    miscounts packets reordered across pairs. Default is None.
+
+		Returns
+		-------
+		report : dict
+		    Counts for these packets only, with keys as for summary(), and
+		    the running counters under the key 'total'. Gaps are listed
+		    when they are closed, lost is the net number of packets
+		    missing and may be negative when late packets fill gaps
+		    opened by an earlier update.
+		"""
+		cnt = asarray(pkt_in_batch,dtype=int64)
+		ut = asarray(unix_time,dtype=int64)
+		n = len(cnt)
+		report = dict(packets=n,lost=0,duplicated=0,out_of_order=0,time_jumps=0,gaps=[])
+		if n == 0:
+			report['total'] = self.summary()
+			return report
+		wrap = self.COUNTS_PER_WINDOW
+		first = self._origin is None
+		if first:
+			# first packet of the stream defines the starting position
+			self._origin = cnt[0]
+			self._last_count = cnt[0]
+			self._last_abs = cnt[0]
+			self._last_rank = -1
+			self._last_ut = ut[0]
+		prev_cnt = concatenate(([self._last_count],cnt[:-1]))
+		prev_ut = concatenate(([self._last_ut],ut[:-1]))
+		# counter step modulo the window, plus the whole windows that passed according to unix_time
+		step = (cnt - prev_cnt + wrap/2) % wrap - wrap/2
+		expect = (ut - prev_ut)*(wrap/float(self.WINDOW_SECONDS))
+		step = step + wrap*rint((expect - step)/wrap).astype(int64)
+		abs_cnt = self._last_abs + cumsum(step)
+		pos = (abs_cnt - self._origin)/self._stride*self._per_count
+		if self._per_count > 1:
+			if freq_not_time is None:
+				# rank of a packet among consecutive packets with the same counter
+				idx = arange(n,dtype=int64)
+				run = maximum.accumulate(where(step == 0,-1,idx))
+				rank = where(run < 0,self._last_rank + 1 + idx,idx - run)
+				self._last_rank = rank[-1]
+				pos = pos + minimum(rank,1)
+			else:
+				pos = pos + where(asarray(freq_not_time,dtype=bool),0,1)
+		if first:
+			self._last_pos = pos[0] - 1
+			self._high = pos[0] - 1
+		prev_pos = concatenate(([self._last_pos],pos[:-1]))
+		prev_high = maximum.accumulate(concatenate(([self._high],pos)))[:-1]
+		ahead = pos - prev_high
+		new = ahead > 0
+		dup = ~new & (pos == prev_pos)
+		late = ~new & ~dup
+		report['duplicated'] = int(dup.sum())
+		report['time_jumps'] = int(((ut - prev_ut) > 1).sum())
+		events = flatnonzero((ahead > 1) | late)
+		for ii in events:
+			if new[ii]:
+				self._open.append([prev_high[ii]+1,pos[ii],int(prev_ut[ii]),int(ut[ii]),set()])
+				report['lost'] = report['lost'] + int(ahead[ii]) - 1
+			elif self._fill(pos[ii],prev_high[ii]):
+				report['out_of_order'] = report['out_of_order'] + 1
+				report['lost'] = report['lost'] - 1
+			else:
+				report['duplicated'] = report['duplicated'] + 1
+		# carry the stream position over to the next batch
+		self._last_count = cnt[-1]
+		self._last_abs = abs_cnt[-1]
+		self._last_pos = pos[-1]
+		self._high = max(prev_high[-1],pos[-1])
+		self._last_ut = ut[-1]
+		# close the gaps the stream has left behind for good
+		while len(self._open) > 0 and self._open[0][1] <= self._high - self._reorder_window:
+			g = self._gap_entry(self._open.pop(0))
+			if g[2] > 0:
+				report['gaps'].append(g)
+		for k in ('packets','lost','duplicated','out_of_order','time_jumps'):
+			self._totals[k] = self._totals[k] + report[k]
+		self._gaps.extend(report['gaps'])
+		report['total'] = self.summary()
+		return report
+
+	def _fill(self,p,high):
+		"""
+		Account for a late packet at position p, return False for a duplicate.
+		"""
+		for g in reversed(self._open):
+			if g[0] <= p < g[1]:
+				if p in g[4]:
+					return False
+				g[4].add(p)
+				return True
+		# positions within the reorder window outside open gaps were all received
+		return p <= high - self._reorder_window
+
+	@staticmethod
+	def _gap_entry(g):
+		return (g[2],g[3],int(g[1] - g[0]) - len(g[4]))
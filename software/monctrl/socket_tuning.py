@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+import errno
+import os
+from socket import SOL_SOCKET, SO_RCVBUF, error as socket_error
+from stats import monotonic
+
+# Linux socket options not exported by the socket module
+SO_RCVBUFFORCE = 33
+SO_TIMESTAMPNS = 35
+SO_BUSY_POLL = 46
+
+def tune_socket(sock,rcvbuf=None,busy_poll=None,timestamps=False):
+	"""
+	Apply receive options to a datagram socket and read back their values.
+
+	The kernel silently caps SO_RCVBUF at net.core.rmem_max, so the
+	buffer size is first set with SO_RCVBUFFORCE, which needs
+	CAP_NET_ADMIN, and with SO_RCVBUF if that is not permitted. Linux
+	reserves twice the requested size for bookkeeping and reports the
+	doubled value, so the value read back is halved before comparing.
+
+	Parameters
+	----------
+	sock : socket
+	    Datagram socket, bound or not.
+	rcvbuf : int
+	    Receive buffer size in bytes. If None leave as is. Default is None.
+	busy_poll : int
+	    Microseconds to busy poll the device queue on receive
+	    (SO_BUSY_POLL). If None leave as is. Default is None.
+	timestamps : bool
+	    Enable nanosecond kernel receive timestamps (SO_TIMESTAMPNS).
+	    Default is False.
+
+	Returns
+	-------
+	applied : dict
+	    For every option requested, a dict with the requested and
+	    actual value and whether they agree.
+	"""
+	applied = dict()
+	if not rcvbuf is None:
+		try:
+			sock.setsockopt(SOL_SOCKET,SO_RCVBUFFORCE,rcvbuf)
+		except socket_error as e:
+			if not e.errno in (errno.EPERM,errno.EACCES,errno.ENOPROTOOPT):
+				raise
+			sock.setsockopt(SOL_SOCKET,SO_RCVBUF,rcvbuf)
+		actual = sock.getsockopt(SOL_SOCKET,SO_RCVBUF)/2
+		applied['rcvbuf'] = dict(requested=rcvbuf,actual=actual,ok=actual >= rcvbuf)
+	if not busy_poll is None:
+		actual = _set_get(sock,SO_BUSY_POLL,busy_poll)
+		applied['busy_poll'] = dict(requested=busy_poll,actual=actual,ok=actual == busy_poll)
+	if timestamps:
+		actual = _set_get(sock,SO_TIMESTAMPNS,1)
+		applied['timestamps'] = dict(requested=True,actual=bool(actual),ok=bool(actual))
+	return applied
+
+def _set_get(sock,opt,value):
+	try:
+		sock.setsockopt(SOL_SOCKET,opt,value)
+	except socket_error as e:
+		# not permitted or not supported by this kernel, report what is in effect
+		if not e.errno in (errno.EPERM,errno.EACCES,errno.ENOPROTOOPT,errno.EINVAL):
+			raise
+	try:
+		return sock.getsockopt(SOL_SOCKET,opt)
+	except socket_error:
+		return None
+
+def failed_options(applied):
+	"""
+	Return the names of options in a tune_socket() result that did not apply.
+	"""
+	return sorted(k for k,v in applied.items() if not v['ok'])
+
+def udp_socket_info(sock):
+	"""
+	Read the kernel's entry for a UDP socket from /proc/net/udp.
+
+	Parameters
+	----------
+	sock : socket
+	    Bound UDP socket.
+
+	Returns
+	-------
+	info : dict
+	    'drops', the number of datagrams the kernel discarded because the
+	    receive buffer was full, and 'rx_queue', the bytes waiting in the
+	    receive buffer. None if the socket is not listed, for example
+	    where /proc is not available.
+	"""
+	inode = str(os.fstat(sock.fileno()).st_ino)
+	for path in ('/proc/net/udp','/proc/net/udp6'):
+		try:
+			fh = open(path,'r')
+		except IOError:
+			continue
+		with fh:
+			fh.readline()
+			for line in fh:
+				fields = line.split()
+				# sl local rem st tx_queue:rx_queue tr:tm retrnsmt uid timeout inode ref pointer drops
+				if len(fields) >= 13 and fields[9] == inode:
+					return dict(drops=int(fields[12]),rx_queue=int(fields[4].split(':')[1],16))
+	return None
+
+class KernelDropMonitor(object):
+	"""
+	Follow the count of datagrams the kernel dropped on one socket.
+
+	The count is read from /proc/net/udp, which lists every UDP socket of
+	the host, so reads are rate-limited to one per interval seconds and
+	the last reading is returned in between. The socket can no longer be
+	looked up once it is closed, so close() takes a last reading and
+	keeps it.
+	"""
+
+	@property
+	def available(self):
+		return not self._base is None
+
+	def __init__(self,sock,interval=1.0):
+		"""
+		Initialize KernelDropMonitor and take the initial reading.
+
+		Parameters
+		----------
+		sock : socket
+		    Bound UDP socket.
+		interval : float
+		    Minimum seconds between reads of /proc/net/udp. Default is 1.0.
+		"""
+		self._sock = sock
+		self._interval = interval
+		info = udp_socket_info(sock)
+		self._base = None if info is None else info['drops']
+		self._last = 0
+		self._last_t = monotonic()
+		self._reported = 0
+
+	def drops(self,force=False):
+		"""
+		Return datagrams dropped by the kernel since the monitor was created.
+
+		Parameters
+		----------
+		force : bool
+		    Read /proc/net/udp even if the interval has not passed.
+		    Default is False.
+
+		Returns
+		-------
+		drops : int
+		    Number of dropped datagrams, None if not available.
+		"""
+		if self._base is None:
+			return None
+		if self._sock is None:
+			return self._last
+		t = monotonic()
+		if force or t - self._last_t >= self._interval:
+			info = udp_socket_info(self._sock)
+			if not info is None:
+				self._last = info['drops'] - self._base
+			self._last_t = t
+		return self._last
+
+	def close(self):
+		"""
+		Take a last reading and keep it, call before closing the socket.
+		"""
+		self.drops(force=True)
+		self._sock = None
+
+	def annotate(self,report,force=False):
+		"""
+		Add kernel drops to a SequenceTracker report.
+
+		Sets report['kernel_drops'] to the drops since the previous
+		report and, if present, report['total']['kernel_drops'] to the
+		drops since the monitor was created. Both are None if not
+		available.
+		"""
+		total = self.drops(force=force)
+		if total is None:
+			report['kernel_drops'] = None
+		else:
+			report['kernel_drops'] = total - self._reported
+			self._reported = total
+		if 'total' in report:
+			report['total']['kernel_drops'] = total
+		return report
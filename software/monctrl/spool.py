@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+from numpy import (
+	arange,
+	asarray,
+	concatenate,
+	cumsum,
+	dtype,
+	empty,
+	fromfile,
+	frombuffer,
+	int64,
+	searchsorted,
+	uint8,
+	unique,
+	zeros,
+	)
+from packet_batch import PacketBatch
+
+def _load_fallocate():
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+		f = libc.fallocate64
+	except (OSError,AttributeError,TypeError):
+		return None
+	f.argtypes = [ctypes.c_int,ctypes.c_int,ctypes.c_int64,ctypes.c_int64]
+	f.restype = ctypes.c_int
+	return f
+
+_fallocate = _load_fallocate()
+
+def _preallocate(fh,nbytes):
+	"""
+	Reserve nbytes of disk space for a file, return False if the file system cannot.
+	"""
+	if _fallocate is None:
+		return False
+	while _fallocate(fh.fileno(),0,0,nbytes) < 0:
+		err = ctypes.get_errno()
+		if err == errno.EINTR:
+			continue
+		if err in (errno.EOPNOTSUPP,errno.ENOSYS):
+			return False
+		raise IOError(err,os.strerror(err),fh.name)
+	return True
+
+# one record per block of packets written, all fields little-endian
+SPOOL_INDEX_DTYPE = dtype([
+	('file','<u4'),
+	('count','<u4'),
+	('offset','<u8'),
+	('unix_time','<u4'),
+	('pkt_in_batch','<u4'),
+	('digital_id','u1'),
+	('last_unix_time','<u4'),
+	])
+
+def spool_file_name(prefix,num):
+	"""
+	Return the name of spool file number num for the given prefix.
+	"""
+	return "{0}_{1:06d}.spool".format(prefix,num)
+
+def spool_index_name(prefix):
+	"""
+	Return the name of the sidecar index for the given prefix.
+	"""
+	return "{0}.idx".format(prefix)
+
+class SpoolWriter(object):
+	"""
+	Append raw packets to a sequence of large pre-sized spool files.
+
+	Packets are written exactly as received, block by block, so that no
+	decoding is needed to persist them. Each spool file is sized up front
+	to hold a whole number of packets and a new file is started once it is
+	full. For every block one record is appended to a sidecar index, see
+	SPOOL_INDEX_DTYPE, which holds the spool file number, byte offset and
+	packet count of the block and the header fields of its first packet.
+	"""
+
+	@property
+	def prefix(self):
+		return self._prefix
+
+	@property
+	def packets_written(self):
+		return self._packets_written
+
+	@property
+	def files(self):
+		return [spool_file_name(self._prefix,ii) for ii in xrange(self._file_num+1)]
+
+	def __init__(self,prefix,packet_cls,file_bytes=4<<30,presize=True):
+		"""
+		Initialize SpoolWriter and open the first spool file.
+
+		Parameters
+		----------
+		prefix : string
+		    Path prefix, spool files are named <prefix>_NNNNNN.spool and
+		    the index <prefix>.idx. Existing files are overwritten.
+		packet_cls : class
+		    Packet class that defines the header layout.
+		file_bytes : int
+		    Maximum size of each spool file, rounded down to a whole number
+		    of packets. Default is 4 GiB.
+		presize : bool
+		    Allocate the disk space of each spool file in full with
+		    fallocate(2) when it is opened, so that the file system can
+		    lay it out in one piece and a full disk is reported when a
+		    file is opened rather than while it is written. Where the
+		    file system does not support this the file is only extended,
+		    which leaves it sparse. The last file is cut to its used size
+		    on close(). Default is True.
+		"""
+		self._prefix = prefix
+		self._packet_cls = packet_cls
+		self._packet_bytes = packet_cls.BYTES_IN_PACKET
+		self._file_packets = file_bytes/self._packet_bytes
+		if self._file_packets < 1:
+			raise ValueError("Spool files of {0} bytes cannot hold a packet of {1} bytes".format(file_bytes,self._packet_bytes))
+		self._presize = presize
+		self._packets_written = 0
+		self._file_num = -1
+		self._fh = None
+		self._idx = open(spool_index_name(prefix),'wb')
+		self._next_file()
+
+	def write(self,raw):
+		"""
+		Append a block of raw packets.
+
+		Parameters
+		----------
+		raw : ndarray
+		    C-contiguous (k, BYTES_IN_PACKET) uint8 array of packets exactly
+		    as received, for example a view into a receive ring.
+
+		Returns
+		-------
+		k : int
+		    Number of packets written.
+		"""
+		if not raw.flags['C_CONTIGUOUS'] or not raw.ndim == 2 or not raw.shape[1] == self._packet_bytes:
+			raise ValueError("Raw packet block should be a C-contiguous (k, {0}) array".format(self._packet_bytes))
+		first = 0
+		while first < raw.shape[0]:
+			if self._file_fill == self._file_packets:
+				self._next_file()
+			k = min(raw.shape[0]-first,self._file_packets-self._file_fill)
+			block = raw[first:first+k]
+			self._write_index(block)
+			self._fh.write(block.data)
+			self._file_fill = self._file_fill + k
+			first = first + k
+		self._packets_written = self._packets_written + raw.shape[0]
+		return raw.shape[0]
+
+	def flush(self):
+		"""
+		Flush spool file and index to the operating system.
+		"""
+		self._fh.flush()
+		self._idx.flush()
+
+	def close(self):
+		"""
+		Close the spool files and the index.
+		"""
+		if self._fh is None:
+			return
+		self._close_file()
+		self._idx.close()
+		self._fh = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*exc):
+		self.close()
+
+	def _write_index(self,block):
+		hdr = self._packet_cls._unpack_header(self._packet_cls._header_view(block))
+		rec = zeros(1,dtype=SPOOL_INDEX_DTYPE)
+		rec['file'] = self._file_num
+		rec['count'] = block.shape[0]
+		rec['offset'] = self._file_fill*self._packet_bytes
+		rec['unix_time'] = hdr[0][0]
+		rec['pkt_in_batch'] = hdr[1][0]
+		rec['digital_id'] = hdr[2][0]
+		rec['last_unix_time'] = hdr[0][-1]
+		self._idx.write(rec.tostring())
+
+	def _close_file(self):
+		if self._presize:
+			self._fh.truncate(self._file_fill*self._packet_bytes)
+		self._fh.close()
+
+	def _next_file(self):
+		if not self._fh is None:
+			# a full file needs no truncation
+			self._fh.close()
+		self._file_num = self._file_num + 1
+		self._fh = open(spool_file_name(self._prefix,self._file_num),'wb',0)
+		if self._presize:
+			nbytes = self._file_packets*self._packet_bytes
+			if not _preallocate(self._fh,nbytes):
+				self._fh.truncate(nbytes)
+			self._fh.seek(0)
+		self._file_fill = 0
+
+class SpoolReader(object):
+	"""
+	Read spool files written by SpoolWriter through memory maps.
+
+	Each spool file is mapped read-only and viewed as a (packets,
+	BYTES_IN_PACKET) array, on which the header and payload views of the
+	Packet class are laid. Nothing is read until it is indexed, so that a
+	run of any size opens instantly and only the pages that are touched
+	are ever read from disk. Rows are numbered across all files in order
+	of writing.
+	"""
+
+	@property
+	def index(self):
+		return self._index
+
+	@property
+	def packet_cls(self):
+		return self._packet_cls
+
+	@property
+	def spectrogram(self):
+		return self._spectrogram
+
+	def __init__(self,prefix,packet_cls):
+		"""
+		Initialize SpoolReader and map the spool files.
+
+		Parameters
+		----------
+		prefix : string
+		    Path prefix as given to SpoolWriter.
+		packet_cls : class
+		    Packet class the spool was written with.
+		"""
+		self._packet_cls = packet_cls
+		self._index = fromfile(spool_index_name(prefix),dtype=SPOOL_INDEX_DTYPE)
+		# first row of every block, across files
+		counts = self._index['count'].astype(int64)
+		self._block_start = cumsum(counts) - counts
+		self._n_packets = int(counts.sum())
+		self._maps = []
+		self._raw = []
+		nbytes = packet_cls.BYTES_IN_PACKET
+		n_files = int(self._index['file'].max()) + 1 if len(self._index) else 0
+		file_packets = [int(counts[self._index['file'] == ii].sum()) for ii in xrange(n_files)]
+		for ii,n in enumerate(file_packets):
+			with open(spool_file_name(prefix,ii),'rb') as fh:
+				if n == 0:
+					mm = None
+					raw = empty((0,nbytes),dtype=uint8)
+				else:
+					mm = mmap.mmap(fh.fileno(),n*nbytes,access=mmap.ACCESS_READ)
+					raw = frombuffer(mm,dtype=uint8,count=n*nbytes).reshape((n,nbytes))
+			self._maps.append(mm)
+			self._raw.append(raw)
+		self._file_start = cumsum([0] + file_packets)
+		self._spectrogram = SpoolSpectrogram(self)
+
+	def __len__(self):
+		return self._n_packets
+
+	def close(self):
+		"""
+		Unmap the spool files. Views obtained earlier become invalid.
+		"""
+		self._raw = []
+		for mm in self._maps:
+			if not mm is None:
+				mm.close()
+		self._maps = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*exc):
+		self.close()
+
+	def header(self,start=0,stop=None):
+		"""
+		Return header columns for a range of rows.
+
+		Only the header bytes of the rows in range are read.
+
+		Returns
+		-------
+		columns : dict
+		    Maps each name in PacketBatch.HEADER_FIELDS to an array.
+		"""
+		fields = [self._packet_cls._unpack_header(self._packet_cls._header_view(raw)) for raw in self._raw_range(start,stop)]
+		if len(fields) == 0:
+			return dict((k,empty(0)) for k in PacketBatch.HEADER_FIELDS)
+		return dict((k,concatenate([f[ii] for f in fields])) for ii,k in enumerate(PacketBatch.HEADER_FIELDS))
+
+	def batch(self,start=0,stop=None):
+		"""
+		Decode a range of rows into a PacketBatch.
+		"""
+		batches = [PacketBatch.FromBuffer(raw,self._packet_cls) for raw in self._raw_range(start,stop)]
+		if len(batches) == 0:
+			return PacketBatch.FromBuffer(empty((0,self._packet_cls.BYTES_IN_PACKET),dtype=uint8),self._packet_cls)
+		if len(batches) == 1:
+			return batches[0]
+		return PacketBatch.concatenate(batches)
+
+	def seek(self,unix_time):
+		"""
+		Return the first row with a unix_time not before the given time.
+
+		The index locates the block that holds the time, then only the
+		headers of that block are read. Packets are assumed to have been
+		written in time order.
+
+		Returns
+		-------
+		row : int
+		    Row index, len(self) if all packets are earlier.
+		"""
+		blk = searchsorted(self._index['last_unix_time'],unix_time,side='left')
+		if blk == len(self._index):
+			return self._n_packets
+		start = int(self._block_start[blk])
+		stop = start + int(self._index['count'][blk])
+		ut = self.header(start,stop)['unix_time']
+		return start + int(searchsorted(ut,unix_time,side='left'))
+
+	def time_slice(self,t0,t1):
+		"""
+		Return the slice of rows with t0 <= unix_time < t1.
+		"""
+		return slice(self.seek(t0),self.seek(t1))
+
+	def rows_to_files(self,rows):
+		"""
+		Split global row numbers into (file number, local rows) groups.
+		"""
+		rows = asarray(rows,dtype=int64)
+		files = searchsorted(self._file_start,rows,side='right') - 1
+		groups = []
+		for ii in unique(files):
+			sel = files == ii
+			groups.append((int(ii),rows[sel]-self._file_start[ii],sel))
+		return groups
+
+	def _raw_range(self,start,stop):
+		if stop is None or stop > self._n_packets:
+			stop = self._n_packets
+		out = []
+		for ii,raw in enumerate(self._raw):
+			f0 = self._file_start[ii]
+			f1 = self._file_start[ii+1]
+			lo = max(start,f0)
+			hi = min(stop,f1)
+			if lo < hi:
+				out.append(raw[lo-f0:hi-f0])
+		return out
+
+class SpoolSpectrogram(object):
+	"""
+	Lazy (time, frequency) array over the payloads of a spool.
+
+	Indexing decodes only the rows that are selected; the selection along
+	the frequency axis is applied after decoding. Single integers select a
+	row, slices and integer arrays select several.
+	"""
+
+	@property
+	def shape(self):
+		return (len(self._reader),self._bins)
+
+	@property
+	def dtype(self):
+		return self._dtype
+
+	def __init__(self,reader):
+		self._reader = reader
+		cls = reader.packet_cls
+		self._bins = cls.CODEC.bins
+		self._dtype = cls.CODEC.dtype
+
+	def __len__(self):
+		return len(self._reader)
+
+	def __getitem__(self,key):
+		if not isinstance(key,tuple):
+			key = (key,)
+		if len(key) > 2:
+			raise IndexError("Spectrogram has two dimensions")
+		tkey = key[0]
+		fkey = key[1] if len(key) == 2 else slice(None)
+		scalar = isinstance(tkey,(int,long)) or (hasattr(tkey,'ndim') and tkey.ndim == 0)
+		if scalar:
+			if tkey < 0:
+				tkey = tkey + len(self)
+			rows = asarray([tkey])
+		elif isinstance(tkey,slice):
+			rows = arange(*tkey.indices(len(self)))
+		else:
+			rows = asarray(tkey)
+		out = empty((len(rows),self._bins),dtype=self._dtype)
+		cls = self._reader.packet_cls
+		for ii,local,sel in self._reader.rows_to_files(rows):
+			raw = self._reader._raw[ii]
+			# fancy indexing on the raw rows reads only the selected packets
+			out[sel] = cls._decode_payload(raw[local])
+		out = out[:,fkey]
+		if scalar:
+			return out[0]
+		return out
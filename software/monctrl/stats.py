@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+import ctypes
+import ctypes.util
+import threading
+from bisect import bisect_right
+from time import time
+
+_CLOCK_MONOTONIC = 1
+
+class _timespec(ctypes.Structure):
+	_fields_ = [
+		('tv_sec',ctypes.c_long),
+		('tv_nsec',ctypes.c_long),
+		]
+
+def _load_clock_gettime():
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+		f = libc.clock_gettime
+	except (OSError,AttributeError,TypeError):
+		return None
+	f.argtypes = [ctypes.c_int,ctypes.POINTER(_timespec)]
+	f.restype = ctypes.c_int
+	return f
+
+_clock_gettime = _load_clock_gettime()
+
+def monotonic():
+	"""
+	Return the time in seconds from a clock that never goes backwards.
+
+	Uses clock_gettime(CLOCK_MONOTONIC) where available, which unlike
+	time.time() is not stepped when the system clock is adjusted, and
+	falls back to time.time() otherwise.
+	"""
+	if _clock_gettime is None:
+		return time()
+	ts = _timespec()
+	_clock_gettime(_CLOCK_MONOTONIC,ctypes.byref(ts))
+	return ts.tv_sec + ts.tv_nsec*1e-9
+
+def log_edges(lo,hi,per_decade=4):
+	"""
+	Return logarithmically spaced bucket edges from lo to hi.
+	"""
+	edges = []
+	ii = 0
+	while True:
+		e = lo*10**(float(ii)/per_decade)
+		if e > hi*(1+1e-9):
+			break
+		edges.append(e)
+		ii = ii + 1
+	return edges
+
+def linear_edges(lo,hi,n):
+	"""
+	Return n+1 equally spaced bucket edges from lo to hi.
+	"""
+	return [lo + (hi-lo)*float(ii)/n for ii in xrange(n+1)]
+
+class Histogram(object):
+	"""
+	Fixed-size histogram of a scalar quantity.
+
+	Values are counted into the buckets between consecutive edges, with
+	one extra bucket below the first edge and one above the last, so that
+	memory use is fixed however many values are added. Count, sum,
+	minimum and maximum are kept exactly.
+	"""
+
+	@property
+	def edges(self):
+		return list(self._edges)
+
+	@property
+	def count(self):
+		return self._count
+
+	def __init__(self,edges):
+		"""
+		Initialize Histogram.
+
+		Parameters
+		----------
+		edges : list
+		    Increasing bucket edges.
+		"""
+		self._edges = list(edges)
+		self.reset()
+
+	def reset(self):
+		"""
+		Remove all values.
+		"""
+		self._counts = [0]*(len(self._edges)+1)
+		self._count = 0
+		self._sum = 0.0
+		self._min = None
+		self._max = None
+
+	def add(self,value):
+		"""
+		Add a value.
+		"""
+		self._counts[bisect_right(self._edges,value)] += 1
+		self._count += 1
+		self._sum += value
+		if self._min is None or value < self._min:
+			self._min = value
+		if self._max is None or value > self._max:
+			self._max = value
+
+	def quantile(self,q):
+		"""
+		Return an upper bound on the q-quantile, 0 <= q <= 1.
+
+		The bound is the upper edge of the bucket holding the quantile,
+		or the maximum for the overflow bucket. None if empty.
+		"""
+		if self._count == 0:
+			return None
+		target = q*self._count
+		acc = 0
+		for ii,c in enumerate(self._counts):
+			acc = acc + c
+			if acc >= target and c > 0:
+				if ii < len(self._edges):
+					return min(self._edges[ii],self._max)
+				return self._max
+		return self._max
+
+	def snapshot(self):
+		"""
+		Return the state of the histogram as a dict.
+
+		Returns
+		-------
+		state : dict
+		    Bucket edges and counts, the count, sum, min, max and mean of
+		    the values and estimates of the 50th, 90th and 99th
+		    percentiles.
+		"""
+		return dict(
+			edges=list(self._edges),
+			counts=list(self._counts),
+			count=self._count,
+			sum=self._sum,
+			min=self._min,
+			max=self._max,
+			mean=self._sum/self._count if self._count else None,
+			p50=self.quantile(0.5),
+			p90=self.quantile(0.9),
+			p99=self.quantile(0.99),
+			)
+
+class _StageTimer(object):
+
+	def __init__(self,stats,name):
+		self._stats = stats
+		self._name = name
+
+	def __enter__(self):
+		self._t0 = monotonic()
+		return self
+
+	def __exit__(self,*exc):
+		self._stats.add_time(self._name,monotonic() - self._t0)
+
+class PipelineStats(object):
+	"""
+	Stage timers, per-port counters and queue depth gauges.
+
+	Stage durations and gauge readings are aggregated in fixed-size
+	histograms, so that instrumentation can be left on indefinitely. The
+	pipeline records once per batch rather than per packet, which keeps
+	the cost to a few microseconds per batch. Updates of a given stage,
+	port or gauge are expected from one thread at a time; snapshot() may
+	be called from any thread while the pipeline runs.
+	"""
+
+	# stage durations from 1 us to 10 s, four buckets per decade
+	STAGE_EDGES = log_edges(1e-6,10.0,4)
+
+	@property
+	def enabled(self):
+		return self._enabled
+
+	@enabled.setter
+	def enabled(self,value):
+		self._enabled = bool(value)
+
+	def __init__(self,enabled=True):
+		"""
+		Initialize PipelineStats.
+
+		Parameters
+		----------
+		enabled : bool
+		    If False then nothing is recorded until enabled is set.
+		    Default is True.
+		"""
+		self._enabled = enabled
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		"""
+		Zero all timers, counters and gauges.
+		"""
+		with self._lock:
+			self._stages = dict()
+			self._ports = dict()
+			self._gauges = dict()
+			self._last = dict()
+			self._t0 = monotonic()
+
+	def stage(self,name):
+		"""
+		Return a context manager that times its body as the named stage.
+		"""
+		return _StageTimer(self,name)
+
+	def add_time(self,name,seconds):
+		"""
+		Record a duration in seconds for the named stage.
+		"""
+		if not self._enabled:
+			return
+		h = self._stages.get(name)
+		if h is None:
+			h = self._new(self._stages,name,self.STAGE_EDGES)
+		h.add(seconds)
+
+	def count(self,port,packets,nbytes):
+		"""
+		Count packets and bytes received on a port in one batch.
+		"""
+		if not self._enabled:
+			return
+		c = self._ports.get(port)
+		if c is None:
+			with self._lock:
+				c = self._ports.setdefault(port,[0,0,0])
+		c[0] += packets
+		c[1] += nbytes
+		c[2] += 1
+
+	def gauge(self,name,value,capacity):
+		"""
+		Record the current depth of a queue that holds at most capacity items.
+		"""
+		if not self._enabled:
+			return
+		g = self._gauges.get(name)
+		if g is None:
+			g = self._new(self._gauges,name,linear_edges(0,capacity,min(capacity,32)))
+		g.add(value)
+		self._last[name] = value
+
+	def snapshot(self):
+		"""
+		Return a copy of all statistics.
+
+		Returns
+		-------
+		stats : dict
+		    'stages' maps stage name to Histogram.snapshot() of its
+		    durations in seconds, 'ports' maps port to its packets, bytes
+		    and batches, 'gauges' maps gauge name to Histogram.snapshot()
+		    of its readings plus the last reading, and 'elapsed' holds
+		    the seconds since the last reset.
+		"""
+		with self._lock:
+			stages = dict((k,h.snapshot()) for k,h in self._stages.items())
+			ports = dict((k,dict(packets=c[0],bytes=c[1],batches=c[2])) for k,c in self._ports.items())
+			gauges = dict()
+			for k,g in self._gauges.items():
+				gauges[k] = g.snapshot()
+				gauges[k]['last'] = self._last.get(k)
+			elapsed = monotonic() - self._t0
+		return dict(stages=stages,ports=ports,gauges=gauges,elapsed=elapsed)
+
+	def _new(self,table,name,edges):
+		with self._lock:
+			if not name in table:
+				table[name] = Histogram(edges)
+			return table[name]
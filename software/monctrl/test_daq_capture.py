@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+from codec import BasePacket, PacketCodec
+from daq_capture import DataCapture
+from stats import PipelineStats, monotonic
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import unittest
+
+class Packet(BasePacket):
+
+	CODEC = PacketCodec('uint16')
+	PAYLOAD_DTYPE = CODEC.wire_dtype
+	SAMPLES_PER_WORD = CODEC.samples_per_word
+
+class LoopbackDAQ(DataCapture):
+
+	_PACKET = Packet
+
+	def __init__(self):
+		self._stats = PipelineStats()
+
+class SpoolInterruptTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def test_sigint_stops_idle_spool(self):
+		daq = LoopbackDAQ()
+		daq.open_dsoc(('127.0.0.1',0),rcvbuf=None)
+		# nothing is sent, the spool waits on an idle socket until interrupted
+		timer = threading.Timer(0.5,os.kill,(os.getpid(),signal.SIGINT))
+		timer.start()
+		t0 = monotonic()
+		try:
+			n = daq.spool_packets(os.path.join(self.tmp,'idle'),close_soc=True)
+		finally:
+			timer.cancel()
+		self.assertEqual(n,0)
+		self.assertLess(monotonic() - t0,5.0)
+		self.assertEqual(daq.packet_loss()['dsoc']['packets'],0)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+from codec import BasePacket, PacketCodec
+from integrate import SpectrumIntegrator
+from numpy import (
+	arange,
+	full,
+	int8,
+	uint32,
+	uint8,
+	uint64,
+	zeros,
+	)
+from packet_batch import PacketBatch
+import unittest
+
+class Packet(BasePacket):
+
+	CODEC = PacketCodec('int8')
+	PAYLOAD_DTYPE = CODEC.wire_dtype
+	SAMPLES_PER_WORD = CODEC.samples_per_word
+
+def interleaved(pairs,power,time_sample=-100):
+	"""
+	Return a PacketBatch of frequency- and time-domain packet pairs as the ROACH2 sends them.
+
+	Every spectrum holds power in all bins, as the unsigned 8-bit value
+	the firmware sends, decoded as int8. Time-domain packets hold
+	time_sample.
+	"""
+	n = 2*pairs
+	freq = arange(n) % 2 == 0
+	columns = dict(
+		unix_time=full(n,1000,dtype=uint32),
+		pkt_in_batch=(arange(n)/2).astype(uint32),
+		digital_id=zeros(n,dtype=uint8),
+		if_id=zeros(n,dtype=uint8),
+		user_data_0=zeros(n,dtype=uint32),
+		user_data_1=zeros(n,dtype=uint32),
+		reserved_0=zeros(n,dtype=uint64),
+		reserved_1=zeros(n,dtype=uint64),
+		freq_not_time=freq,
+		)
+	data = zeros((n,Packet.CODEC.bins),dtype=int8)
+	data[freq] = full(1,power,dtype=uint8).view(int8)
+	data[~freq] = time_sample
+	return PacketBatch(columns,data,Packet)
+
+class SpectrumIntegratorTest(unittest.TestCase):
+
+	def test_mean_skips_time_domain(self):
+		si = SpectrumIntegrator(Packet,n=4,mode='mean')
+		out = si.process(interleaved(8,200))
+		self.assertEqual(len(out),2)
+		self.assertTrue((out.count == 4).all())
+		self.assertTrue((out.data == 200.0).all())
+		self.assertEqual(out.start_pkt.tolist(),[0,4])
+		self.assertEqual(out.stop_pkt.tolist(),[3,7])
+
+	def test_max_hold_unsigned(self):
+		si = SpectrumIntegrator(Packet,n=3,mode='max')
+		# the second integration straddles the two batches
+		out = si.process(interleaved(4,200))
+		self.assertEqual(out.count.tolist(),[3])
+		out = si.process(interleaved(4,250))
+		self.assertEqual(out.count.tolist(),[3])
+		self.assertEqual(out.data.dtype,uint8)
+		self.assertTrue((out.data == 250).all())
+		out = si.flush()
+		self.assertEqual(out.count.tolist(),[2])
+		self.assertTrue((out.data == 250).all())
+
+if __name__ == '__main__':
+	unittest.main()
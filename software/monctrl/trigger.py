@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+
+from baseline import StreamBaselines
+from numpy import (
+	add,
+	arange,
+	complexfloating,
+	concatenate,
+	diff,
+	empty,
+	flatnonzero,
+	float32,
+	floor,
+	iinfo,
+	int32,
+	int64,
+	issubdtype,
+	maximum,
+	minimum,
+	nonzero,
+	searchsorted,
+	sqrt,
+	unique,
+	where,
+	zeros,
+	)
+
+class TriggerEvent(object):
+	"""
+	Encapsulate the spectra forwarded around one candidate event.
+
+	The event holds consecutive spectra of one (if_id, digital_id) stream,
+	from pre spectra before the first triggered spectrum to post spectra
+	after the last, restricted to the bins listed in bins. These are the
+	bins that triggered, widened on either side, so that tracks at
+	different frequencies in the same event do not pull in the bins
+	between them.
+	"""
+
+	@property
+	def if_id(self):
+		return self._if_id
+
+	@property
+	def digital_id(self):
+		return self._digital_id
+
+	@property
+	def unix_time(self):
+		return self._unix_time
+
+	@property
+	def pkt_in_batch(self):
+		return self._pkt_in_batch
+
+	@property
+	def bins(self):
+		return self._bins
+
+	@property
+	def windows(self):
+		"""
+		Runs of consecutive bins kept, as a list of (lo, hi) with hi exclusive.
+		"""
+		b = self._bins
+		split = flatnonzero(diff(b) > 1) + 1
+		starts = concatenate([[0],split])
+		stops = concatenate([split,[len(b)]])
+		return [(int(b[s]),int(b[e-1])+1) for s,e in zip(starts,stops)]
+
+	@property
+	def data(self):
+		return self._data
+
+	@property
+	def peak(self):
+		"""
+		Largest excess over the noise mean in the event, in noise standard deviations.
+		"""
+		return self._peak
+
+	@property
+	def triggers(self):
+		"""
+		Number of spectra in the event that met the trigger condition.
+		"""
+		return self._triggers
+
+	def __init__(self,if_id,digital_id,unix_time,pkt_in_batch,bins,data,peak,triggers):
+		"""
+		Initialize TriggerEvent.
+		"""
+		self._if_id = if_id
+		self._digital_id = digital_id
+		self._unix_time = unix_time
+		self._pkt_in_batch = pkt_in_batch
+		self._bins = bins
+		self._data = data
+		self._peak = peak
+		self._triggers = triggers
+
+	def __len__(self):
+		return self._data.shape[0]
+
+	def __repr__(self):
+		return "TriggerEvent(if_id={0}, digital_id={1}, {2} spectra x {3} bins in {4}, peak {5:.1f})".format(
+			self._if_id,self._digital_id,len(self),len(self._bins),self.windows,self._peak)
+
+class _OpenEvent(object):
+
+	def __init__(self):
+		self.data = []
+		self.unix_time = []
+		self.pkt_in_batch = []
+		self.bins = []
+		self.last = None
+		self.peak = 0.0
+		self.triggers = 0
+
+	def extend(self,bins,last,peak,triggers):
+		self.bins.append(bins)
+		self.last = last
+		self.peak = max(self.peak,peak)
+		self.triggers = self.triggers + triggers
+
+	def append(self,data,unix_time,pkt_in_batch,copy=False):
+		if len(data) == 0:
+			return
+		self.data.append(data.copy() if copy else data)
+		self.unix_time.append(unix_time.copy() if copy else unix_time)
+		self.pkt_in_batch.append(pkt_in_batch.copy() if copy else pkt_in_batch)
+
+class _StreamState(object):
+
+	def __init__(self,bins,dtype):
+		self.run = zeros(bins,dtype=int32)
+		self.hist_data = empty((0,bins),dtype=dtype)
+		self.hist_unix_time = empty(0,dtype=int64)
+		self.hist_pkt_in_batch = empty(0,dtype=int64)
+		self.event = None
+		# last row already forwarded, relative to the start of the next batch
+		self.claimed = -(1 << 62)
+
+class ExcessPowerTrigger(object):
+	"""
+	Keep only the spectra around candidate events in a stream of spectra.
+
+	A bin of a spectrum is above threshold if it exceeds the running mean
+	of that bin by threshold running standard deviations. A spectrum
+	triggers if any bin has been above threshold in coincidence
+	consecutive spectra, which suppresses isolated noise excursions while
+	passing the narrow, persistent power tracks of electrons. Triggered
+	spectra that are close together make one event, which is forwarded
+	with pre spectra before it and post spectra after it, restricted to
+	the bins that triggered widened by freq_pad on either side. All other
+	spectra and bins are dropped.
+
+	Streams are told apart by (if_id, digital_id), each with its own
+	BinBaseline as the noise estimate. Only frequency-domain packets are
+	tested, the interleaved time-domain packets are dropped. It is updated once per batch from
+	a fixed number of its spectra, clipped at the threshold so that
+	signals hardly bias it, and the whole batch is tested against the
+	estimate from before the batch.
+	The test is one comparison per sample in the sample type of the
+	packets; coincidence is only worked out for bins above threshold, so
+	that the cost per batch is dominated by reading the data once.
+	"""
+
+	@property
+	def threshold(self):
+		return self._threshold
+
+	@threshold.setter
+	def threshold(self,value):
+		if value <= 0:
+			raise ValueError("Threshold should be positive, got {0}".format(value))
+		self._threshold = float(value)
+
+	@property
+	def baselines(self):
+		"""
+		StreamBaselines holding the noise estimate of every stream.
+		"""
+		return self._baselines
+
+	@property
+	def coincidence(self):
+		return self._coincidence
+
+	@property
+	def pre(self):
+		return self._pre
+
+	@property
+	def post(self):
+		return self._post
+
+	@property
+	def freq_pad(self):
+		return self._freq_pad
+
+	def __init__(self,packet_cls,threshold=5.0,coincidence=3,pre=16,post=16,freq_pad=8,alpha=1.0/1024,warmup=256,noise_rows=64,min_sigma=1.0):
+		"""
+		Initialize ExcessPowerTrigger.
+
+		Parameters
+		----------
+		packet_cls : class
+		    Packet class of the stream, which fixes the number of bins and
+		    the sample type.
+		threshold : float
+		    Excess over the running mean, in running standard deviations,
+		    for a bin to be above threshold. Default is 5.0.
+		coincidence : int
+		    Number of consecutive spectra a bin must be above threshold
+		    in to trigger. Default is 3.
+		pre : int
+		    Spectra forwarded before the first spectrum of a coincidence.
+		    Default is 16.
+		post : int
+		    Spectra forwarded after the last triggered spectrum. Default
+		    is 16.
+		freq_pad : int
+		    Bins forwarded on either side of the triggered bins. Default
+		    is 8.
+		alpha : float
+		    Weight per spectrum of the running noise estimate, its time
+		    constant is 1/alpha spectra. Default is 1/1024.
+		warmup : int
+		    Spectra of a stream seen before it can trigger. Default is
+		    256.
+		noise_rows : int
+		    Maximum number of spectra per batch used to update the noise
+		    estimate. Default is 64.
+		min_sigma : float
+		    Lower bound on the standard deviation, which keeps bins that
+		    hardly vary, such as ones that are always zero, from
+		    triggering on the smallest change. Default is 1.0.
+		"""
+		if coincidence < 1 or pre < 0 or post < 0 or freq_pad < 0:
+			raise ValueError("Need coincidence >= 1 and non-negative padding, got coincidence={0}, pre={1}, post={2} and freq_pad={3}".format(coincidence,pre,post,freq_pad))
+		self._packet_cls = packet_cls
+		self.threshold = threshold
+		self._coincidence = coincidence
+		self._pre = pre
+		self._post = post
+		self._freq_pad = freq_pad
+		self._baselines = StreamBaselines(packet_cls,alpha=alpha)
+		self._warmup = warmup
+		self._noise_rows = noise_rows
+		self._min_sigma = min_sigma
+		self._bins = packet_cls.CODEC.bins
+		self._dtype = packet_cls.CODEC.dtype
+		self._complex = issubdtype(self._dtype,complexfloating)
+		self._power_dtype = self._baselines.power_dtype
+		self.reset()
+
+	def reset(self):
+		"""
+		Forget noise estimates, history and events in progress.
+		"""
+		self._baselines.reset()
+		self._streams = dict()
+		self._counts = dict(spectra_in=0,spectra_out=0,bytes_in=0,bytes_out=0,events=0)
+
+	def summary(self):
+		"""
+		Return the amount of data in and out of the trigger.
+
+		Returns
+		-------
+		summary : dict
+		    Spectra and bytes in and out, number of events and the ratio
+		    of bytes in to bytes out.
+		"""
+		s = dict(self._counts)
+		s['reduction'] = float(s['bytes_in'])/s['bytes_out'] if s['bytes_out'] else None
+		return s
+
+	def process(self,pkts,stats=None):
+		"""
+		Test a batch of spectra and return the events it completes.
+
+		Parameters
+		----------
+		pkts : PacketBatch
+		    Decoded packets, in order of arrival. Time-domain packets
+		    are dropped.
+		stats : PipelineStats
+		    If not None, record the time taken as stage 'trigger'.
+		    Default is None.
+
+		Returns
+		-------
+		events : list
+		    TriggerEvent objects completed by this batch, in order of
+		    completion. Events still open at the end of the batch are
+		    returned by a later call or by flush().
+		"""
+		if not stats is None:
+			with stats.stage('trigger'):
+				return self.process(pkts)
+		events = []
+		pkts = pkts.spectra()
+		if len(pkts) > 0:
+			key = pkts.if_id.astype(int64) << 6 | pkts.digital_id
+			keys = unique(key)
+			if len(keys) == 1:
+				self._process_stream((int(pkts.if_id[0]),int(pkts.digital_id[0])),pkts.data,pkts.unix_time,pkts.pkt_in_batch,events)
+			else:
+				for k in keys:
+					idx = flatnonzero(key == k)
+					self._process_stream((int(k >> 6),int(k & 0x3F)),pkts.data[idx],pkts.unix_time[idx],pkts.pkt_in_batch[idx],events)
+			self._counts['spectra_in'] += len(pkts)
+			self._counts['bytes_in'] += pkts.data.nbytes
+		return events
+
+	def flush(self):
+		"""
+		Complete all events in progress, without their remaining post padding.
+
+		Returns
+		-------
+		events : list
+		    TriggerEvent objects.
+		"""
+		events = []
+		for k,st in sorted(self._streams.items()):
+			if not st.event is None:
+				events.append(self._close(k,st.event))
+				st.event = None
+		return events
+
+	def filter(self,batches,stats=None):
+		"""
+		Trigger on an iterable of batches, such as He6CRES_DAQ.iter_packets().
+
+		Yields
+		------
+		event : TriggerEvent
+		    Every event, as it completes. When the batches are exhausted
+		    the events in progress are yielded, see flush().
+		"""
+		for pkts in batches:
+			for ev in self.process(pkts,stats=stats):
+				yield ev
+		for ev in self.flush():
+			yield ev
+
+	def _level(self,noise):
+		sigma = maximum(sqrt(noise.var),self._min_sigma)
+		level = noise.mean + self._threshold*sigma
+		if self._complex:
+			return level.astype(float32),sigma
+		# x > level for integer x is x > floor(level), compared without conversion
+		info = iinfo(self._power_dtype)
+		return floor(level).clip(info.min,info.max).astype(self._power_dtype),sigma
+
+	def _process_stream(self,key,data,unix_time,pkt_in_batch,events):
+		st = self._streams.get(key)
+		if st is None:
+			st = _StreamState(self._bins,self._dtype)
+			self._streams[key] = st
+		x = self._baselines.power(data)
+		m = len(x)
+		noise = self._baselines.get(*key)
+		clip = None
+		trig = None
+		if noise.count >= self._warmup:
+			level,sigma = self._level(noise)
+			clip = level
+			trig = self._coincident(st,noise,x,level,sigma)
+		else:
+			st.run[:] = 0
+		noise.update(x,clip,stride=max(1,m/self._noise_rows))
+		self._forward(key,st,data,unix_time,pkt_in_batch,trig,events)
+		# keep the spectra that may be needed as pre padding of the next event
+		h = self._pre + self._coincidence - 1
+		if h > 0:
+			if m >= h:
+				st.hist_data = data[m-h:].copy()
+				st.hist_unix_time = unix_time[m-h:].copy()
+				st.hist_pkt_in_batch = pkt_in_batch[m-h:].copy()
+			else:
+				st.hist_data = concatenate([st.hist_data,data])[-h:]
+				st.hist_unix_time = concatenate([st.hist_unix_time,unix_time])[-h:]
+				st.hist_pkt_in_batch = concatenate([st.hist_pkt_in_batch,pkt_in_batch])[-h:]
+
+	def _coincident(self,st,noise,x,level,sigma):
+		"""
+		Return rows that trigger, the index of their first triggered bin, the triggered bins in row order and the peak excess per row.
+		"""
+		m = len(x)
+		above = x > level
+		cols = flatnonzero(above.any(axis=0) | (st.run > 0))
+		if len(cols) == 0:
+			return None
+		a = above[:,cols]
+		# run length of consecutive spectra above threshold, carried over from the previous batch
+		pos = arange(m)[:,None]
+		last_below = maximum.accumulate(where(a,-1-st.run[cols][None,:],pos),axis=0)
+		run = pos - last_below
+		st.run[:] = 0
+		st.run[cols] = run[-1]
+		hr,hc = nonzero(run >= self._coincidence)
+		if len(hr) == 0:
+			return None
+		b = cols[hc]
+		rows = unique(hr)
+		first = searchsorted(hr,rows)
+		z = (x[hr,b] - noise.mean[b])/sigma[b]
+		return (rows,first,b,maximum.reduceat(z,first))
+
+	def _forward(self,key,st,data,unix_time,pkt_in_batch,trig,events):
+		m = len(data)
+		pre = self._pre + self._coincidence - 1
+		post = self._post
+		# triggered spectra closer than this share an event, so that events never overlap
+		gap = pre + post + 1
+		groups = []
+		if not trig is None:
+			rows,first,b,peak = trig
+			split = flatnonzero(diff(rows) > gap) + 1
+			starts = concatenate([[0],split])
+			stops = concatenate([split,[len(rows)]])
+			for s,e in zip(starts,stops):
+				hits = slice(first[s],first[e] if e < len(rows) else len(b))
+				groups.append((rows[s],rows[e-1],unique(b[hits]),peak[s:e].max(),e - s))
+		ev = st.event
+		consumed = 0
+		if not ev is None:
+			if groups and groups[0][0] - ev.last <= gap:
+				f,l,gbins,gpeak,n = groups.pop(0)
+				ev.extend(gbins,l,gpeak,n)
+			end = ev.last + post
+			if end < m:
+				ev.append(data[:end+1],unix_time[:end+1],pkt_in_batch[:end+1])
+				events.append(self._close(key,ev))
+				st.event = None
+				consumed = end + 1
+			else:
+				ev.append(data,unix_time,pkt_in_batch,copy=True)
+				consumed = m
+			st.claimed = consumed - 1
+		for f,l,gbins,gpeak,n in groups:
+			ev = _OpenEvent()
+			ev.extend(gbins,l,gpeak,n)
+			start = max(f - pre,st.claimed + 1,-len(st.hist_data))
+			if start < 0:
+				ev.append(st.hist_data[start:],st.hist_unix_time[start:],st.hist_pkt_in_batch[start:])
+				start = 0
+			end = l + post
+			if end < m:
+				ev.append(data[start:end+1],unix_time[start:end+1],pkt_in_batch[start:end+1])
+				events.append(self._close(key,ev))
+				st.claimed = end
+			else:
+				ev.append(data[start:],unix_time[start:],pkt_in_batch[start:],copy=True)
+				st.event = ev
+				st.claimed = m - 1
+		# indices are relative to the start of the batch
+		if not st.event is None:
+			st.event.last = st.event.last - m
+		st.claimed = st.claimed - m
+
+	def _close(self,key,ev):
+		# mark freq_pad bins either side of every triggered bin
+		b = unique(concatenate(ev.bins))
+		edge = zeros(self._bins+1,dtype=int32)
+		add.at(edge,maximum(b - self._freq_pad,0),1)
+		add.at(edge,minimum(b + self._freq_pad + 1,self._bins),-1)
+		cols = flatnonzero(edge.cumsum()[:-1] > 0)
+		data = concatenate([d[:,cols] for d in ev.data])
+		event = TriggerEvent(key[0],key[1],concatenate(ev.unix_time),concatenate(ev.pkt_in_batch),cols,data,float(ev.peak),ev.triggers)
+		self._counts['events'] += 1
+		self._counts['spectra_out'] += len(event)
+		self._counts['bytes_out'] += data.nbytes
+		return event
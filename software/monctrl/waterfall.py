@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+import multiprocessing
+from numpy import (
+	abs as np_abs,
+	asarray,
+	dtype,
+	flatnonzero,
+	float32,
+	frombuffer,
+	full,
+	int8,
+	iscomplexobj,
+	log10,
+	maximum,
+	nan,
+	nanmax,
+	nanmin,
+	uint8,
+	)
+from stats import monotonic
+from time import sleep
+
+class Waterfall(object):
+	"""
+	Live waterfall display that runs beside packet capture.
+
+	The display runs in its own process, so that drawing never holds up
+	the receiver, and the capture loop hands it spectra through offer().
+	The hand-off is latest-wins: whenever the display is ready for a new
+	frame it raises a flag, and the next call to offer() copies the last
+	nspec spectra of its batch into shared memory and clears the flag.
+	Only frequency-domain packets are shown, the interleaved time-domain
+	packets are skipped, and 8-bit spectra are taken as the unsigned
+	power the firmware sends.
+	All other calls return after checking the flag, so the capture loop
+	does a bounded copy at most fps times per second whatever the packet
+	rate. Spectra that arrive between frames are not shown.
+
+	Each frame the display reduces the spectra it was handed to one row,
+	by maximum (max-hold) or mean over spectra and over groups of
+	adjacent bins, scrolls the image by one row and redraws only the
+	image by blitting, at a fixed frame rate.
+	"""
+
+	MODES = ('max','mean')
+
+	@property
+	def bins(self):
+		return self._bins
+
+	@property
+	def nspec(self):
+		return self._nspec
+
+	@property
+	def mode(self):
+		return self._mode
+
+	@property
+	def fps(self):
+		return self._fps
+
+	@property
+	def frames(self):
+		"""
+		Number of frames drawn so far.
+		"""
+		return self._frames.value
+
+	@property
+	def offered(self):
+		"""
+		Number of times spectra were handed to the display.
+		"""
+		return self._seq.value
+
+	def __init__(self,packet_cls,nspec=16,mode='max',rows=256,width=1024,fps=10.0,digital_id=None,db=True,freq_range=None,title=None):
+		"""
+		Initialize Waterfall.
+
+		Parameters
+		----------
+		packet_cls : class
+		    Packet class of the stream, which fixes the number of bins and
+		    the sample type.
+		nspec : int
+		    Maximum number of spectra reduced into one row. Default is 16.
+		mode : string
+		    Reduction over spectra and bins, 'max' or 'mean'. Default is
+		    'max'.
+		rows : int
+		    Number of rows in the image. Default is 256.
+		width : int
+		    Number of columns in the image, should divide the number of
+		    bins. Default is 1024.
+		fps : float
+		    Frames drawn per second. Default is 10.0.
+		digital_id : int
+		    Only show spectra of this digital channel. If None show all.
+		    Default is None.
+		db : bool
+		    Show power in decibels. Default is True.
+		freq_range : tuple
+		    Frequencies (lo, hi) of the first and past the last bin, for
+		    the horizontal axis. If None label bins. Default is None.
+		title : string
+		    Figure title. Default is None.
+		"""
+		if not mode in self.MODES:
+			raise ValueError("Unknown mode '{0}', should be one of {1}".format(mode,self.MODES))
+		bins = packet_cls.CODEC.bins
+		if width > bins or bins % width != 0:
+			raise ValueError("Image width {0} should divide the number of bins {1}".format(width,bins))
+		if nspec < 1 or rows < 1 or fps <= 0:
+			raise ValueError("nspec, rows and fps should be positive, got nspec={0}, rows={1} and fps={2}".format(nspec,rows,fps))
+		self._packet_cls = packet_cls
+		self._bins = bins
+		self._dtype = packet_cls.CODEC.dtype
+		# 8-bit power is sent unsigned, decoded as int8 it would wrap above 127
+		if self._dtype == int8:
+			self._dtype = dtype(uint8)
+		self._nspec = nspec
+		self._mode = mode
+		self._rows = rows
+		self._width = width
+		self._fps = float(fps)
+		self._digital_id = digital_id
+		self._db = db
+		self._freq_range = freq_range
+		self._title = title
+		# shared between capture and display process
+		self._buf = multiprocessing.RawArray('B',nspec*bins*self._dtype.itemsize)
+		self._slab = frombuffer(self._buf,dtype=self._dtype).reshape((nspec,bins))
+		self._count = multiprocessing.RawValue('i',0)
+		self._unix_time = multiprocessing.RawValue('L',0)
+		self._seq = multiprocessing.RawValue('L',0)
+		self._frames = multiprocessing.RawValue('L',0)
+		self._lock = multiprocessing.Lock()
+		self._want = multiprocessing.Event()
+		self._stop = multiprocessing.Event()
+		self._proc = None
+
+	def start(self):
+		"""
+		Open the display in a new process.
+		"""
+		if not self._proc is None:
+			raise RuntimeError("Waterfall already started")
+		self._stop.clear()
+		self._proc = multiprocessing.Process(target=self._run,name='waterfall')
+		self._proc.daemon = True
+		self._proc.start()
+
+	def stop(self,timeout=5.0):
+		"""
+		Close the display and wait for its process to end.
+		"""
+		if self._proc is None:
+			return
+		self._stop.set()
+		self._proc.join(timeout)
+		if self._proc.is_alive():
+			self._proc.terminate()
+			self._proc.join()
+		self._proc = None
+
+	def is_alive(self):
+		"""
+		Return True while the display is open, False once its window was closed.
+		"""
+		return not self._proc is None and self._proc.is_alive()
+
+	def offer(self,pkts):
+		"""
+		Hand a batch of spectra to the display if it is ready for a frame.
+
+		Parameters
+		----------
+		pkts : PacketBatch
+		    Decoded packets, of which the frequency-domain packets are
+		    shown.
+
+		Returns
+		-------
+		taken : bool
+		    True if spectra were copied for the next frame.
+		"""
+		if not self._want.is_set():
+			return False
+		# never wait on the display
+		if not self._lock.acquire(False):
+			return False
+		try:
+			keep = asarray(pkts.freq_not_time,dtype=bool)
+			if not self._digital_id is None:
+				keep = keep & (pkts.digital_id == self._digital_id)
+			idx = flatnonzero(keep)[-self._nspec:]
+			n = len(idx)
+			if n == 0:
+				return False
+			self._slab[:n] = pkts.data[idx].view(self._dtype)
+			self._count.value = n
+			self._unix_time.value = int(pkts.unix_time[idx[-1]])
+			self._seq.value += 1
+			self._want.clear()
+		finally:
+			self._lock.release()
+		return True
+
+	def _reduce(self):
+		x = self._slab[:self._count.value]
+		if iscomplexobj(x):
+			x = np_abs(x)**2
+		x = x.reshape((x.shape[0],self._width,self._bins/self._width))
+		if self._mode == 'max':
+			row = x.max(axis=2).max(axis=0).astype(float32)
+		else:
+			row = x.mean(axis=2,dtype=float32).mean(axis=0)
+		if self._db:
+			row = 10*log10(maximum(row,1e-3))
+		return row
+
+	def _run(self):
+		# imported here so that capture does not depend on a display
+		import matplotlib.pyplot as mplpp
+		image = full((self._rows,self._width),nan,dtype=float32)
+		if self._freq_range is None:
+			extent = (0,self._bins,self._rows,0)
+		else:
+			extent = (self._freq_range[0],self._freq_range[1],self._rows,0)
+		fig = mplpp.figure(figsize=(12,9),dpi=80,facecolor='w',edgecolor='k')
+		ax = fig.add_subplot(111)
+		im = ax.imshow(image,aspect='auto',interpolation='nearest',extent=extent,animated=True)
+		txt = ax.text(0.01,0.99,'',transform=ax.transAxes,va='top',color='w',animated=True)
+		ax.set_xlabel('Frequency (MHz)' if not self._freq_range is None else 'Bin')
+		ax.set_ylabel('Frames ago')
+		if not self._title is None:
+			fig.suptitle(self._title)
+		fig.colorbar(im,ax=ax,label='Power (dB)' if self._db else 'Power')
+		bg = dict()
+		def on_draw(event):
+			# a full redraw, e.g. after resizing, invalidates the background
+			bg['region'] = fig.canvas.copy_from_bbox(ax.bbox)
+			ax.draw_artist(im)
+			ax.draw_artist(txt)
+		fig.canvas.mpl_connect('draw_event',on_draw)
+		mplpp.show(block=False)
+		fig.canvas.draw()
+		last = self._seq.value
+		lo = hi = None
+		frame = 1.0/self._fps
+		t_next = monotonic()
+		while not self._stop.is_set() and mplpp.fignum_exists(fig.number):
+			self._want.set()
+			with self._lock:
+				seq = self._seq.value
+				if seq != last:
+					row = self._reduce()
+					ut = self._unix_time.value
+					n = self._count.value
+			if seq != last:
+				last = seq
+				image[1:] = image[:-1]
+				image[0] = row
+				# widen the colour scale to the range seen so far
+				lo = nanmin(row) if lo is None else min(lo,nanmin(row))
+				hi = nanmax(row) if hi is None else max(hi,nanmax(row))
+				im.set_data(image)
+				im.set_clim(lo,hi if hi > lo else lo + 1)
+				txt.set_text("unix_time {0}, {1} spectra per row".format(ut,n))
+			if 'region' in bg:
+				fig.canvas.restore_region(bg['region'])
+				ax.draw_artist(im)
+				ax.draw_artist(txt)
+				fig.canvas.blit(ax.bbox)
+			fig.canvas.flush_events()
+			self._frames.value += 1
+			t_next = t_next + frame
+			wait = t_next - monotonic()
+			if wait > 0:
+				sleep(wait)
+			else:
+				# drop frames rather than catch up
+				t_next = monotonic()
+		mplpp.close(fig)